@@ -21,7 +21,13 @@ fi
 # TODO: introduce a constraints.txt file as a mechanism to pin specific
 # versions, while keeping this file clean.
 
-PIP3="$SUDO python3 -m pip --no-cache-dir"
+if [ -n "$CASA_BUILD_CACHE" ]; then
+    # keep downloaded wheels in the package cache mounted by casa_distro
+    # (PIP_CACHE_DIR)
+    PIP3="$SUDO python3 -m pip"
+else
+    PIP3="$SUDO python3 -m pip --no-cache-dir"
+fi
 PIP_INSTALL="$PIP3 install -c /build/pip_dev_constraints.txt"
 
 # Python packages that do not exist as APT packages
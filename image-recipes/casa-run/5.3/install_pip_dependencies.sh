@@ -30,7 +30,13 @@ fi
 # If there is a specific reason to constrain the version of a package, please
 # introduce the version constraint in this file and document the reason.
 
-PIP3="$SUDO python3 -m pip --no-cache-dir"
+if [ -n "$CASA_BUILD_CACHE" ]; then
+    # keep downloaded wheels in the package cache mounted by casa_distro
+    # (PIP_CACHE_DIR)
+    PIP3="$SUDO python3 -m pip"
+else
+    PIP3="$SUDO python3 -m pip --no-cache-dir"
+fi
 PIP_INSTALL="$PIP3 install -c /build/pip_constraints.txt"
 ${PIP_INSTALL} -U pip
 
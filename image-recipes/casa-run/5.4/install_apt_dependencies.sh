@@ -392,7 +392,11 @@ $SUDO apt-get -o Acquire::Retries=20 install --no-install-recommends -y \
 # Free disk space by removing APT caches
 ###############################################################################
 
-$SUDO apt-get clean
+if [ -z "$CASA_BUILD_CACHE" ]; then
+    # downloaded packages are kept in the package cache mounted by
+    # casa_distro (APT_CONFIG), outside of the image
+    $SUDO apt-get clean
+fi
 
 if [ -z "$APT_NO_LIST_CLEANUP" ]; then
     # delete all the apt list files since they're big and get stale quickly
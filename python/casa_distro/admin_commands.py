@@ -3,6 +3,7 @@
 
 import datetime
 import glob
+import inspect
 import json
 import os
 import os.path as osp
@@ -19,17 +20,21 @@
 from casa_distro.command import command, check_boolean
 from casa_distro.defaults import (default_base_directory,
                                   publish_url, default_download_url)
-from casa_distro.environment import (CasaDistroBBIDaily, casa_distro_directory,
+from casa_distro.environment import (casa_distro_directory,
                                      iter_environments,
                                      run_container,
                                      select_environment,
                                      get_run_base_of_dev_image)
 from casa_distro.log import verbose_file, boolean_value
+import casa_distro.hash
 import casa_distro.singularity
 import casa_distro.apptainer_pixi
 import casa_distro.vbox
 import casa_distro.docker
-from casa_distro.hash import file_hash
+from casa_distro.hash import (file_hash, tree_hash, directory_manifest,
+                              manifest_fingerprint)
+from casa_distro.web import catalog_basename
+from casa_distro.delta import write_block_index, control_suffix
 from .image_builder import get_image_builder, LocalInstaller
 
 
@@ -283,6 +288,27 @@ def create_base_image(type,
         images (this is the recommended wby). Otherwise, "sudo singularity"
         must be used so singularity has root access on the host.
 
+    step_cache (allowed only if container_type=singularity)
+        default=no
+
+        If ``yes``, ``true`` or 1, build each step of the image recipe as an
+        intermediate image kept in $CASA_DISTRO_BUILD_CACHE (by default
+        ~/.cache/casa-distro/build_steps). A new build reuses the images of
+        the steps which have not changed (same commands and same copied
+        files) and resumes from the first modified step. The step images
+        replaced by a new build of the same recipe on the same base image
+        are removed from the cache.
+
+    package_cache (allowed only if container_type=singularity)
+        default=no
+
+        Host directory where apt and pip keep the packages they download
+        during the build, so that they are not downloaded again by the next
+        builds. It is mounted on /casa-build-cache during the build and is
+        not part of the image. If ``yes``, ``true`` or 1,
+        ~/.cache/casa-distro/packages is used. The number of files reused
+        from the cache and downloaded is reported at the end of the build.
+
     memory (allowed only if container_type=vbox)
         default=8192
 
@@ -424,28 +450,25 @@ def create_base_image(type,
     elif osp.isfile(output):
         metadata['size'] = os.stat(output).st_size
         metadata['md5'] = file_hash(output)
+        metadata['tree_hash'] = tree_hash(output)
         metadata['image_id'] = image_id
         json.dump(metadata, open(metadata_output, 'w'),
                   indent=4, separators=(',', ': '))
 
 
-def create_numbered_file(url, filename, metadata):
-    script = '''from __future__ import print_function
-import os, sys
-import json
+def _numbered_file_script(filename, metadata):
+    '''
+    Python script run on the publication server by
+    :func:`create_numbered_file`. casa_distro may not be installed there:
+    the :mod:`casa_distro.hash` module, which only depends on the standard
+    library, is included in the script (without its benchmark main block).
+    '''
+    hash_source = inspect.getsource(casa_distro.hash).split(
+        "\nif __name__ == '__main__':")[0]
+    return hash_source + '''
 import glob
 import re
-import hashlib
-
-def file_hash(path, blocksize=2**20):
-    m = hashlib.md5()
-    with open(path, 'rb') as f:
-        while True:
-            buf = f.read(blocksize)
-            if not buf:
-                break
-            m.update(buf)
-    return m.hexdigest()
+
 
 def check_image(metadata, meta_filename):
     'True if meta_filename is up-to-date'
@@ -527,6 +550,9 @@ def check_image(metadata, meta_filename):
     os.unlink(sys.argv[0])
 ''' % (filename, repr(metadata))
 
+
+def create_numbered_file(url, filename, metadata):
+    script = _numbered_file_script(filename, metadata)
     script_filename = tempfile.mkstemp()
     os.close(script_filename[0])
 
@@ -563,6 +589,78 @@ def check_image(metadata, meta_filename):
         os.unlink(script_filename[1])
 
 
+def update_remote_catalog(url, remote_dir):
+    '''
+    Regenerate the images catalog (see :func:`casa_distro.web.url_catalog`)
+    of a download directory on the publication server, from the JSON
+    metadata files of the images it contains.
+    '''
+    script = '''from __future__ import print_function
+import os, sys
+import json
+import glob
+import re
+
+image_re = re.compile(
+    r'(?P<name>[\\w-]+)'
+    r'(?:-(?P<version>\\d+\\.\\d+(?:\\.\\d+)?)'
+    r'(?:-(?P<patch>\\d+))?)?'
+    r'\\.(?P<extension>\\w+)$')
+
+try:
+    directory = "%s"
+    catalog_file = os.path.join(directory, "%s")
+    images = {}
+    for meta_file in glob.glob(os.path.join(directory, '*.json')):
+        image = meta_file[:-5]
+        m = image_re.match(os.path.basename(image))
+        if not m or not os.path.isfile(image):
+            continue
+        try:
+            with open(meta_file) as f:
+                metadata = json.load(f)
+        except ValueError:
+            continue
+        images[os.path.basename(image)] = {
+            'name': m.group('name'),
+            'version': m.group('version'),
+            'patch': int(m.group('patch') or 0),
+            'image_id': metadata.get('image_id'),
+            'md5': metadata.get('md5'),
+            'size': metadata.get('size'),
+            'compatibility': metadata.get('compatibility', []),
+        }
+    tmp_file = '%%s.%%d.tmp' %% (catalog_file, os.getpid())
+    with open(tmp_file, 'w') as f:
+        json.dump({'images': images}, f, indent=1, sort_keys=True)
+    os.chmod(tmp_file, 0o644)
+    os.rename(tmp_file, catalog_file)
+
+finally:
+    os.unlink(sys.argv[0])
+''' % (remote_dir, catalog_basename)
+
+    script_filename = tempfile.mkstemp()
+    os.close(script_filename[0])
+
+    try:
+
+        with open(script_filename[1], 'w') as f:
+            f.write(script)
+
+        cmd = ['ssh', url, 'tempfile']
+        remote_script_filename = subprocess.check_output(cmd).strip().decode()
+
+        subprocess.check_call(['rsync',
+                               script_filename[1],
+                               '%s:%s' % (url, remote_script_filename)])
+
+        subprocess.check_call(['ssh', url, 'python', remote_script_filename])
+
+    finally:
+        os.unlink(script_filename[1])
+
+
 @command
 def publish_base_image(type=None,
                        image=osp.join(
@@ -576,6 +674,9 @@ def publish_base_image(type=None,
 
       {publish_url}
 
+    Block checksums of the image (``<image>.blocks.json``) are uploaded
+    with it, to allow delta updates with ``pull_image``.
+
     This directory location can be customized with
     the following environment variables::
 
@@ -629,6 +730,7 @@ def publish_base_image(type=None,
     metadata = json.load(open(metadata_file))
     metadata['size'] = os.stat(image).st_size
     metadata['md5'] = file_hash(image)
+    metadata['tree_hash'] = tree_hash(image)
 
     url, remote_path = publish_url.split(':', 1)
     remote_metadata_file = osp.join(remote_path, osp.basename(metadata_file))
@@ -649,11 +751,17 @@ def publish_base_image(type=None,
     image_path, image_base = osp.split(image)
     subprocess.check_call(['rsync', '-P', '--progress', '--chmod=a+r',
                            image, '%s:%s' % (url, final_imagefile)])
+    # block checksums used for delta updates
+    control_file = write_block_index(image)
+    subprocess.check_call(['rsync', '-P', '--progress', '--chmod=a+r',
+                           control_file,
+                           '%s:%s' % (url, final_imagefile + control_suffix)])
     # symlink numbered filename on local filesystem
     if osp.basename(final_imagefile) != image_base:
         os.symlink(image, osp.join(image_path, osp.basename(final_imagefile)))
         os.symlink(metadata_file,
                    osp.join(image_path, osp.basename(final_metafile)))
+    update_remote_catalog(url, remote_path)
 
 
 @command
@@ -674,6 +782,7 @@ def create_user_image(
         install_doc='yes',
         install_test='yes',
         install_thirdparty='none',
+        install_mode='clean',
         generate='yes',
         zip='no',
         verbose=True,
@@ -726,12 +835,25 @@ def create_user_image(
     force
         default={force_default}
         If "yes", "true" or 1, erase existing image without asking any
-        question.
+        question, and generate the image even if the installed files have
+        not changed.
     fakeroot (allowed only if container_type=singularity)
         default=yes
         If ``yes``, ``true`` or 1, use singularity --fakeroot for building the
         images (this is the recommended wby). Otherwise, "sudo singularity"
         must be used so singularity has root access on the host.
+    builder (allowed only if container_type=singularity)
+        default=recipe
+        If "recipe", the image is built from a recipe which copies the
+        installed files in a new image based on the run image. If "overlay",
+        the installed files, casa-distro and the third-party software are
+        stored in a squashfs overlay partition added to a copy of the run
+        image: the base system is not compressed again, and the copy shares
+        its data with the run image on filesystems supporting copy-on-write.
+        mksquashfs must be installed on the host. Both builders replace the
+        run script and environment (90-environment.sh) of the run image in
+        the same way. The build duration is recorded in the image metadata
+        in order to compare both builders.
     {base_directory}
     install
         default={install_default}
@@ -750,6 +872,16 @@ def create_user_image(
         If "true", "yes" or "1", run 'make install-test' as part of the install
         step.
         If "false", "no" or "0", skip this step
+    install_mode
+        default={install_mode_default}
+        If "clean", the installation directory is emptied before the
+        installation steps. If "incremental", files are installed over the
+        existing ones, then the files which are not listed in the
+        install_manifest*.txt files written by CMake in the build directory
+        during this installation, and have not been written during this
+        installation, are removed. Unchanged files thus keep
+        their timestamps and inodes. A clean installation is done if no
+        manifest is found.
     install_thirdparty
         default={install_thirdparty_default}
         If "none", no third-party software is installed in the image. If
@@ -770,7 +902,13 @@ def create_user_image(
     generate
         default={generate_default}
         If "true", "yes" or "1", perform the image creation step.
-        If "false", "no" or "0", skip this step
+        If "false", "no" or "0", skip this step.
+        A fingerprint of the installed files (paths, sizes, contents and
+        symlinks targets), of the base run image and of the third-party
+        software is recorded in the image metadata. The image creation is
+        skipped if the output image exists with the same fingerprint, unless
+        force is used. An existing image with another fingerprint is
+        replaced.
     cleanup
         default={cleanup_default}
         If "false", "no" or "0", do NOT clean up the temp image during the
@@ -789,6 +927,8 @@ def create_user_image(
     generate = check_boolean('generate', generate)
     cleanup = check_boolean('cleanup', cleanup)
     zip = check_boolean('zip', zip)
+    if install_mode not in ('clean', 'incremental'):
+        raise ValueError('install_mode must be "clean" or "incremental"')
 
     verbose = verbose_file(verbose)
     envtype = 'dev'
@@ -823,13 +963,14 @@ def create_user_image(
         raise ValueError('Unsupported container type: {0}'.format(
             container_type))
     name = name.format(version=version, **config)
-    kwargs = config.copy()
-    kwargs.pop('name', None)
+    # kwargs holds the builder options given on the command line
+    format_kwargs = config.copy()
+    format_kwargs.pop('name', None)
     output = osp.expandvars(osp.expanduser(output)).format(
         name=name,
         extension=extension,
         base_directory=base_directory,
-        **kwargs
+        **format_kwargs
     )
     force = boolean_value(force)
 
@@ -917,10 +1058,13 @@ def create_user_image(
 
     if install and container_type not in ('apptainer_pixi',
                                           'singularity_pixi'):
-        # Always empty the directory before installing to avoid files left over
-        # from a previous install.
-        shutil.rmtree(osp.join(config['directory'], 'install'))
-        os.mkdir(osp.join(config['directory'], 'install'))
+        install_dir = osp.join(config['directory'], 'install')
+        if install_mode == 'clean':
+            # Always empty the directory before installing to avoid files
+            # left over from a previous install.
+            shutil.rmtree(install_dir)
+            os.mkdir(install_dir)
+        install_start = time.time()
 
         install_targets = ['install-runtime']
         install_targets += ['install-doc'] if install_doc else []
@@ -934,25 +1078,45 @@ def create_user_image(
             'make',
             'BRAINVISA_INSTALL_PREFIX=/casa/host/install'] \
             + install_targets
-        retcode = run_container(
-            config=config,
-            command=[
-                'bash',
-                '-c',
-                ' '.join(sub_cmd)],
-            gui=False,
-            opengl="container",
-            root=False,
-            cwd='/casa/host/build',
-            env={},
-            image=None,
-            container_options=None,
-            base_directory=base_directory,
-            verbose=verbose
-        )
-        if retcode != 0:
-            sys.exit('make ' + ' '.join(install_targets)
-                     + ' failed, aborting.')
+
+        def make_install():
+            retcode = run_container(
+                config=config,
+                command=[
+                    'bash',
+                    '-c',
+                    ' '.join(sub_cmd)],
+                gui=False,
+                opengl="container",
+                root=False,
+                cwd='/casa/host/build',
+                env={},
+                image=None,
+                container_options=None,
+                base_directory=base_directory,
+                verbose=verbose
+            )
+            if retcode != 0:
+                sys.exit('make ' + ' '.join(install_targets)
+                         + ' failed, aborting.')
+
+        make_install()
+        if install_mode == 'incremental':
+            installed = installed_files(
+                osp.join(config['directory'], 'build'), install_start,
+                '/casa/host/install')
+            if installed is None:
+                print('No CMake install manifest has been written, '
+                      'files left over from previous installs cannot be '
+                      'found: doing a clean install.', file=sys.stderr)
+                shutil.rmtree(install_dir)
+                os.mkdir(install_dir)
+                make_install()
+            else:
+                removed = prune_install_tree(install_dir, installed,
+                                             install_start)
+                print(len(removed), 'files from previous installs removed '
+                      'from', install_dir)
         sub_cmd = ['bv_env_test',
                    'make',
                    'BRAINVISA_INSTALL_PREFIX=/casa/host/install',
@@ -1006,15 +1170,45 @@ def create_user_image(
 
     metadata_file = output + '.json'
 
+    if generate:
+        if container_type == 'singularity':
+            metadata['builder'] = kwargs.get('builder', 'recipe')
+        fingerprint = user_image_fingerprint(
+            osp.join(config['directory'], 'install'), metadata,
+            install_thirdparty)
+        metadata['install_fingerprint'] = fingerprint
+        if osp.exists(output):
+            try:
+                with open(metadata_file) as f:
+                    old_fingerprint = json.load(f).get('install_fingerprint')
+            except (IOError, OSError, ValueError):
+                # interrupted generation, or image copied without metadata
+                old_fingerprint = None
+            if force:
+                pass
+            elif old_fingerprint == fingerprint:
+                print('The installed files have not changed since', output,
+                      'was generated: the image is not generated again '
+                      '(use force=yes to generate it anyway).')
+                generate = False
+            else:
+                # the existing image is outdated, or cannot be identified
+                force = True
+
     if generate:
         output_dir = osp.dirname(output)
         if not osp.exists(output_dir) and output_dir != '':
             os.makedirs(output_dir)
         # filter kwargs to avoid passing unexpected or duplicate parameters
-        kwargs = {k: v for k, v in kwargs.items()
-                  if k in ('fakeroot', )}
-        if container_type in ('apptainer_pixi', 'singularity_pixi'):
-            kwargs['install'] = install
+        build_kwargs = {}
+        if container_type == 'singularity':
+            build_kwargs = {k: v for k, v in kwargs.items()
+                            if k in ('fakeroot', 'builder')}
+        elif container_type in ('apptainer_pixi', 'singularity_pixi'):
+            build_kwargs = {k: v for k, v in kwargs.items()
+                            if k == 'fakeroot'}
+            build_kwargs['install'] = install
+        build_start = time.time()
         image_id, msg = module.create_user_image(
             base_image=base_image,
             dev_config=config,
@@ -1025,18 +1219,134 @@ def create_user_image(
             verbose=verbose,
             install_thirdparty=install_thirdparty,
             cleanup=cleanup,
-            **kwargs)
+            **build_kwargs)
         if msg:
             print(msg)
 
+        metadata['build_duration'] = time.time() - build_start
+
         # Add image file md5 hash to JSON metadata file
         metadata['size'] = os.stat(output).st_size
         metadata['md5'] = file_hash(output)
+        metadata['tree_hash'] = tree_hash(output)
         metadata['image_id'] = image_id
         json.dump(metadata, open(metadata_file, 'w'),
                   indent=4, separators=(',', ': '))
 
 
+def installed_files(build_dir, since, install_prefix):
+    '''
+    Return the files installed since a given time, read in the
+    install_manifest*.txt files written by CMake install scripts in a build
+    tree. Paths are given relative to the install prefix (as seen in the
+    container). Return None if no manifest has been written.
+    '''
+    manifests = []
+    for dirpath, dirnames, filenames in os.walk(build_dir):
+        for name in filenames:
+            if name.startswith('install_manifest') and name.endswith('.txt'):
+                path = osp.join(dirpath, name)
+                # allow for a coarse timestamp resolution
+                if os.stat(path).st_mtime >= since - 2:
+                    manifests.append(path)
+    if not manifests:
+        return None
+    prefix = install_prefix.rstrip('/') + '/'
+    installed = set()
+    for manifest in manifests:
+        with open(manifest) as f:
+            for line in f:
+                line = line.rstrip('\n')
+                if line.startswith(prefix):
+                    installed.add(osp.normpath(line[len(prefix):]))
+    return installed
+
+
+def prune_install_tree(install_dir, installed, since):
+    '''
+    Remove the files of an installation directory which are not in the
+    given set of installed files (relative paths) and have not been
+    modified since the given time, then the directories left empty by these
+    removals. Files written during the installation but not listed in CMake
+    manifests (by ``install(CODE)`` or custom commands) are thus kept.
+    Compiled Python files are kept if their source is installed.
+
+    Returns
+    -------
+    removed: list
+        relative paths of removed files
+    '''
+    removed = []
+    pruned_dirs = set()
+    for dirpath, dirnames, filenames in os.walk(install_dir, topdown=False):
+        rel_dir = osp.relpath(dirpath, install_dir)
+        for name in filenames + [d for d in dirnames
+                                 if osp.islink(osp.join(dirpath, d))]:
+            rel = osp.normpath(osp.join(rel_dir, name))
+            if rel in installed:
+                continue
+            if name.endswith('.pyc') \
+                    and osp.basename(rel_dir) == '__pycache__':
+                source = osp.join(osp.dirname(rel_dir),
+                                  name.split('.', 1)[0] + '.py')
+                if osp.normpath(source) in installed:
+                    continue
+            path = osp.join(dirpath, name)
+            # allow for a coarse timestamp resolution
+            if os.lstat(path).st_mtime >= since - 2:
+                continue
+            os.unlink(path)
+            removed.append(rel)
+            pruned_dirs.add(dirpath)
+        if dirpath != install_dir and dirpath in pruned_dirs \
+                and not os.listdir(dirpath):
+            os.rmdir(dirpath)
+            pruned_dirs.add(osp.dirname(dirpath))
+    return removed
+
+
+def user_image_fingerprint(install_dir, metadata, install_thirdparty):
+    '''
+    Return a digest identifying the contents of a user image: the files of
+    the installation directory (see
+    :func:`casa_distro.hash.directory_manifest`), the base run image, the
+    third-party software and the casa-distro files copied in the image, and
+    the metadata of the image. Third-party software, which may be very
+    large, is identified by the sizes and modification times of its files.
+    '''
+    thirdparty = []
+    if install_thirdparty not in (None, 'none', 'None', 'NONE'):
+        from casa_distro.thirdparty import get_thirdparty_software
+
+        for path, name, scripts, env \
+                in get_thirdparty_software(install_thirdparty):
+            if osp.isdir(path):
+                files = manifest_fingerprint(
+                    directory_manifest(path, exclude=(), contents=False))
+            else:
+                # archive
+                stat = os.stat(path)
+                files = [stat.st_size, stat.st_mtime_ns]
+            thirdparty.append([name, path, files])
+        thirdparty.sort()
+    casa_distro_source = osp.dirname(osp.dirname(osp.dirname(__file__)))
+    casa_distro_files = {}
+    for i in ('bin', 'cbin', 'python', 'etc', 'share'):
+        if osp.isdir(osp.join(casa_distro_source, i)):
+            casa_distro_files[i] = manifest_fingerprint(
+                directory_manifest(osp.join(casa_distro_source, i)))
+    return manifest_fingerprint({
+        'install': manifest_fingerprint(directory_manifest(install_dir)),
+        'origin_run': metadata.get('origin_run'),
+        'thirdparty': thirdparty,
+        'casa_distro': casa_distro_files,
+        'image': dict((k, metadata.get(k))
+                      for k in ('name', 'distro', 'system', 'version',
+                                'image_version', 'container_type',
+                                'builder')),
+    })
+
+
 @command
 def publish_user_image(image):
     """Upload a "user" image to the BrainVISA web site.
@@ -1045,6 +1355,9 @@ def publish_user_image(image):
 
       {publish_url}
 
+    Block checksums of the image (``<image>.blocks.json``) are uploaded
+    with it, to allow delta updates with ``pull_image``.
+
     This directory location can be customized with
     the following environment variables::
 
@@ -1057,10 +1370,13 @@ def publish_user_image(image):
 
     {image}
     """
-    files = [image + '.json', image]
+    # block checksums used for delta updates
+    files = [image + '.json', image, write_block_index(image)]
     print('uploading files to server:')
     subprocess.check_call(['rsync', '-P', '--progress', '--chmod=a+r']
                           + files + [publish_url])
+    url, remote_path = publish_url.split(':', 1)
+    update_remote_catalog(url, remote_path)
 
 
 NONFATAL_BV_MAKER_STEPS = {'doc', 'test'}
@@ -1203,6 +1519,9 @@ def bbi_daily(distro=None, branch=None, system=None,
     # the correct base_directory.
     os.environ['CASA_BASE_DIRECTORY'] = base_directory
 
+    # also makes brainvisa_cmake importable
+    from casa_distro.bbi_daily import CasaDistroBBIDaily
+
     if jenkins_server:
         # Import jenkins only if necessary to avoid dependency
         # on requests module
@@ -1555,6 +1874,7 @@ def convert_image(source=None,
     elif osp.isfile(output):
         metadata['size'] = os.stat(output).st_size
         metadata['md5'] = file_hash(output)
+        metadata['tree_hash'] = tree_hash(output)
         metadata['image_id'] = image_id
         json.dump(metadata, open(metadata_output, 'w'),
                   indent=4, separators=(',', ': '))
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+'''
+Automated builds and tests (``casa_distro_admin bbi_daily``), based on the
+``bbi_daily`` module of brainvisa-cmake, which is looked for only when
+this module is imported.
+'''
+from __future__ import absolute_import, division, print_function
+
+import os
+import os.path as osp
+import subprocess
+import sys
+import time
+
+from casa_distro.environment import add_brainvisa_cmake_path
+
+
+add_brainvisa_cmake_path()
+try:
+    from brainvisa_cmake import bbi_daily
+except ImportError:
+    bbi_daily = None
+
+
+class CasaDistroBBIDaily(bbi_daily.BBIDaily if bbi_daily else object):
+    def __init__(self, base_directory, jenkins=None):
+        super().__init__(base_directory=base_directory, jenkins=jenkins)
+        self.casa_distro_src = osp.dirname(osp.dirname(
+            osp.dirname(__file__)))
+        casa_distro = osp.join(self.casa_distro_src, 'bin',
+                               'casa_distro')
+        casa_distro_admin = osp.join(self.casa_distro_src, 'bin',
+                                     'casa_distro_admin')
+        self.casa_distro_cmd = [sys.executable, casa_distro]
+        self.casa_distro_cmd_env = None
+        self.casa_distro_admin_cmd = [sys.executable, casa_distro_admin]
+
+    def update_casa_distro(self):
+        self.update_brainvisa_cmake()
+        start = time.time()
+        result, log = self.call_output(['git',
+                                        '-C', self.casa_distro_src,
+                                        'pull'])
+        duration = int(1000 * (time.time() - start))
+        self.log(self.bbe_name, 'update casa_distro',
+                 result, log,
+                 duration=duration)
+        return result == 0
+
+    def update_base_images(self, images):
+        start = time.time()
+        log = []
+        result = None
+        if images:
+            # a single pull_image downloads all images concurrently
+            result, output = self.call_output(self.casa_distro_cmd + [
+                'pull_image', 'image={0}'.format(','.join(images))])
+            log.append(output)
+        duration = int(1000 * (time.time() - start))
+        self.log(self.bbe_name,
+                 'update images',
+                 result, '\n'.join(log),
+                 duration=duration)
+        return result == 0
+
+    def recreate_user_env(self, user_config, dev_config):
+        environment = user_config['name']
+        if self.jenkins:
+            if not self.jenkins.job_exists(environment):
+                self.jenkins.create_job(environment,
+                                        **user_config)
+        start = time.time()
+        if not os.path.exists(user_config['directory']):
+            os.makedirs(user_config['directory'])
+        eimage = osp.normpath(osp.join(user_config.get('directory'),
+                                       user_config['image']))
+        result, log = self.call_output([
+            'singularity', 'run',
+            '--bind', user_config['directory'] + ':/casa/setup:rw', eimage,
+        ])
+        if result == 0:
+            # Make the reference test data available in the user environment
+            # through a symlink to the dev environment
+            user_test_ref_dir = os.path.join(user_config['directory'],
+                                             'tests', 'ref')
+            dev_test_ref_dir = os.path.join(dev_config['directory'],
+                                            'tests', 'ref')
+            if not os.path.exists(user_test_ref_dir):
+                if not os.path.exists(os.path.dirname(user_test_ref_dir)):
+                    os.makedirs(os.path.dirname(user_test_ref_dir))
+                os.symlink(os.path.join('/host', dev_test_ref_dir),
+                           user_test_ref_dir)
+
+            for command in (dev_config.get('bbi_user_config', {})
+                            .get('setup_commands', [])):
+                subprocess.check_call(command, shell=True,
+                                      cwd=user_config['directory'])
+        duration = int(1000 * (time.time() - start))
+        self.log(user_config['name'], 'recreate user env', result, log,
+                 duration=duration)
+        return result == 0
+
+    def update_user_image(self, user_config, dev_config,
+                          install_doc=True,
+                          install_test=True,
+                          install_thirdparty='default'):
+        environment = user_config['name']
+        if self.jenkins:
+            if not self.jenkins.job_exists(environment):
+                self.jenkins.create_job(environment,
+                                        **user_config)
+        start = time.time()
+        image = user_config['image']
+        image = osp.normpath(osp.join(user_config.get('directory'), image))
+        # the image is replaced only if the installed files have changed
+        result, log = self.call_output(self.casa_distro_admin_cmd + [
+            'create_user_image',
+            'version={0}'.format(user_config['version']),
+            'name={0}'.format(user_config['name']),
+            'environment_name={0}'.format(dev_config['name']),
+            'output=' + image,
+            'install_thirdparty=%s' % install_thirdparty,
+            'install_doc=' + str(install_doc),
+            'install_test=' + str(install_test),
+            'install_mode=clean',
+        ])
+        duration = int(1000 * (time.time() - start))
+        self.log(user_config['name'], 'update user image', result, log,
+                 duration=duration)
+        return result == 0
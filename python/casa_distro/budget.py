@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+'''
+CPU, memory and threads budget of containerized runs.
+
+A budget is given by the ``cpus``, ``memory`` and ``cpu_affinity`` items of
+the environment (or user) configuration, or by the parameters of the same
+names of the ``run`` and ``mrun`` commands, which have priority:
+
+cpus
+    number of CPUs (may be fractional), enforced with the ``--cpus``
+    cgroups option of Apptainer / Singularity.
+memory
+    maximum memory (``8G``, ``512M``...), enforced with the ``--memory``
+    cgroups option.
+cpu_affinity
+    list of CPUs (``0-3,8``) the container processes are bound to with
+    ``sched_setaffinity``.
+
+The number of threads of OpenMP and of the usual linear algebra libraries
+is set from the budget in the container (see :data:`thread_variables`),
+unless these variables are explicitly configured.
+'''
+from __future__ import absolute_import, division, print_function
+
+import math
+import os
+import re
+import sys
+
+from casa_distro import six
+
+
+# Environment variables setting the number of threads of computing
+# libraries
+thread_variables = (
+    'OMP_NUM_THREADS',
+    'MKL_NUM_THREADS',
+    'OPENBLAS_NUM_THREADS',
+    'BLIS_NUM_THREADS',
+    'VECLIB_MAXIMUM_THREADS',
+    'NUMEXPR_NUM_THREADS',
+    'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS',
+)
+
+
+def parse_cpu_list(cpu_list):
+    '''
+    Parse a list of CPUs, given as a string in the format of the ``taskset``
+    command (``0-3,8``), or as a list of integers.
+    '''
+    if isinstance(cpu_list, (list, tuple)):
+        return sorted(set(int(i) for i in cpu_list))
+    cpus = set()
+    for item in six.text_type(cpu_list).split(','):
+        item = item.strip()
+        m = re.match(r'^(\d+)(?:-(\d+))?$', item)
+        if not m:
+            raise ValueError('Invalid CPU list: {0}'.format(cpu_list))
+        first = int(m.group(1))
+        last = int(m.group(2) or first)
+        cpus.update(range(first, last + 1))
+    return sorted(cpus)
+
+
+def parse_memory(memory):
+    '''
+    Convert a memory size (``8G``, ``512M``, ``1024K`` or a number of bytes)
+    into a number of bytes.
+    '''
+    coefs = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3,
+             'T': 1024 ** 4}
+    match = re.match(r'^(\d+(?:\.\d+)?)\s*([KMGT]?)B?$',
+                     six.text_type(memory).strip().upper())
+    if not match:
+        raise ValueError('Invalid memory size: {0}'.format(memory))
+    return int(float(match.group(1)) * coefs[match.group(2)])
+
+
+def resource_budget(config, cpus=None, memory=None, cpu_affinity=None):
+    '''
+    Return the budget of a run as a dictionary with the "cpus" (float),
+    "memory" (bytes) and "cpu_affinity" (list of CPUs) items, which are None
+    if not limited. Parameters override the items of the environment
+    configuration.
+    '''
+    if cpus is None:
+        cpus = config.get('cpus')
+    if memory is None:
+        memory = config.get('memory')
+    if cpu_affinity is None:
+        cpu_affinity = config.get('cpu_affinity')
+    budget = {'cpus': None, 'memory': None, 'cpu_affinity': None}
+    if cpus not in (None, ''):
+        budget['cpus'] = float(cpus)
+        if budget['cpus'] <= 0:
+            raise ValueError('Invalid number of CPUs: {0}'.format(cpus))
+    if memory not in (None, ''):
+        budget['memory'] = parse_memory(memory)
+    if cpu_affinity not in (None, '', []):
+        budget['cpu_affinity'] = parse_cpu_list(cpu_affinity)
+    return budget
+
+
+def thread_count(budget):
+    '''
+    Return the number of threads computing libraries should use for a
+    budget, or None if the number of CPUs is not limited.
+    '''
+    counts = []
+    if budget.get('cpus'):
+        counts.append(max(1, int(math.floor(budget['cpus']))))
+    if budget.get('cpu_affinity'):
+        counts.append(len(budget['cpu_affinity']))
+    if not counts:
+        return None
+    return min(counts)
+
+
+def thread_environment(budget):
+    '''
+    Return the environment variables limiting the number of threads of
+    computing libraries for a budget.
+    '''
+    count = thread_count(budget)
+    if count is None:
+        return {}
+    return dict((name, str(count)) for name in thread_variables)
+
+
+def affinity_setter(cpu_affinity):
+    '''
+    Return a function binding the current process to the given CPUs, to be
+    used as ``preexec_fn`` of a subprocess, or None if there is no affinity
+    to set or if it is not supported on this system.
+    '''
+    if not cpu_affinity:
+        return None
+    if not hasattr(os, 'sched_setaffinity'):
+        print('WARNING: CPU affinity is not supported on this system, '
+              'cpu_affinity is ignored.', file=sys.stderr)
+        return None
+
+    def set_affinity():
+        os.sched_setaffinity(0, cpu_affinity)
+
+    return set_affinity
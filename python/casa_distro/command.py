@@ -14,6 +14,7 @@
 from casa_distro.info import __version__
 from casa_distro.log import boolean_value
 from casa_distro import six
+from casa_distro import trace
 from casa_distro.environment import casa_distro_directory
 
 
@@ -125,6 +126,20 @@ def command(f, name=None):
     'version': '''version
 {indent}If given, select environment by its version (only applicable to user
 {indent}environments, not dev)''',
+    'cpus': '''cpus
+{indent}Number of CPUs (may be fractional) the container may use. It is
+{indent}enforced with cgroups when available, and sets the number of threads
+{indent}of OpenMP, MKL, OpenBLAS and other computing libraries in the
+{indent}container. Overrides the ``cpus`` item of the environment
+{indent}configuration.''',
+    'memory': '''memory
+{indent}Maximum memory of the container (``8G``, ``512M``...), enforced with
+{indent}cgroups when available. Overrides the ``memory`` item of the
+{indent}environment configuration.''',
+    'cpu_affinity': '''cpu_affinity
+{indent}CPUs the container processes are bound to, as a list of CPUs and
+{indent}ranges (``0-3,8``). Overrides the ``cpu_affinity`` item of the
+{indent}environment configuration.''',
 }
 
 
@@ -357,7 +372,9 @@ def main(meant_for_container=False):
                       'be used: it must be called from the host system.'
                       % osp.basename(sys.argv[0]), file=sys.stderr)
                 sys.exit(1)
-            result = command(*args, **kwargs)
+            with trace.span('casa_distro ' + command_name) as span_args:
+                result = command(*args, **kwargs)
+                span_args['result'] = result
     except (ValueError, TypeError, RuntimeError, NotImplementedError) as e:
         print('ERROR: {0} raised the following error:'.format(command_name),
               file=sys.stderr)
@@ -181,7 +181,8 @@ def local_install_checked(self, checked):
             self.dl_grp.setEnabled(False)
 
     def update_distros(self):
-        from casa_distro.web import url_listdir, urlopen
+        from casa_distro.web import url_listdir
+        from casa_distro.http_session import default_session
 
         url = self.url_edit.text()
         if self.url == url:
@@ -194,6 +195,8 @@ def update_distros(self):
 
         try:
             items = url_listdir(osp.join(url, self.conf['version']))
+            distros = []
+            urls = []
             for distro in items:
                 if distro.endswith('/'):
                     distro = distro[:-1]
@@ -203,7 +206,14 @@ def update_distros(self):
                                 '%s-%s-%s' % (distro, self.conf['version'],
                                               self.conf['system']))
                 djson = '%s.json' % dzip
-                if urlopen(djson) and urlopen(dzip):
+                distros.append(distro)
+                urls += [djson, dzip]
+            # check all files at once
+            found = [not isinstance(r, Exception)
+                     for r in default_session().fetch_all(
+                         urls, method='HEAD', return_exceptions=True)]
+            for i, distro in enumerate(distros):
+                if found[i * 2] and found[i * 2 + 1]:
                     self.distros.addItem(distro)
                     if distro in sel_distros:
                         self.distros.item(
@@ -5,7 +5,8 @@
 # from casa_distro import six
 from casa_distro.command import command, check_boolean
 from casa_distro.container_environment import (setup_user as env_setup_user,
-                                               setup_dev as env_setup_dev)
+                                               setup_dev as env_setup_dev,
+                                               write_bv_env_snapshot)
 
 
 @command
@@ -96,6 +97,33 @@ def setup_dev(distro, branch='master', system=None, image_version=None,
                   image_version=image_version, name=name)
 
 
+@command
+def bv_env_snapshot(install='/casa/install', output='/casa/bv_env_snapshot'):
+    """
+    Write a script running a command in the environment defined by the
+    bv_env command of an install directory. It is used in user images to
+    avoid computing this environment at each container start.
+
+    The snapshot is not used when the ``CASA_DYNAMIC_BV_ENV`` variable is
+    set in the container, which allows to compare start times, for
+    instance::
+
+        time bv true
+        time bv env=CASA_DYNAMIC_BV_ENV=1 true
+
+    Parameters
+    ----------
+
+    install
+        {install_default}
+        BrainVISA install directory
+    output
+        {output_default}
+        snapshot script to write
+    """
+    write_bv_env_snapshot(install, output)
+
+
 @command
 def config_gui():
     """
@@ -6,6 +6,7 @@
 import os
 import os.path as osp
 import platform
+import shlex
 import shutil
 import stat
 import sys
@@ -17,6 +18,7 @@
 from casa_distro.environment import (prepare_environment_homedir, copytree, cp,
                                      get_env_host_dir)
 from casa_distro import downloader
+from casa_distro.http_session import default_session
 
 
 def user_config_filename():
@@ -99,9 +101,7 @@ def download_install(install_dir, distro, version, url):
     try:
         f = None
         try:
-            f = downloader.urlopen(json_url)
-            if f.getcode() == 404:
-                return
+            f = default_session().get(json_url)
             metadata = json.loads(f.read().decode('utf-8'))
         except Exception as e:
             print('%s could not be read:' % json_url, e)
@@ -155,6 +155,100 @@ def is_writable(dir):
     return True
 
 
+# Variables which change from a process (or terminal) to another, thus are not
+# part of an environment snapshot
+_snapshot_ignored_variables = ('_', 'PWD', 'OLDPWD', 'SHLVL', 'COLUMNS',
+                               'LINES')
+
+
+def environment_snapshot(before, after):
+    """
+    Return the shell commands turning the environment ``before`` into the
+    environment ``after``.
+
+    Variables whose value in ``after`` extends their value in ``before``
+    with path elements (such as PATH or LD_LIBRARY_PATH) are written as
+    additions to their current value, so that elements added when the
+    container starts (OpenGL libraries...) are kept.
+    """
+    lines = []
+    for name in sorted(set(before) - set(after)):
+        if name not in _snapshot_ignored_variables:
+            lines.append('unset %s' % name)
+    for name, value in sorted(after.items()):
+        if name in _snapshot_ignored_variables or before.get(name) == value:
+            continue
+        old = before.get(name)
+        new_items = value.split(':')
+        old_items = old.split(':') if old else []
+        for i in range(len(new_items) - len(old_items) + 1):
+            if old_items and new_items[i:i + len(old_items)] == old_items:
+                prefix = ':'.join(new_items[:i])
+                suffix = ':'.join(new_items[i + len(old_items):])
+                if prefix and suffix:
+                    value = '%s"${%s:+:$%s}":%s' % (
+                        shlex.quote(prefix), name, name, shlex.quote(suffix))
+                elif prefix:
+                    value = '%s"${%s:+:$%s}"' % (shlex.quote(prefix), name,
+                                                 name)
+                else:
+                    value = '"${%s:+$%s:}"%s' % (name, name,
+                                                 shlex.quote(suffix))
+                break
+        else:
+            value = shlex.quote(value)
+        lines.append('export %s=%s' % (name, value))
+    return lines
+
+
+_snapshot_probe = '/casa-distro-snapshot-probe'
+
+
+def _command_environment(command, env):
+    output = subprocess.check_output(command + ['env', '-0'], env=env)
+    return dict(item.split('=', 1)
+                for item in output.decode('utf-8').split('\0')
+                if '=' in item)
+
+
+def write_bv_env_snapshot(install_dir='/casa/install',
+                          output='/casa/bv_env_snapshot'):
+    """
+    Write an executable script which sets the environment defined by the
+    bv_env command of an install directory, then runs its arguments, as
+    ``bv_env`` does, without having to compute the environment each time.
+
+    The snapshot is computed relatively to the environment of the current
+    process: path variables extended by bv_env are extended in the same way
+    when the script runs.
+    """
+    bv_env = osp.join(install_dir, 'bin', 'bv_env')
+    before = dict(os.environ)
+    after = _command_environment([bv_env], before)
+    # Variables created by bv_env may extend a value set at run time: find
+    # it out by running bv_env again with these variables defined.
+    created = [name for name in after
+               if name not in before
+               and name not in _snapshot_ignored_variables]
+    if created:
+        probe_env = dict(before)
+        probe_env.update((name, _snapshot_probe) for name in created)
+        probed = _command_environment([bv_env], probe_env)
+        for name in created:
+            if _snapshot_probe in probed.get(name, '').split(':'):
+                before[name] = _snapshot_probe
+                after[name] = probed[name]
+    lines = ['#!/bin/sh',
+             '# Environment defined by %s, generated by casa_distro on %s.'
+             % (bv_env, time.strftime('%Y-%m-%d %H:%M')),
+             '# The command given as arguments is run in this environment.']
+    lines += environment_snapshot(before, after)
+    lines.append('exec "$@"')
+    with open(output, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.chmod(output, 0o755)
+
+
 def setup_user(setup_dir='/casa/setup', rw_install=False, distro=None,
                version=None, url='https://brainvisa.info/download',
                create_homedir=True):
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+'''
+Block-level delta updates of image files.
+
+A new patch of an image mostly contains the same data as the previous one,
+but not at the same offsets: squashfs packs files contiguously, so a
+change shifts all the data that follows. Images are thus split into
+content-defined blocks. A block ends after an occurrence of a fixed byte
+sequence (the anchor), within size bounds, so that block boundaries follow
+the data when it moves. Finding the anchor is done by ``bytes.find``,
+which is much faster than a rolling checksum computed in Python.
+
+At publication, a control file (:func:`block_index`) listing the blocks of
+the image and their md5 is stored next to it, as ``<image>.blocks.json``.
+:func:`delta_download` splits the installed image in the same way, copies
+the blocks it already has, and downloads only the missing byte ranges.
+'''
+from __future__ import absolute_import, division, print_function
+
+import binascii
+import hashlib
+import json
+import os
+import os.path as osp
+import threading
+
+
+control_suffix = '.blocks.json'
+
+# Sequence marking the end of a block. Two bytes give blocks of 64KiB on
+# average in compressed data.
+default_anchor = b'\xc3\x5a'
+default_min_size = 16 * 1024
+default_max_size = 256 * 1024
+
+
+def iter_blocks(path, anchor=default_anchor, min_size=default_min_size,
+                max_size=default_max_size, read_size=8 * 1024 * 1024):
+    '''
+    Split a file into content-defined blocks.
+
+    Yields
+    ------
+    ``(offset, length, md5)`` for each block of the file.
+    '''
+    buf = bytearray()
+    offset = 0
+    eof = False
+    with open(path, 'rb') as f:
+        while True:
+            while not eof and len(buf) < max_size:
+                data = f.read(read_size)
+                if not data:
+                    eof = True
+                buf += data
+            if not buf:
+                break
+            i = buf.find(anchor, min_size, max_size)
+            if i >= 0:
+                cut = i + len(anchor)
+            else:
+                cut = min(max_size, len(buf))
+            block = memoryview(buf)[:cut]
+            yield offset, cut, hashlib.md5(block).hexdigest()
+            block.release()
+            del buf[:cut]
+            offset += cut
+
+
+def block_index(path, anchor=default_anchor, min_size=default_min_size,
+                max_size=default_max_size):
+    '''
+    Compute the control data of a file for delta updates.
+
+    Returns
+    -------
+    control: dict
+        JSON-compatible dictionary with the chunking parameters ("anchor"
+        as an hexadecimal string, "min_size", "max_size"), the file "size",
+        and the "lengths" and "md5" lists of the blocks.
+    '''
+    lengths = []
+    digests = []
+    size = 0
+    for offset, length, digest in iter_blocks(path, anchor, min_size,
+                                              max_size):
+        lengths.append(length)
+        digests.append(digest)
+        size += length
+    return {'anchor': binascii.hexlify(anchor).decode(),
+            'min_size': min_size,
+            'max_size': max_size,
+            'size': size,
+            'lengths': lengths,
+            'md5': digests}
+
+
+def write_block_index(path, output=None):
+    '''
+    Write the control file of an image (``<path>.blocks.json`` by default)
+    and return its name.
+    '''
+    if output is None:
+        output = path + control_suffix
+    with open(output, 'w') as f:
+        json.dump(block_index(path), f, separators=(',', ':'))
+    return output
+
+
+def _missing_ranges(control, old_image):
+    '''
+    Match the blocks described by ``control`` with blocks of ``old_image``.
+
+    Returns
+    -------
+    copies: list
+        ``(offset, old_offset, length)`` of blocks available locally
+    ranges: list
+        ``[start, end[`` byte ranges to download, adjacent blocks being
+        merged
+    '''
+    local = {}
+    if old_image is not None and osp.exists(old_image):
+        anchor = binascii.unhexlify(control['anchor'])
+        for offset, length, digest in iter_blocks(
+                old_image, anchor, control['min_size'],
+                control['max_size']):
+            local.setdefault(digest, (offset, length))
+    copies = []
+    ranges = []
+    offset = 0
+    for length, digest in zip(control['lengths'], control['md5']):
+        match = local.get(digest)
+        if match is not None and match[1] == length:
+            copies.append((offset, match[0], length))
+        elif ranges and ranges[-1][1] == offset:
+            ranges[-1][1] = offset + length
+        else:
+            ranges.append([offset, offset + length])
+        offset += length
+    return copies, ranges
+
+
+def delta_download(url, dest, old_image, control, md5_check=None,
+                   segments=4, timeout=10., session=None, throttle=None,
+                   callback=None, max_range_size=16 * 1024 * 1024):
+    '''
+    Build the file at ``url`` into ``dest`` from the blocks of
+    ``old_image`` which are unchanged, and download the others with HTTP
+    range requests.
+
+    The file is assembled in ``<dest>.delta.part``, distinct from the
+    ``<dest>.part`` file of a (possibly interrupted) full download, which is
+    thus kept for a later resume. The md5 of each downloaded
+    block is checked, as well as the md5 of the whole file if
+    ``md5_check`` is given, before it is renamed to ``dest``.
+
+    Parameters
+    ----------
+    url: str
+        URL of the new file
+    dest: str
+        output filename
+    old_image: str
+        installed file to take unchanged blocks from
+    control: dict
+        control data of the new file (see :func:`block_index`)
+    md5_check: str
+        expected md5 of the new file
+    segments: int
+        number of ranges downloaded concurrently
+    timeout: float
+        connection / stall timeout
+    session: :class:`casa_distro.http_session.HTTPSession`
+        HTTP session used for requests
+    throttle: :class:`casa_distro.downloader.TokenBucket`
+        bandwidth limit
+    callback: function
+        progress callback (see
+        :func:`casa_distro.downloader.download_file_internal`), reporting
+        the downloaded part of the missing ranges.
+    max_range_size: int
+        maximum size of a single range request
+
+    Returns
+    -------
+    downloaded: int
+        number of bytes downloaded
+    '''
+    from concurrent.futures import ThreadPoolExecutor, wait
+
+    from casa_distro.downloader import _download_segment
+    from casa_distro.hash import store_file_hash
+    from casa_distro.http_session import default_session
+
+    if session is None:
+        session = default_session()
+    size = control['size']
+    copies, ranges = _missing_ranges(control, old_image)
+    # split large ranges to spread them over connections
+    segments_todo = []
+    for start, end in ranges:
+        for pos in range(start, end, max_range_size):
+            segments_todo.append([pos, min(pos + max_range_size, end)])
+    to_download = sum(r[1] - r[0] for r in ranges)
+    base_url = osp.basename(url)
+
+    tmp_dest = dest + '.delta.part'
+    fd = os.open(tmp_dest, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        os.ftruncate(fd, size)
+        if copies:
+            old_fd = os.open(old_image, os.O_RDONLY)
+            try:
+                for offset, old_offset, length in copies:
+                    os.pwrite(fd, os.pread(old_fd, length, old_offset),
+                              offset)
+            finally:
+                os.close(old_fd)
+
+        abort = threading.Event()
+        with ThreadPoolExecutor(max_workers=max(segments, 1)) as executor:
+            futures = [executor.submit(_download_segment, url, fd, segment,
+                                       timeout, abort, session=session,
+                                       throttle=throttle)
+                       for segment in segments_todo]
+            try:
+                count = 0
+                pending = futures
+                while pending:
+                    done, pending = wait(pending, timeout=0.3)
+                    for future in done:
+                        future.result()
+                    if callback:
+                        remaining = sum(r[1] - r[0] for r in segments_todo)
+                        callback(base_url, to_download - remaining,
+                                 to_download, 0, count, count)
+                        count += 1
+            except BaseException:
+                abort.set()
+                raise
+
+        # verify downloaded blocks, then the whole file
+        whole = hashlib.md5()
+        offset = 0
+        ranges = iter(ranges)
+        current = next(ranges, None)
+        for length, digest in zip(control['lengths'], control['md5']):
+            data = os.pread(fd, length, offset)
+            whole.update(data)
+            while current is not None and current[1] <= offset:
+                current = next(ranges, None)
+            if (current is not None and current[0] <= offset
+                    and hashlib.md5(data).hexdigest() != digest):
+                raise RuntimeError('mismatching block md5 at offset %d of %s'
+                                   % (offset, url))
+            offset += length
+        md5 = whole.hexdigest()
+        if md5_check and md5 != md5_check:
+            raise RuntimeError('mismatching md5 sum')
+    except BaseException:
+        os.close(fd)
+        os.unlink(tmp_dest)
+        raise
+    os.close(fd)
+    os.rename(tmp_dest, dest)
+    # later hashes of the image will not need to read it
+    store_file_hash(dest, md5)
+    if callback:
+        callback(base_url, to_download, to_download, 0, 0, 0)
+        print()
+    return to_download
@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*-
 
+import errno
+import hashlib
+import json
 import socket
+import threading
 import time
 import os
 import sys
@@ -10,16 +14,18 @@
 from casa_distro import six
 
 try:
-    # Try Python 3 only import
-    from urllib.request import urlopen, Request
+    import fcntl
 except ImportError:
-    from urllib2 import urlopen, Request
+    # no file locking on this platform
+    fcntl = None
 
 osp = os.path
 
 
 def download_file_internal(url, dest, timeout=10., callback=None,
-                           cbk_interval=0.3, allow_continue=False):
+                           cbk_interval=0.3, allow_continue=False,
+                           segments=1, hasher=None, session=None,
+                           throttle=None):
     '''
     Download a file from the given URL to the local path ``dest``.
 
@@ -64,11 +70,38 @@ def download_file_internal(url, dest, timeout=10., callback=None,
         than the file to be downloaded, then assume the local file is an
         incomplete download of the same file, and append the remaining of the
         remote file.
+    segments: int
+        number of byte ranges downloaded concurrently. If greater than 1 and
+        if the server supports range requests, the download is performed by
+        :func:`download_file_segmented`. Otherwise a single connection is
+        used.
+    hasher: hashlib hash object
+        if given, it is updated with the contents of the file while it is
+        downloaded. When a previous incomplete download is continued, the
+        existing part of the file is hashed first.
+    session: :class:`casa_distro.http_session.HTTPSession`
+        HTTP session used for requests. Default: the shared session (see
+        :func:`casa_distro.http_session.default_session`).
+    throttle: :class:`TokenBucket`
+        if given, limits the download bandwidth. A bucket may be shared by
+        several downloads.
     '''
+    from casa_distro.http_session import default_session
+
     buffer_size = 1024 * 4
-    input = urlopen(url, timeout=timeout)
+    if session is None:
+        session = default_session()
+    input = session.get(url, timeout=timeout)
     info = input.info()
     size = int(info.get('Content-Length', 0))
+    if segments > 1 and size > 0 and info.get('Accept-Ranges') == 'bytes':
+        input.close()
+        return download_file_segmented(url, dest, segments=segments,
+                                       timeout=timeout, callback=callback,
+                                       cbk_interval=cbk_interval,
+                                       allow_continue=allow_continue,
+                                       size=size, hasher=hasher,
+                                       session=session, throttle=throttle)
     dl_len = 0
     last_time = time.time()
     block = 0
@@ -81,22 +114,31 @@ def download_file_internal(url, dest, timeout=10., callback=None,
         dsize = os.stat(dest).st_size
         if dsize == size:
             print('already downloaded.')
+            if hasher is not None:
+                _hash_file(hasher, dest, 0, dsize)
             return
         elif dsize > size:
             print('size inconsistency - downloading the whole file again')
         else:
             open_mode = 'ab'
+            input.close()
             headers = {'Range': 'bytes=%d-%d' % (dsize, size)}
-            new_url = Request(url, headers=headers)
-            input = urlopen(new_url, timeout=timeout)
+            input = session.get(url, headers=headers, timeout=timeout)
             dl_len = dsize
+            if hasher is not None:
+                # recover the hash state of the existing part
+                _hash_file(hasher, dest, 0, dsize)
 
     with open(dest, open_mode) as output:
         while True:
             try:
                 buffer = input.read(buffer_size)
                 if buffer:
+                    if throttle is not None:
+                        throttle.consume(len(buffer))
                     output.write(buffer)
+                    if hasher is not None:
+                        hasher.update(buffer)
                     dl_len += len(buffer)
                     if callback and time.time() - last_time >= cbk_interval:
                         speed = (dl_len - last_pos) / (time.time() - last_time)
@@ -111,14 +153,360 @@ def download_file_internal(url, dest, timeout=10., callback=None,
             except socket.timeout:
                 # print('*** timeout ***')
                 # print('resume at:', dl_len)
+                input.close()
                 headers = {'Range': 'bytes=%d-%d' % (dl_len, size)}
-                new_url = Request(url, headers=headers)
-                input = urlopen(new_url, timeout=timeout)
+                input = session.get(url, headers=headers, timeout=timeout)
+        input.close()
         if callback:
             callback(base_url, dl_len, size, speed, block, cbk_count)
             print()
 
 
+def _hash_file(hasher, path_or_fd, start, end, blocksize=2**20):
+    '''
+    Update ``hasher`` with the bytes ``[start, end[`` of a file, given as a
+    path or as an open file descriptor.
+    '''
+    if not isinstance(path_or_fd, int):
+        fd = os.open(path_or_fd, os.O_RDONLY)
+        try:
+            return _hash_file(hasher, fd, start, end, blocksize)
+        finally:
+            os.close(fd)
+    pos = start
+    while pos < end:
+        buffer = os.pread(path_or_fd, min(blocksize, end - pos), pos)
+        if not buffer:
+            break
+        hasher.update(buffer)
+        pos += len(buffer)
+    return pos
+
+
+def _segments_state_file(dest):
+    return dest + '.segments'
+
+
+def _read_segments_state(dest, url, size):
+    ''' Read the segments remaining to download in an interrupted segmented
+    download. Return None if no valid state can be found for this URL and
+    size.
+    '''
+    state_file = _segments_state_file(dest)
+    if not osp.exists(state_file) or not osp.exists(dest):
+        return None
+    try:
+        with open(state_file) as f:
+            state = json.load(f)
+    except ValueError:
+        return None
+    if (state.get('url') != url or state.get('size') != size
+            or os.stat(dest).st_size != size):
+        return None
+    return [list(s) for s in state['segments']]
+
+
+def _write_segments_state(dest, url, size, segments):
+    state_file = _segments_state_file(dest)
+    with open(state_file + '.tmp', 'w') as f:
+        json.dump({'url': url, 'size': size,
+                   'segments': [list(s) for s in segments]}, f)
+    os.rename(state_file + '.tmp', state_file)
+
+
+def _discard_invalid_chunks(url, dest, tree):
+    '''
+    Verify the already downloaded parts of an incomplete download using the
+    chunks digests of a tree hash (see :func:`casa_distro.hash.tree_hash`).
+    Invalid parts are scheduled to be downloaded again: they are added to the
+    remaining segments of a segmented download, or the file is truncated
+    before the first invalid chunk.
+    '''
+    from .hash import invalid_chunks
+
+    chunk_size = tree['chunk_size']
+    size = tree['size']
+    todo = _read_segments_state(dest, url, size)
+    if todo is not None:
+        # only check chunks which do not overlap a remaining segment
+        done = [i for i in range(len(tree['chunks']))
+                if not any(s[0] < min((i + 1) * chunk_size, size)
+                           and i * chunk_size < s[1]
+                           for s in todo if s[0] < s[1])]
+        bad = invalid_chunks(dest, tree, chunks=done)
+        if bad:
+            todo += [[i * chunk_size, min((i + 1) * chunk_size, size)]
+                     for i in bad]
+            todo.sort()
+            _write_segments_state(dest, url, size, todo)
+    else:
+        bad = invalid_chunks(dest, tree)
+        if bad:
+            with open(dest, 'r+b') as f:
+                f.truncate(bad[0] * chunk_size)
+    return bad
+
+
+def _download_segment(url, fd, segment, timeout, abort, max_retries=5,
+                      buffer_size=1024 * 64, session=None, throttle=None):
+    '''
+    Download the byte range ``[segment[0], segment[1][`` of ``url`` into the
+    file descriptor ``fd``, using positional writes.
+
+    ``segment[0]`` is advanced as data is written, thus the segment list
+    always holds the part which remains to be downloaded. A stalled
+    connection is closed and reopened where it stopped. Stalls and other
+    connection errors are retried up to ``max_retries`` times in a row
+    (i.e. without receiving any data), with an increasing delay; the last
+    error is raised.
+    '''
+    from casa_distro.http_session import default_session
+
+    if session is None:
+        session = default_session()
+    retries = 0
+    while segment[0] < segment[1] and not abort.is_set():
+        headers = {'Range': 'bytes=%d-%d' % (segment[0], segment[1] - 1)}
+        try:
+            input = session.get(url, headers=headers, timeout=timeout)
+            try:
+                if input.getcode() != 206:
+                    raise RuntimeError('server does not support range '
+                                       'requests for %s' % url)
+                while segment[0] < segment[1] and not abort.is_set():
+                    buffer = input.read(min(buffer_size,
+                                            segment[1] - segment[0]))
+                    if not buffer:
+                        raise IOError('connection closed before the end '
+                                      'of the segment')
+                    if throttle is not None:
+                        throttle.consume(len(buffer))
+                    os.pwrite(fd, buffer, segment[0])
+                    segment[0] += len(buffer)
+                    retries = 0
+            finally:
+                input.close()
+        except (socket.timeout, IOError, OSError):
+            # stalled connection or connection error: reconnect and resume
+            retries += 1
+            if retries > max_retries:
+                raise
+            abort.wait(min(0.2 * 2 ** (retries - 1), 10.))
+
+
+def download_file_segmented(url, dest, segments=4, timeout=10.,
+                            callback=None, cbk_interval=0.3,
+                            allow_continue=False, size=None, hasher=None,
+                            session=None, throttle=None):
+    '''
+    Download a file from the given URL to the local path ``dest``, splitting
+    it into several byte ranges which are fetched concurrently.
+
+    The server must support HTTP range requests. The output file is
+    preallocated to its final size, and each segment is written at its
+    position in the file. Stalled segments are retried independently.
+
+    The remaining byte ranges are recorded in a ``<dest>.segments`` file
+    during the download, so that an interrupted download can be continued
+    using ``allow_continue``. This file is removed once the download is
+    complete.
+
+    Parameters
+    ----------
+    url: str
+        URL of the file to be downloaded
+    dest: str
+        output filename for the downloaded file
+    segments: int
+        number of segments (and concurrent connections)
+    timeout: float
+        connection / stall timeout for each segment.
+    callback: function
+        callback function to display the progress of the download, see
+        :func:`download_file_internal`.
+    cbk_interval: float
+        minimum interval (in seconds) between two calls to the progress
+        callback.
+    allow_continue: bool
+        if True, continue an interrupted segmented download of the same file.
+        If a local file smaller than the remote one exists without segments
+        information (a regular interrupted download), only the remaining of
+        the remote file is downloaded.
+    size: int
+        size of the file, if already known. Otherwise it is read from the
+        server response headers.
+    hasher: hashlib hash object
+        if given, it is updated with the contents of the file. As segments are
+        not received in order, the hash follows the end of the contiguous
+        downloaded part of the file, which is read back while it is still in
+        the system cache.
+    session: :class:`casa_distro.http_session.HTTPSession`
+        HTTP session used for requests, see :func:`download_file_internal`.
+        The number of concurrent connections is also limited by the
+        session.
+    throttle: :class:`TokenBucket`
+        if given, limits the download bandwidth.
+    '''
+    from concurrent.futures import ThreadPoolExecutor, wait
+
+    from casa_distro.http_session import default_session
+
+    if session is None:
+        session = default_session()
+    if size is None:
+        input = session.get(url, timeout=timeout)
+        size = int(input.info().get('Content-Length', 0))
+        input.close()
+    base_url = os.path.basename(url)
+
+    todo = None
+    start = 0
+    if allow_continue and osp.exists(dest):
+        todo = _read_segments_state(dest, url, size)
+        if todo is None:
+            dsize = os.stat(dest).st_size
+            if dsize == size:
+                print('already downloaded.')
+                if hasher is not None:
+                    _hash_file(hasher, dest, 0, dsize)
+                return
+            elif dsize > size:
+                print('size inconsistency - downloading the whole file again')
+            else:
+                start = dsize
+    if todo is None:
+        step = max(-(-(size - start) // segments), 1)
+        todo = [[pos, min(pos + step, size)]
+                for pos in range(start, size, step)]
+        if osp.exists(dest) and start == 0:
+            os.unlink(dest)
+
+    def remaining():
+        return sum(s[1] - s[0] for s in todo)
+
+    hashed = [0]
+
+    def update_hash():
+        # hash up to the first incomplete segment: everything before is
+        # already written
+        if hasher is not None:
+            frontier = next((s[0] for s in todo if s[0] < s[1]), size)
+            hashed[0] = _hash_file(hasher, fd, hashed[0], frontier)
+
+    fd = os.open(dest, os.O_RDWR | os.O_CREAT, 0o666)
+    abort = threading.Event()
+    try:
+        if os.fstat(fd).st_size != size:
+            os.ftruncate(fd, size)
+        _write_segments_state(dest, url, size, todo)
+        last_time = time.time()
+        last_pos = size - remaining()
+        speed = 0
+        cbk_count = 0
+        with ThreadPoolExecutor(max_workers=len(todo) or 1) as executor:
+            futures = [executor.submit(_download_segment, url, fd, segment,
+                                       timeout, abort, session=session,
+                                       throttle=throttle)
+                       for segment in todo]
+            try:
+                pending = futures
+                while pending:
+                    done, pending = wait(pending, timeout=cbk_interval)
+                    for future in done:
+                        # raise errors as soon as a segment fails
+                        future.result()
+                    _write_segments_state(dest, url, size, todo)
+                    update_hash()
+                    if callback:
+                        dl_len = size - remaining()
+                        now = time.time()
+                        speed = (dl_len - last_pos) / max(now - last_time,
+                                                          1e-6)
+                        last_pos = dl_len
+                        last_time = now
+                        callback(base_url, dl_len, size, speed,
+                                 dl_len // (1024 * 64), cbk_count)
+                        cbk_count += 1
+            except BaseException:
+                abort.set()
+                raise
+        update_hash()
+    finally:
+        os.close(fd)
+        if remaining():
+            _write_segments_state(dest, url, size, todo)
+    if callback:
+        print()
+    os.unlink(_segments_state_file(dest))
+
+
+class TokenBucket(object):
+    '''
+    Bandwidth limiter shared between threads.
+
+    Tokens (bytes) accumulate at ``rate`` bytes per second, up to ``burst``
+    bytes. :meth:`consume` takes tokens from the bucket, and waits when the
+    bucket is exhausted, so that the average throughput of all consumers
+    does not exceed ``rate``.
+    '''
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        if burst is None:
+            burst = max(self.rate, 1024 * 64)
+        self.burst = burst
+        self._tokens = burst
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, amount):
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst,
+                               self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            # tokens may become negative: the debt is paid by waiting
+            self._tokens -= amount
+            delay = -self._tokens / self.rate
+        if delay > 0:
+            time.sleep(delay)
+
+
+class MultiProgress(object):
+    '''
+    Aggregate the progress of several concurrent downloads. Use
+    :meth:`callback` as the progress callback of each download: the total
+    progress is displayed by ``display`` (:func:`stdout_progress` by
+    default) at most every ``interval`` seconds.
+    '''
+
+    def __init__(self, display=None, interval=0.3):
+        self.display = display or stdout_progress
+        self.interval = interval
+        self.downloads = {}
+        self._count = 0
+        self._last_time = 0
+        self._lock = threading.Lock()
+
+    def callback(self, url, pos, size, speed, block, count):
+        with self._lock:
+            if pos >= size:
+                speed = 0
+            self.downloads[url] = (pos, size, speed, block)
+            now = time.time()
+            if now - self._last_time < self.interval:
+                return
+            self._last_time = now
+            pos, size, speed, block = [sum(x) for x in
+                                       zip(*self.downloads.values())]
+            active = len([d for d in self.downloads.values()
+                          if d[0] < d[1]])
+            self.display('%d files (%d active)' % (len(self.downloads),
+                                                   active),
+                         pos, size, speed, block, self._count)
+            self._count += 1
+
+
 _term_width = 79
 _term_width_timestamp = 0
 
@@ -166,7 +554,10 @@ def stdout_progress(url, pos, size, speed, block, count):
         spstr = '%.2fB/s' % speed
     perstr = '%d' % int((float(pos) / size) * 100) + '%'
 
-    time_left = float(size - pos) / speed
+    if speed > 0:
+        time_left = float(size - pos) / speed
+    else:
+        time_left = 0
     if time_left > 3600:
         timestr = '%dh%2dm' \
             % (int(math.floor(time_left / 3600)),
@@ -282,9 +673,192 @@ def wget_command(download_container=True):
     raise RuntimeError('neither wget, singularity, or docker are installed.')
 
 
+def _wget_download_hashed(wget, url, dest, hasher, buffer_size=2**20):
+    '''
+    Download a file using wget, writing the data through a pipe so that it is
+    hashed while being written to ``dest``.
+    '''
+    cmd = list(wget) + [url, '-O', '-']
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=-1)
+    try:
+        with open(dest, 'wb') as output:
+            while True:
+                buffer = proc.stdout.read(buffer_size)
+                if not buffer:
+                    break
+                output.write(buffer)
+                hasher.update(buffer)
+    finally:
+        proc.stdout.close()
+        retcode = proc.wait()
+    if retcode != 0:
+        raise subprocess.CalledProcessError(retcode, cmd)
+
+
+class DownloadLock(object):
+    '''
+    Advisory inter-process lock on a download destination file, so that
+    several processes (possibly on several hosts sharing a base directory)
+    do not download the same file at the same time.
+
+    The lock is a POSIX lock on the ``<dest>.lock`` file, which also
+    records the host and PID of its owner. The system releases it when its
+    owner dies, thus locks left by killed processes are not an issue. Where
+    locks are not supported (no fcntl module, file system without lock
+    support, or read-only directory), the lock is always granted.
+    '''
+
+    def __init__(self, dest):
+        self.dest = dest
+        self.path = dest + '.lock'
+        self._fd = None
+
+    def acquire(self, blocking=True):
+        '''
+        Take the lock. If ``blocking`` is False, return False instead of
+        waiting when it is held by another process.
+        '''
+        if fcntl is None:
+            return True
+        flags = fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        while True:
+            try:
+                fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+            except (IOError, OSError):
+                return True
+            try:
+                fcntl.lockf(fd, flags)
+            except (IOError, OSError) as e:
+                os.close(fd)
+                if e.errno in (errno.EACCES, errno.EAGAIN):
+                    return False
+                return True
+            # The previous owner removes the lock file when it releases
+            # it: make sure the locked file is still the current one.
+            try:
+                stat = os.stat(self.path)
+            except OSError:
+                stat = None
+            fstat = os.fstat(fd)
+            if stat is None or (stat.st_dev, stat.st_ino) != (fstat.st_dev,
+                                                              fstat.st_ino):
+                os.close(fd)
+                continue
+            try:
+                # allow other users of a shared directory to lock it
+                os.fchmod(fd, 0o666)
+            except OSError:
+                pass
+            os.ftruncate(fd, 0)
+            os.write(fd, json.dumps({'host': socket.gethostname(),
+                                     'pid': os.getpid()}).encode())
+            self._fd = fd
+            return True
+
+    def owner(self):
+        '''
+        Return a description of the current owner of the lock.
+        '''
+        try:
+            with open(self.path) as f:
+                owner = json.load(f)
+            return '%s:%d' % (owner['host'], owner['pid'])
+        except (IOError, OSError, ValueError, KeyError):
+            return 'another process'
+
+    def release(self):
+        if self._fd is not None:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+            os.close(self._fd)
+            self._fd = None
+
+    def acquire_for_download(self, url, tmp_dest, md5_check=None,
+                             callback=None, cbk_interval=0.3, session=None):
+        '''
+        Take the lock before downloading ``url`` to the destination. If
+        another process is downloading it, wait for it to finish (see
+        :meth:`wait_for_download`), then tell whether its result can be
+        used (see :meth:`reusable_download`).
+
+        The lock is held when this method returns, in all cases: it must be
+        released by the caller.
+
+        Returns
+        -------
+        done: bool
+            True if the destination file has been downloaded by another
+            process and is valid, thus needs not be downloaded again.
+        '''
+        if self.acquire(blocking=False):
+            return False
+        self.wait_for_download(url, tmp_dest, callback, cbk_interval,
+                               session)
+        return self.reusable_download(md5_check)
+
+    def wait_for_download(self, url, tmp_dest, callback=None,
+                          cbk_interval=0.3, session=None):
+        '''
+        Wait for another process to release the lock and take it,
+        displaying the progress of its download of ``url`` in ``tmp_dest``.
+        '''
+        from casa_distro.http_session import default_session
+
+        print('%s is being downloaded by %s, waiting for it.'
+              % (osp.basename(tmp_dest), self.owner()))
+        size = 0
+        if callback:
+            try:
+                response = (session or default_session()).request(
+                    url, method='HEAD')
+                size = int(response.getheader('Content-Length', 0))
+            except Exception:
+                pass
+        last_pos = None
+        last_time = time.time()
+        count = 0
+        while not self.acquire(blocking=False):
+            if size:
+                todo = _read_segments_state(tmp_dest, url, size)
+                if todo is not None:
+                    pos = size - sum(s[1] - s[0] for s in todo)
+                elif osp.exists(tmp_dest):
+                    pos = min(os.stat(tmp_dest).st_size, size)
+                else:
+                    pos = 0
+                now = time.time()
+                speed = 0
+                if last_pos is not None:
+                    speed = (pos - last_pos) / max(now - last_time, 1e-6)
+                last_pos = pos
+                last_time = now
+                callback(osp.basename(url), pos, size, speed, count, count)
+                count += 1
+            time.sleep(max(cbk_interval, 0.1))
+        if count:
+            print()
+
+    def reusable_download(self, md5_check=None):
+        '''
+        Tell if the destination file, downloaded by another process, can be
+        used.
+        '''
+        if not osp.exists(self.dest):
+            return False
+        if not md5_check:
+            return True
+        from .hash import file_hash
+        return file_hash(self.dest) == md5_check
+
+
 def download_file(url, dest, timeout=10., callback=None, cbk_interval=0.3,
                   allow_continue=False, method='auto', use_tmp=True,
-                  md5_check=None):
+                  md5_check=None, segments=1, tree_hash=None, session=None,
+                  throttle=None, lock=True):
     '''
     Download a file from the given URL to the local path ``dest``.
 
@@ -335,7 +909,9 @@ def download_file(url, dest, timeout=10., callback=None, cbk_interval=0.3,
         'wget': use wget,
         'wget_no_dl': use wget from the system, don't download a container
         image for it,
-        'auto': try in this order: ('wget_no_dl', 'internal', 'wget').
+        'auto': try in this order: ('wget_no_dl', 'internal', 'wget'), or
+        ('internal', 'wget_no_dl', 'wget') if ``segments`` is greater than 1
+        or if ``throttle`` is given.
     use_tmp: bool
         if True, download a temporary file appended with ".part"
         ("/home/someone/file.sif" -> "/home/someone/file.sif.part") and move
@@ -343,7 +919,28 @@ def download_file(url, dest, timeout=10., callback=None, cbk_interval=0.3,
         This avoids erasing older files before the download is finished.
     md5_check: str
         if not None, check the md5 sum of the downloaded file and checks it
-        matches the given hash string
+        matches the given hash string. The sum is computed while the file is
+        downloaded. The file is read again after the download only if this
+        is not possible (wget continuing a previous download).
+    segments: int
+        number of byte ranges downloaded concurrently by the 'internal'
+        method (see :func:`download_file_segmented`). 1 means a single
+        connection.
+    tree_hash: dict
+        if given, tree hash of the file (see
+        :func:`casa_distro.hash.tree_hash`), used to verify the already
+        downloaded part of the file when a download is continued: invalid
+        parts are downloaded again.
+    session: :class:`casa_distro.http_session.HTTPSession`
+        HTTP session used by the 'internal' method.
+    throttle: :class:`TokenBucket`
+        bandwidth limit of the 'internal' method.
+    lock: bool
+        if True, take an inter-process lock on ``dest`` (see
+        :class:`DownloadLock`). If another process is already downloading
+        the same file, wait for it to finish (displaying its progress)
+        and use its result if it is valid, instead of downloading the
+        file a second time.
     '''
     methods = ('internal', 'wget', 'wget_no_dl', 'auto')
     if method not in methods:
@@ -358,38 +955,77 @@ def download_file(url, dest, timeout=10., callback=None, cbk_interval=0.3,
     else:
         tmp_dest = dest
     if method == 'auto':
-        used_methods = ['wget_no_dl', 'internal', 'wget']
-    done = False
-    for method in used_methods:
-        try:
-            if method in ('wget', 'wget_no_dl'):
-                if method == 'wget_no_dl':
-                    wget = wget_command(download_container=False)
-                else:
-                    wget = wget_command()
-                cmd = list(wget)
-                if allow_continue:
-                    cmd.append('--continue')
-                cmd += [url, '-O', tmp_dest]
-                subprocess.check_call(cmd)
-            elif method == 'internal':
-                download_file_internal(url, tmp_dest, timeout=timeout,
-                                       callback=callback,
-                                       cbk_interval=cbk_interval,
-                                       allow_continue=allow_continue)
-            done = True
-            break
-        except Exception:
-            done = False
-    if not done:
-        if not hasattr(sys, 'last_type'):
-            raise RuntimeError(
-                'No download method could be used to download %s' % url)
-        six.reraise(sys.last_type, sys.last_value, sys.last_traceback)
-
-    if md5_check:
-        from .hash import file_hash
-        if file_hash(tmp_dest) != md5_check:
-            raise RuntimeError('mismatching md5 sum')
-    if use_tmp:
-        os.rename(tmp_dest, dest)
+        if segments > 1 or throttle is not None:
+            # wget cannot perform segmented or globally throttled downloads
+            used_methods = ['internal', 'wget_no_dl', 'wget']
+        else:
+            used_methods = ['wget_no_dl', 'internal', 'wget']
+    download_lock = None
+    if lock:
+        download_lock = DownloadLock(dest)
+        if download_lock.acquire_for_download(url, tmp_dest, md5_check,
+                                              callback, cbk_interval,
+                                              session):
+            download_lock.release()
+            return
+    try:
+        if tree_hash and allow_continue and osp.exists(tmp_dest):
+            _discard_invalid_chunks(url, tmp_dest, tree_hash)
+        done = False
+        for method in used_methods:
+            hasher = None
+            if md5_check:
+                hasher = hashlib.md5()
+            try:
+                if method in ('wget', 'wget_no_dl'):
+                    if method == 'wget_no_dl':
+                        wget = wget_command(download_container=False)
+                    else:
+                        wget = wget_command()
+                    if hasher is not None and not (allow_continue
+                                                   and osp.exists(tmp_dest)):
+                        _wget_download_hashed(wget, url, tmp_dest, hasher)
+                    else:
+                        # wget writes the file itself: the hash will be
+                        # computed afterwards
+                        hasher = None
+                        cmd = list(wget)
+                        if allow_continue:
+                            cmd.append('--continue')
+                        cmd += [url, '-O', tmp_dest]
+                        subprocess.check_call(cmd)
+                elif method == 'internal':
+                    download_file_internal(url, tmp_dest, timeout=timeout,
+                                           callback=callback,
+                                           cbk_interval=cbk_interval,
+                                           allow_continue=allow_continue,
+                                           segments=segments,
+                                           hasher=hasher, session=session,
+                                           throttle=throttle)
+                done = True
+                break
+            except Exception:
+                done = False
+        if not done:
+            if not hasattr(sys, 'last_type'):
+                raise RuntimeError(
+                    'No download method could be used to download %s' % url)
+            six.reraise(sys.last_type, sys.last_value, sys.last_traceback)
+
+        if md5_check:
+            if hasher is not None:
+                md5 = hasher.hexdigest()
+            else:
+                from .hash import file_hash
+                md5 = file_hash(tmp_dest)
+            if md5 != md5_check:
+                raise RuntimeError('mismatching md5 sum')
+        if use_tmp:
+            os.rename(tmp_dest, dest)
+        if md5_check:
+            # later hashes of the image will not need to read it
+            from .hash import store_file_hash
+            store_file_hash(dest, md5)
+    finally:
+        if download_lock is not None:
+            download_lock.release()
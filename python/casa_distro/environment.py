@@ -1,24 +1,24 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division, print_function
 
+import copy
 import errno
 import fnmatch
 from glob import glob
+import hashlib
 import json
 import os
 import os.path as osp
 import re
 import shutil
 import stat
-import subprocess
 import sys
-import time
 import tempfile
 
 from casa_distro import share_directories
 from casa_distro import singularity
-from casa_distro.web import url_listdir
 from casa_distro import downloader
+from casa_distro import trace
 
 
 def add_brainvisa_cmake_path():
@@ -54,13 +54,6 @@ def add_brainvisa_cmake_path():
             sys.path.append(osp.join(dn, 'python'))
 
 
-add_brainvisa_cmake_path()
-try:
-    from brainvisa_cmake import bbi_daily
-except ImportError:
-    bbi_daily = None
-
-
 bv_maker_branches = {
     'latest_release': 'latest_release',
     'master': 'master',
@@ -353,73 +346,183 @@ def user_config_filename():
     return user_config_file
 
 
+# Name of the index of environments configurations, stored in base
+# directories (see iter_environments)
+environments_index_basename = '.casa_distro_index.json'
+
+# Version of the format of environments index files
+_environments_index_version = 2
+
+
+def environments_index_file(base_directory):
+    """
+    Return the index file of the environments of a base directory (see
+    :func:`iter_environments`).
+    """
+    return osp.join(base_directory, environments_index_basename)
+
+
+def _environment_config_files(base_directory, run_type):
+    """
+    Return the configuration files of the environments of a base directory
+    as a dictionary whose values are the stamps (modification time, size and
+    inode) of the files. Duplicates via symlinks are removed.
+    """
+    candidates = []
+    try:
+        names = sorted(os.listdir(base_directory))
+    except OSError:
+        names = []
+    for name in names:
+        if name.startswith('.'):
+            continue
+        if run_type:
+            if name.endswith('.json'):
+                candidates.append(osp.join(base_directory, name))
+        else:
+            candidates.append(osp.join(base_directory, name, 'conf',
+                                       'casa_distro.json'))
+    casa_dir = os.environ.get('CASA_DIR')
+    if casa_dir and not run_type:
+        candidates.append(osp.join(casa_dir, 'conf', 'casa_distro.json'))
+
+    files = {}
+    links = {}
+    for casa_distro_json in candidates:
+        try:
+            st = os.lstat(casa_distro_json)
+            if stat.S_ISLNK(st.st_mode):
+                link = os.readlink(casa_distro_json)
+                if not osp.isabs(link):
+                    link = osp.join(osp.dirname(casa_distro_json), link)
+                links[casa_distro_json] = link
+                st = os.stat(casa_distro_json)
+        except OSError:
+            continue
+        if stat.S_ISREG(st.st_mode):
+            files[casa_distro_json] = [st.st_mtime_ns, st.st_size,
+                                       st.st_ino]
+
+    # remove duplicates via symlinks
+    for casa_distro_json in sorted(files):
+        if links.get(casa_distro_json) in files:
+            del files[casa_distro_json]
+    return files
+
+
+def _environment_config(casa_distro_json, environment_config,
+                        user_config_file, user_config):
+    """
+    Build the configuration of an environment from the content of its
+    casa_distro.json file, merged with the user configuration.
+    """
+    directory = osp.dirname(osp.dirname(casa_distro_json))
+    config = {}
+    config['config_files'] = [casa_distro_json]
+    config['directory'] = directory
+    config['mounts'] = {
+        '/casa/host': '{directory}',
+        '/host': '/',
+    }
+    if 'WSL_DISTRO_NAME' in os.environ:
+        # On Winows/WSL2, /dev/shm is a symlink to /run/shm. This
+        # is supposed to be a directory-like device stored in memory.
+        # To avoid failure of some programs, /run/shm is mounted as
+        # /tmp so that it behave like a writable directory as expected.
+        config['mounts']['/run/shm'] = '/tmp'
+    config['env'] = {
+        'CASA_ENVIRONMENT': '{name}',
+        'CASA_SYSTEM': '{system}',
+        'CASA_HOST_DIR': '{directory}',
+        'CASA_DISTRO': '{distro}',
+    }
+    if 'bv_maker_branch' in config:
+        config['env']['CASA_BRANCH'] = config['bv_maker_branch']
+    if environment_config['container_type'] == 'singularity':
+        config.setdefault('gui_env', {}).update({
+            'DISPLAY': '$DISPLAY'
+        })
+
+    update_config(config, copy.deepcopy(environment_config))
+
+    if user_config is not None:
+        config['config_files'].append(user_config_file)
+        update_config(config, copy.deepcopy(user_config))
+    return config
+
+
+def _read_environments_index(index_file):
+    try:
+        with open(index_file) as f:
+            index = json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+    if index.get('version') != _environments_index_version:
+        return {}
+    return index
+
+
+def _write_environments_index(index_file, index):
+    try:
+        tmp = '%s.%d.tmp' % (index_file, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(index, f)
+        os.rename(tmp, index_file)
+    except (IOError, OSError):
+        pass  # read-only base directory: the index is only an optimization
+
+
 def iter_environments(base_directory=casa_distro_directory(), **filter):
     """
     Iterate over environments created with "setup" or "setup_dev" commands
     in the given
     base directory. For each one, yield a dictionary corresponding to the
     casa_distro.json file with the "directory" item added.
+
+    The contents of the casa_distro.json files are kept in an index file
+    of the base directory (see :func:`environments_index_file`) along with
+    the modification time, size and inode of the files. Only the
+    configuration files which have changed since the index was written are
+    read again. The index is shared by the users of the base directory: the
+    user configuration is merged with the indexed configurations at each
+    call, and is never stored in the index. Environments added or removed
+    by other processes are detected since the base directory is listed each
+    time.
     """
     im_type = filter.get('type')
-    if im_type in ('run', 'pixi'):
-        casa_distro_jsons = set(glob(osp.join(base_directory, '*.json')))
+    run_type = im_type in ('run', 'pixi')
+    if run_type:
         filter = {k: v for k, v in filter.items() if k not in ('distro', )}
-    else:
-        casa_distro_jsons = set(glob(osp.join(base_directory, '*',
-                                              'conf', 'casa_distro.json')))
-        casa_dir = os.environ.get('CASA_DIR')
-        if casa_dir:
-            casa_distro_jsons.update(glob(osp.join(casa_dir, 'conf',
-                                                   'casa_distro.json')))
-
-    # remove duplicates via symlinks
-    for casa_distro_json in sorted(casa_distro_jsons):
-        if osp.islink(casa_distro_json):
-            link = os.readlink(casa_distro_json)
-            if not osp.isabs(link):
-                link = osp.join(osp.dirname(casa_distro_json), link)
-            if link in casa_distro_jsons:
-                casa_distro_jsons.remove(casa_distro_json)
-
-    for casa_distro_json in sorted(casa_distro_jsons):
-        with open(casa_distro_json) as f:
-            environment_config = json.load(f)
-        directory = osp.dirname(osp.dirname(casa_distro_json))
-        config = {}
-        config['config_files'] = [casa_distro_json]
-        config['directory'] = directory
-        config['mounts'] = {
-            '/casa/host': '{directory}',
-            '/host': '/',
-        }
-        if 'WSL_DISTRO_NAME' in os.environ:
-            # On Winows/WSL2, /dev/shm is a symlink to /run/shm. This
-            # is supposed to be a directory-like device stored in memory.
-            # To avoid failure of some programs, /run/shm is mounted as
-            # /tmp so that it behave like a writable directory as expected.
-            config['mounts']['/run/shm'] = '/tmp'
-        config['env'] = {
-            'CASA_ENVIRONMENT': '{name}',
-            'CASA_SYSTEM': '{system}',
-            'CASA_HOST_DIR': '{directory}',
-            'CASA_DISTRO': '{distro}',
-        }
-        if 'bv_maker_branch' in config:
-            config['env']['CASA_BRANCH'] = config['bv_maker_branch']
-        if environment_config['container_type'] == 'singularity':
-            config.setdefault('gui_env', {}).update({
-                'DISPLAY': '$DISPLAY'
-            })
-
-        update_config(config, environment_config)
-
-        user_config_file = user_config_filename()
-        for additional_config_file in [user_config_file]:
-            if osp.exists(additional_config_file):
-                config['config_files'].append(additional_config_file)
-                with open(additional_config_file) as f:
-                    update_config(config, json.load(f))
+    files = _environment_config_files(base_directory, run_type)
+
+    index_file = environments_index_file(base_directory)
+    index = _read_environments_index(index_file)
+    section = ('run_environments' if run_type else 'environments')
+    indexed = index.get(section, {})
+
+    entries = {}
+    for casa_distro_json, stamp in sorted(files.items()):
+        entry = indexed.get(casa_distro_json)
+        if entry is None or entry['stamp'] != stamp:
+            with open(casa_distro_json) as f:
+                entry = {'stamp': stamp,
+                         'environment_config': json.load(f)}
+        entries[casa_distro_json] = entry
+    if entries != indexed:
+        index['version'] = _environments_index_version
+        index[section] = entries
+        _write_environments_index(index_file, index)
 
+    user_config_file = user_config_filename()
+    user_config = None
+    if entries and osp.exists(user_config_file):
+        with open(user_config_file) as f:
+            user_config = json.load(f)
+
+    for casa_distro_json, entry in sorted(entries.items()):
+        config = _environment_config(
+            casa_distro_json, entry['environment_config'],
+            user_config_file, user_config)
         match = False
         for k, p in filter.items():
             if p is None:
@@ -430,7 +533,7 @@ def iter_environments(base_directory=casa_distro_directory(), **filter):
         else:
             match = True
         if match:
-            if im_type in ('run', 'pixi'):
+            if run_type:
                 config['image'] = casa_distro_json[:-5]
             yield config
 
@@ -468,6 +571,8 @@ def get_run_base_of_dev_image(image, url=None):
     """
     Get the run image associated to a given dev image
     """
+    from casa_distro.web import url_listdir, url_catalog
+
     image = updated_image(image)
     if url is not None:
         base = osp.basename(image)
@@ -480,6 +585,18 @@ def get_run_base_of_dev_image(image, url=None):
             version = m.group('version')
             extension = m.group('extension')
 
+            # use the catalog of the download directory if there is one
+            catalog = url_catalog(url)
+            for file, im_meta in sorted((catalog or {}).items()):
+                m = image_re.match(file)
+                if (m and run_id is not None
+                        and m.group('version') == version
+                        and m.group('extension') == extension
+                        and im_meta.get('image_id') == run_id):
+                    return osp.join(dirname, file)
+
+            # otherwise (or if the image is missing from the catalog) look
+            # at the metadata of all images
             tmpi = tempfile.mkstemp(prefix='casa_distro', suffix='.json')
             os.close(tmpi[0])
             tmp = tmpi[1]
@@ -524,6 +641,8 @@ def find_image_update_url(image, url):
         up_to_date: bool
             if the image is already the latest version
     '''
+    from casa_distro.web import url_listdir, url_catalog
+
     base = osp.basename(image)
     m = image_re.match(base)
     if m:
@@ -533,7 +652,12 @@ def find_image_update_url(image, url):
         extension = m.group('extension')
         patch = int(patch or 0)
         new_patch = patch
-        for file in url_listdir(url):
+        catalog = url_catalog(url)
+        if catalog is not None:
+            files = catalog.keys()
+        else:
+            files = url_listdir(url)
+        for file in files:
             other_base = osp.basename(file)
             m = image_re.match(other_base)
             if (m and
@@ -555,7 +679,9 @@ def find_image_update_url(image, url):
 
 
 def update_image(image, new_image_url, config_files=[], restart=False,
-                 cleanup=True, do_update=True, rel_images=None):
+                 cleanup=True, do_update=True, rel_images=None, segments=1,
+                 session=None, throttle=None,
+                 callback=downloader.stdout_progress, delta=True):
     """
     Download an image from a given URL to replace an existing image file.
 
@@ -583,6 +709,22 @@ def update_image(image, new_image_url, config_files=[], restart=False,
         The list should have the same size as the config_files parameter.
         If empty, or if any value is not true, then the absolute image name
         is used.
+    segments: int
+        number of byte ranges of the image file downloaded concurrently (see
+        :func:`casa_distro.downloader.download_file_segmented`).
+    session: :class:`casa_distro.http_session.HTTPSession`
+        HTTP session used for downloads.
+    throttle: :class:`casa_distro.downloader.TokenBucket`
+        bandwidth limit of downloads.
+    callback: function
+        download progress callback.
+    delta: bool
+        if True and if the server provides a block control file for the
+        new image (see :mod:`casa_distro.delta`), only the blocks which
+        differ from the current image are downloaded.
+
+    Config files are modified only once the image file has been downloaded
+    and its md5 sum verified. Each one is replaced atomically.
     """
     target_dir = osp.dirname(image)
     new_name = osp.basename(new_image_url)
@@ -593,19 +735,45 @@ def update_image(image, new_image_url, config_files=[], restart=False,
         downloader.download_file(new_image_url + '.json',
                                  new_json,
                                  allow_continue=False,
-                                 use_tmp=False)
+                                 use_tmp=False,
+                                 method='internal',
+                                 session=session)
     with open(new_json) as f:
         new_metadata = json.load(f)
 
     new_image = osp.join(target_dir, '{}'.format(new_name))
     if do_update:
-        # Then download the image file
-        downloader.download_file(new_image_url,
-                                 new_image,
-                                 allow_continue=not restart,
-                                 use_tmp=True,
-                                 md5_check=new_metadata['md5'],
-                                 callback=downloader.stdout_progress)
+        # The same lock as download_file() is held during the delta attempt
+        # and the full download, so that concurrent updates of the image do
+        # not write the same files.
+        download_lock = downloader.DownloadLock(new_image)
+        if download_lock.acquire_for_download(
+                new_image_url, new_image + '.part', new_metadata['md5'],
+                callback, session=session):
+            do_update = False
+        try:
+            delta_done = False
+            if (do_update and delta and osp.exists(image)
+                    and osp.abspath(image) != osp.abspath(new_image)):
+                delta_done = _delta_update_image(
+                    image, new_image_url, new_image, new_metadata, segments,
+                    session, throttle, callback)
+            if do_update and not delta_done:
+                # Then download the image file
+                downloader.download_file(
+                    new_image_url,
+                    new_image,
+                    allow_continue=not restart,
+                    use_tmp=True,
+                    md5_check=new_metadata['md5'],
+                    callback=callback,
+                    segments=segments,
+                    tree_hash=new_metadata.get('tree_hash'),
+                    session=session,
+                    throttle=throttle,
+                    lock=False)
+        finally:
+            download_lock.release()
 
     # Change the config files
     for i, filename in enumerate(config_files):
@@ -622,9 +790,11 @@ def update_image(image, new_image_url, config_files=[], restart=False,
             metadata['image_id'] = image_id
         else:
             metadata.pop('image_id', None)
-        with open(filename, 'w') as f:
+        tmp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+        with open(tmp_filename, 'w') as f:
             json.dump(metadata, f,
                       indent=4, separators=(',', ': '))
+        os.rename(tmp_filename, filename)
 
     # Finally remove old image
     if cleanup and osp.abspath(image) != osp.abspath(new_image):
@@ -634,6 +804,106 @@ def update_image(image, new_image_url, config_files=[], restart=False,
             os.remove(image + '.json')
 
 
+def _delta_update_image(image, new_image_url, new_image, new_metadata,
+                        segments, session, throttle, callback):
+    """
+    Try to build a new image from the current one and the blocks which
+    have changed (see :func:`casa_distro.delta.delta_download`). Return
+    False if it is not possible.
+    """
+    from casa_distro import delta
+    from casa_distro.http_session import default_session
+
+    try:
+        response = (session or default_session()).get(
+            new_image_url + delta.control_suffix)
+        control = json.loads(response.read().decode('utf-8'))
+    except Exception:
+        # no control file
+        return False
+    try:
+        downloaded = delta.delta_download(
+            new_image_url, new_image, image, control,
+            md5_check=new_metadata['md5'], segments=max(segments, 4),
+            session=session, throttle=throttle, callback=callback)
+    except Exception as e:
+        print('delta update of {} failed ({}), downloading the whole '
+              'image'.format(osp.basename(new_image), e))
+        return False
+    print('{}: {} bytes downloaded out of {}'.format(
+        osp.basename(new_image), downloaded, control['size']))
+    return True
+
+
+def update_images(updates, connections=8, bandwidth=0, segments=1,
+                  restart=False, cleanup=True, delta=True):
+    """
+    Download several image updates concurrently, using
+    :func:`update_image` for each of them.
+
+    All downloads share an HTTP session limited to ``connections``
+    simultaneous connections, and a bandwidth limit. Thus
+    ``connections // segments`` images are downloaded at the same time.
+    The progress of all downloads is displayed as a whole.
+
+    Parameters
+    ----------
+    updates: list
+        list of ``(image, new_image_url, config_files, rel_images,
+        do_update)`` tuples, as parameters of :func:`update_image`. Updates
+        sharing the same URL are processed one after the other, in the
+        list order.
+    connections: int
+        maximum number of simultaneous connections
+    bandwidth: int
+        maximum total download speed, in bytes per second. 0 means no
+        limit.
+    segments: int
+        number of byte ranges of each image downloaded concurrently
+    restart: bool
+        see :func:`update_image`
+    cleanup: bool
+        see :func:`update_image`
+    delta: bool
+        see :func:`update_image`
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from casa_distro.http_session import HTTPSession
+
+    groups = {}
+    for update in updates:
+        groups.setdefault(update[1], []).append(update)
+    if not groups:
+        return
+    session = HTTPSession(max_connections=connections)
+    throttle = None
+    if bandwidth:
+        throttle = downloader.TokenBucket(bandwidth)
+    callback = downloader.stdout_progress
+    if len(groups) > 1:
+        callback = downloader.MultiProgress().callback
+
+    def update_group(group):
+        for image, new_image_url, config_files, rel_images, do_update \
+                in group:
+            update_image(image, new_image_url, config_files,
+                         restart=restart, cleanup=cleanup,
+                         do_update=do_update, rel_images=rel_images,
+                         segments=segments, session=session,
+                         throttle=throttle, callback=callback, delta=delta)
+
+    workers = min(max(connections // max(segments, 1), 1), len(groups))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(update_group, group)
+                   for group in groups.values()]
+        # let other downloads finish before reporting the first error
+        errors = [future.exception() for future in futures]
+    session.close()
+    for error in errors:
+        if error is not None:
+            raise error
+
+
 def select_environment(base_directory, **kwargs):
     """
     Select a single environment given its name or an existing distro directory.
@@ -817,14 +1087,50 @@ def prepare_environment_homedir(casa_home_host_path, config):
             pass
 
 
+def _container_module(container_type):
+    if container_type in ('singularity', 'apptainer', 'apptainer_pixi'):
+        return singularity
+    elif container_type == 'vbox':
+        raise NotImplementedError(
+            'run command is not implemented for VirtualBox')
+    elif container_type == 'docker':
+        raise NotImplementedError('run command is not implemented for Docker')
+    else:
+        raise ValueError('Invalid container type: {0}'.format(container_type))
+
+
 def run_container(config, command, gui, opengl, root, cwd, env, image,
-                  container_options, base_directory, verbose):
+                  container_options, base_directory, verbose,
+                  resources=None):
     """
-    Run a command in the container defined in the environment
+    Run a command in the container defined in the environment. ``resources``
+    may give the "cpus", "memory" and "cpu_affinity" budget of the run (see
+    :mod:`casa_distro.budget`).
 
     Return the exit code of the command, or raise an exception if the command
     cannot be run.
     """
+    with trace.span('run_container'):
+        plan = container_launch_plan(config,
+                                     gui=gui,
+                                     opengl=opengl,
+                                     root=root,
+                                     cwd=cwd,
+                                     env=env,
+                                     image=image,
+                                     container_options=container_options,
+                                     base_directory=base_directory,
+                                     resources=resources)
+        return execute_launch_plan(plan, command, verbose)
+
+
+def container_home_directory(config):
+    """
+    Return the host directory mounted as the home directory of the
+    container of an environment: the "home" directory of the environment
+    if it exists, or a directory of $XDG_DATA_HOME/casa-distro otherwise
+    (for read-only environments).
+    """
     if not os.path.exists(osp.join(config['directory'], 'home')):
         full_environment_path_flat = (
             osp.normcase(osp.abspath(config['directory']))
@@ -835,12 +1141,26 @@ def run_container(config, command, gui, opengl, root, cwd, env, image,
         if not xdg_data_home:
             xdg_data_home = os.path.join(os.path.expanduser('~'),
                                          '.local', 'share')
-        host_path_of_container_home = os.path.join(
+        return os.path.join(
             xdg_data_home, 'casa-distro',
             full_environment_path_flat, 'home')
     else:
-        host_path_of_container_home = osp.join(config['directory'], 'home')
+        return osp.join(config['directory'], 'home')
+
 
+def container_launch_plan(config, gui, opengl, root, cwd, env, image,
+                          container_options, base_directory, resources=None):
+    """
+    Resolve everything needed to start the container of an environment,
+    independently of the command to run: prepare the home directory of the
+    container, check the image compatibility and build the container
+    command line and environment (see :func:`casa_distro.singularity.
+    launch_plan`).
+
+    The returned plan also contains the "container_type" and the "files"
+    it depends on (see :func:`run_environment`).
+    """
+    host_path_of_container_home = container_home_directory(config)
     config.setdefault('mounts', {})
     config['mounts']['/casa/home'] = host_path_of_container_home
     for dirname in standard_dirs_to_mount():
@@ -848,19 +1168,12 @@ def run_container(config, command, gui, opengl, root, cwd, env, image,
 
     # Prepare the home directory of the container (create it if needed, and
     # ensure that necessary files are present.)
-    prepare_environment_homedir(host_path_of_container_home, config)
-    prepare_user_config()
+    with trace.span('prepare homedir'):
+        prepare_environment_homedir(host_path_of_container_home, config)
+        prepare_user_config()
 
     container_type = config.get('container_type')
-    if container_type in ('singularity', 'apptainer', 'apptainer_pixi'):
-        module = singularity
-    elif container_type == 'vbox':
-        raise NotImplementedError(
-            'run command is not implemented for VirtualBox')
-    elif container_type == 'docker':
-        raise NotImplementedError('run command is not implemented for Docker')
-    else:
-        raise ValueError('Invalid container type: {0}'.format(container_type))
+    module = _container_module(container_type)
 
     # check image compatibility
     if image is not None:
@@ -895,127 +1208,177 @@ def run_container(config, command, gui, opengl, root, cwd, env, image,
     branch = config.get('branch')
     if branch:
         env['CASA_BRANCH'] = bv_maker_branches.get(branch, branch)
-    return module.run(config,
-                      command=command,
-                      gui=gui,
-                      opengl=opengl,
-                      root=root,
-                      cwd=cwd,
-                      env=env,
-                      image=eimage,
-                      container_options=container_options,
-                      base_directory=base_directory,
-                      verbose=verbose)
-
-
-class CasaDistroBBIDaily(bbi_daily.BBIDaily if bbi_daily else object):
-    def __init__(self, base_directory, jenkins=None):
-        super().__init__(base_directory=base_directory, jenkins=jenkins)
-        self.casa_distro_src = osp.dirname(osp.dirname(
-            osp.dirname(__file__)))
-        casa_distro = osp.join(self.casa_distro_src, 'bin',
-                               'casa_distro')
-        casa_distro_admin = osp.join(self.casa_distro_src, 'bin',
-                                     'casa_distro_admin')
-        self.casa_distro_cmd = [sys.executable, casa_distro]
-        self.casa_distro_cmd_env = None
-        self.casa_distro_admin_cmd = [sys.executable, casa_distro_admin]
-
-    def update_casa_distro(self):
-        self.update_brainvisa_cmake()
-        start = time.time()
-        result, log = self.call_output(['git',
-                                        '-C', self.casa_distro_src,
-                                        'pull'])
-        duration = int(1000 * (time.time() - start))
-        self.log(self.bbe_name, 'update casa_distro',
-                 result, log,
-                 duration=duration)
-        return result == 0
-
-    def update_base_images(self, images):
-        start = time.time()
-        log = []
-        result = None
-        for image in images:
-            result, output = self.call_output(self.casa_distro_cmd + [
-                'pull_image', 'image={0}'.format(image)])
-            log.append(output)
-            if result:
-                break
-        duration = int(1000 * (time.time() - start))
-        self.log(self.bbe_name,
-                 'update images',
-                 result, '\n'.join(log),
-                 duration=duration)
-        return result == 0
-
-    def recreate_user_env(self, user_config, dev_config):
-        environment = user_config['name']
-        if self.jenkins:
-            if not self.jenkins.job_exists(environment):
-                self.jenkins.create_job(environment,
-                                        **user_config)
-        start = time.time()
-        if not os.path.exists(user_config['directory']):
-            os.makedirs(user_config['directory'])
-        eimage = osp.normpath(osp.join(user_config.get('directory'),
-                                       user_config['image']))
-        result, log = self.call_output([
-            'singularity', 'run',
-            '--bind', user_config['directory'] + ':/casa/setup:rw', eimage,
-        ])
-        if result == 0:
-            # Make the reference test data available in the user environment
-            # through a symlink to the dev environment
-            user_test_ref_dir = os.path.join(user_config['directory'],
-                                             'tests', 'ref')
-            dev_test_ref_dir = os.path.join(dev_config['directory'],
-                                            'tests', 'ref')
-            if not os.path.exists(user_test_ref_dir):
-                if not os.path.exists(os.path.dirname(user_test_ref_dir)):
-                    os.makedirs(os.path.dirname(user_test_ref_dir))
-                os.symlink(os.path.join('/host', dev_test_ref_dir),
-                           user_test_ref_dir)
-
-            for command in (dev_config.get('bbi_user_config', {})
-                            .get('setup_commands', [])):
-                subprocess.check_call(command, shell=True,
-                                      cwd=user_config['directory'])
-        duration = int(1000 * (time.time() - start))
-        self.log(user_config['name'], 'recreate user env', result, log,
-                 duration=duration)
-        return result == 0
-
-    def update_user_image(self, user_config, dev_config,
-                          install_doc=True,
-                          install_test=True,
-                          install_thirdparty='default'):
-        environment = user_config['name']
-        if self.jenkins:
-            if not self.jenkins.job_exists(environment):
-                self.jenkins.create_job(environment,
-                                        **user_config)
-        start = time.time()
-        image = user_config['image']
-        image = osp.normpath(osp.join(user_config.get('directory'), image))
-        if osp.exists(image):
-            os.remove(image)
-        result, log = self.call_output(self.casa_distro_admin_cmd + [
-            'create_user_image',
-            'version={0}'.format(user_config['version']),
-            'name={0}'.format(user_config['name']),
-            'environment_name={0}'.format(dev_config['name']),
-            'output=' + image,
-            'force=yes',
-            'install_thirdparty=%s' % install_thirdparty,
-            'install_doc=' + str(install_doc),
-            'install_test=' + str(install_test),
-        ])
-        duration = int(1000 * (time.time() - start))
-        self.log(user_config['name'], 'update user image', result, log,
-                 duration=duration)
-        return result == 0
+    with trace.span('%s launch_plan' % container_type):
+        plan = module.launch_plan(config,
+                                  gui=gui,
+                                  opengl=opengl,
+                                  root=root,
+                                  cwd=cwd,
+                                  env=env,
+                                  image=eimage,
+                                  container_options=container_options,
+                                  base_directory=base_directory,
+                                  resources=resources)
+    plan['container_type'] = container_type
+
+    # files whose change (or appearance) invalidates the plan
+    files = list(config.get('config_files', []))
+    files += [user_config_filename(),
+              base_directory,
+              osp.dirname(plan['image']),
+              plan['image'],
+              plan['image'] + '.json',
+              osp.join(config['directory'], 'overlay.img')]
+    files += [osp.join(host_path_of_container_home, i)
+              for i in ('.bashrc', '.sudo_as_admin_successful',
+                        '.varlib/xkb')]
+    files += plan.get('missing_sources', [])
+    files += [osp.splitext(m.__file__)[0] + '.py'
+              for m in (sys.modules[__name__], module)]
+    plan['files'] = {f: _file_stamp(f) for f in files}
+    return plan
+
+
+def execute_launch_plan(plan, command, verbose):
+    """
+    Run a command in a container as described by a plan returned by
+    :func:`container_launch_plan`.
+
+    Return the exit code of the command.
+    """
+    module = _container_module(plan['container_type'])
+    with trace.span('execute_launch_plan') as span_args:
+        span_args['exit_code'] = module.execute_plan(plan, command, verbose)
+    return span_args['exit_code']
+
+
+def launch_plan_cache_directory():
+    '''
+    Return the directory where launch plans of environments are cached:
+    $XDG_CACHE_HOME/casa-distro/launch_plans
+    (~/.cache/casa-distro/launch_plans by default).
+    '''
+    xdg_cache_home = os.environ.get('XDG_CACHE_HOME', '')
+    if not xdg_cache_home:
+        xdg_cache_home = osp.expanduser('~/.cache')
+    return osp.join(xdg_cache_home, 'casa-distro', 'launch_plans')
+
+
+# Environment variables which change from a shell to another without
+# changing the way a container is started
+_volatile_environ = ('PWD', 'OLDPWD', 'SHLVL', '_')
+
+
+def _file_stamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+def _launch_plan_file(base_directory, selection, options):
+    environ = {k: v for k, v in os.environ.items()
+               if k not in _volatile_environ}
+    key = {'base_directory': osp.abspath(base_directory),
+           'selection': selection,
+           'options': options,
+           'environ': environ,
+           'nvidia': singularity._nvidia_fingerprint()}
+    if hasattr(os, 'sched_getaffinity'):
+        # an explicit cpu_affinity is checked against the caller's CPUs
+        key['affinity'] = sorted(os.sched_getaffinity(0))
+    digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf8'))
+    return osp.join(launch_plan_cache_directory(),
+                    digest.hexdigest() + '.json')
+
+
+def _load_launch_plan(plan_file):
+    try:
+        with open(plan_file) as f:
+            plan = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    for path, stamp in plan.get('files', {}).items():
+        if _file_stamp(path) != stamp:
+            return None
+    return plan
+
+
+def _launch_plan_runnable(plan):
+    '''
+    Tell whether the container runtime executable and the image a launch
+    plan refers to still exist. The exit code of a run cannot tell a
+    runtime failure from a failure of the command itself.
+    '''
+    argv = [i for i in plan.get('argv', []) if i != 'sudo']
+    if argv and not os.access(argv[0], os.X_OK):
+        return False
+    image = plan.get('image')
+    return not image or osp.exists(image)
+
+
+def _store_launch_plan(plan_file, plan):
+    try:
+        if not osp.isdir(osp.dirname(plan_file)):
+            os.makedirs(osp.dirname(plan_file))
+        tmp = '%s.%d.tmp' % (plan_file, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(plan, f)
+        os.rename(tmp, plan_file)
+    except (IOError, OSError):
+        pass  # the cache is only an optimization
+
+
+def run_environment(base_directory, selection, command, gui, opengl, root,
+                    cwd, env, image, container_options, verbose,
+                    resources=None):
+    """
+    Select an environment (see :func:`select_environment`) and run a
+    command in its container.
+
+    The launch plan (see :func:`container_launch_plan`) is cached in
+    :func:`launch_plan_cache_directory`, keyed by the selection, the
+    options and the host environment variables. A cached plan is used
+    without selecting the environment again as long as the modification
+    times of the files it depends on (configuration files, image and its
+    directory, user configuration, container home directory...) do not
+    change, and as long as the skipped mount sources do not appear.
+    """
+    if image is not None:
+        image = osp.abspath(image)
+    options = {'gui': gui, 'opengl': opengl, 'root': root, 'cwd': cwd,
+               'env': env, 'image': image,
+               'container_options': container_options,
+               'resources': resources}
+    with trace.span('launch plan cache lookup') as span_args:
+        plan_file = _launch_plan_file(base_directory, selection, options)
+        plan = _load_launch_plan(plan_file)
+        span_args['hit'] = plan is not None
+    if plan is not None:
+        if verbose:
+            print('Using cached launch plan:', plan_file, file=verbose)
+    else:
+        with trace.span('select_environment'):
+            config = select_environment(base_directory, **selection)
+        with trace.span('container_launch_plan'):
+            plan = container_launch_plan(config,
+                                         base_directory=base_directory,
+                                         **options)
+        _store_launch_plan(plan_file, plan)
+        if verbose:
+            print('Launch plan resolved and stored in:', plan_file,
+                  file=verbose)
+    try:
+        retval = execute_launch_plan(plan, command, verbose)
+    finally:
+        if not _launch_plan_runnable(plan):
+            # the container runtime or the image has gone: the plan is wrong
+            try:
+                os.unlink(plan_file)
+            except OSError:
+                pass
+    return retval
 
 
 def get_env_host_dir(container_type):
@@ -2,11 +2,298 @@
 from __future__ import absolute_import, division, print_function
 
 import hashlib
+import json
 import os
+import sys
+import time
 
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
 
-def file_hash(path, blocksize=2**20):
+
+# Name of the hash cache database, in the user cache directory
+hash_cache_basename = 'hash_cache.sqlite'
+
+# Files modified less than this delay (in nanoseconds) before being hashed
+# are not cached: on filesystems with a coarse timestamp resolution, a
+# modification happening within the same time slot would not change their
+# modification time.
+_racy_delay_ns = 2 * 10**9
+
+
+def hash_cache_file():
+    '''
+    Return the hash cache database file: the value of the
+    CASA_DISTRO_HASH_CACHE environment variable if it is set, or
+    $XDG_CACHE_HOME/casa-distro/hash_cache.sqlite
+    (~/.cache/casa-distro/hash_cache.sqlite by default).
+
+    The cache is kept out of the directories of the hashed files, which may
+    be published by a web server or shared on network filesystems, where
+    sqlite locking is unreliable.
+    '''
+    cache_file = os.environ.get('CASA_DISTRO_HASH_CACHE')
+    if cache_file:
+        return cache_file
+    xdg_cache_home = os.environ.get('XDG_CACHE_HOME', '')
+    if not xdg_cache_home:
+        xdg_cache_home = os.path.expanduser('~/.cache')
+    return os.path.join(xdg_cache_home, 'casa-distro', hash_cache_basename)
+
+
+def _hash_cache_connection():
+    '''
+    Open the hash cache database (see :func:`hash_cache_file`). Return None
+    if it cannot be used.
+    '''
+    if sqlite3 is None:
+        return None
+    cache_file = hash_cache_file()
+    try:
+        if not os.path.isdir(os.path.dirname(cache_file)):
+            os.makedirs(os.path.dirname(cache_file))
+        db = sqlite3.connect(cache_file, timeout=60)
+        db.execute('CREATE TABLE IF NOT EXISTS file_hash ('
+                   'device INTEGER, inode INTEGER, algorithm TEXT, '
+                   'size INTEGER, mtime_ns INTEGER, hash TEXT, '
+                   'PRIMARY KEY (device, inode, algorithm))')
+        db.commit()
+    except (sqlite3.Error, OSError):
+        return None
+    return db
+
+
+def cached_file_hash(path, algorithm='md5', stat=None):
+    '''
+    Return the hash of a file recorded in the hash cache, or None if it is
+    not in the cache or if the file has changed since it was recorded.
+
+    Cache entries are keyed by device, inode, size and modification time of
+    the file, thus they are invalidated when the file is rewritten.
+    '''
+    db = _hash_cache_connection()
+    if db is None:
+        return None
+    if stat is None:
+        stat = os.stat(path)
+    try:
+        with db:
+            row = db.execute(
+                'SELECT size, mtime_ns, hash FROM file_hash '
+                'WHERE device=? AND inode=? AND algorithm=?',
+                (stat.st_dev, stat.st_ino, algorithm)).fetchone()
+    except sqlite3.Error:
+        return None
+    finally:
+        db.close()
+    if row is not None and tuple(row[:2]) == (stat.st_size,
+                                              stat.st_mtime_ns):
+        return row[2]
+    return None
+
+
+def store_file_hash(path, hashsum, algorithm='md5', stat=None):
+    '''
+    Record the hash of a file in the hash cache. Errors (read-only
+    directory...) are ignored: the cache is only an optimization.
+    '''
+    db = _hash_cache_connection()
+    if db is None:
+        return
+    if stat is None:
+        stat = os.stat(path)
+    try:
+        with db:
+            db.execute('INSERT OR REPLACE INTO file_hash '
+                       '(device, inode, algorithm, size, mtime_ns, hash) '
+                       'VALUES (?, ?, ?, ?, ?, ?)',
+                       (stat.st_dev, stat.st_ino, algorithm,
+                        stat.st_size, stat.st_mtime_ns, hashsum))
+    except sqlite3.Error:
+        pass
+    finally:
+        db.close()
+
+
+def file_hash(path, blocksize=2**20, cache=True):
+    '''
+    Compute the md5 hash of a file.
+
+    If ``cache`` is True, the hash is looked up in (and stored into) a cache
+    database (see :func:`hash_cache_file` and :func:`cached_file_hash`), so
+    that hashing an unchanged file again does not need to read it.
+    '''
+    if cache:
+        start_ns = int(time.time() * 1e9)
+        stat = os.stat(path)
+        hashsum = cached_file_hash(path, stat=stat)
+        if hashsum is not None:
+            return hashsum
     m = hashlib.md5()
+    with open(path, 'rb') as f:
+        while True:
+            buf = f.read(blocksize)
+            if not buf:
+                break
+            m.update(buf)
+    hashsum = m.hexdigest()
+    if cache:
+        new_stat = os.stat(path)
+        if (stat.st_mtime_ns < start_ns - _racy_delay_ns
+                and (new_stat.st_dev, new_stat.st_ino, new_stat.st_size,
+                     new_stat.st_mtime_ns)
+                == (stat.st_dev, stat.st_ino, stat.st_size,
+                    stat.st_mtime_ns)):
+            store_file_hash(path, hashsum, stat=stat)
+    return hashsum
+
+
+def _hash_chunk(path_fd, algorithm, offset, chunk_size, blocksize=2**20):
+    h = hashlib.new(algorithm)
+    end = offset + chunk_size
+    while offset < end:
+        buf = os.pread(path_fd, min(blocksize, end - offset), offset)
+        if not buf:
+            break
+        h.update(buf)
+        offset += len(buf)
+    return h.hexdigest()
+
+
+def tree_root(chunks, algorithm='sha256'):
+    '''
+    Combine chunks digests (hexadecimal strings) into the root digest of a
+    tree hash.
+    '''
+    h = hashlib.new(algorithm)
+    for chunk in chunks:
+        h.update(bytes.fromhex(chunk))
+    return h.hexdigest()
+
+
+def chunks_hashes(path, chunk_size, algorithm='sha256', chunks=None,
+                  workers=None):
+    '''
+    Compute the digests of fixed-size chunks of a file, in parallel.
+
+    Parameters
+    ----------
+    path: str
+        file to hash
+    chunk_size: int
+        size of chunks in bytes. The last chunk may be smaller.
+    algorithm: str
+        hashlib algorithm name
+    chunks: list of int
+        indices of the chunks to hash. Default: all chunks.
+    workers: int
+        number of threads. hashlib releases the GIL while hashing, so chunks
+        are hashed concurrently. Default: number of CPUs, up to 8.
+
+    Returns
+    -------
+    digests: list of str
+        hexadecimal digests of the selected chunks
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+
+    if workers is None:
+        workers = min(os.cpu_count() or 1, 8)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if chunks is None:
+            size = os.fstat(fd).st_size
+            chunks = range(max(-(-size // chunk_size), 1))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(
+                lambda i: _hash_chunk(fd, algorithm, i * chunk_size,
+                                      chunk_size),
+                chunks))
+    finally:
+        os.close(fd)
+
+
+def tree_hash(path, chunk_size=2**24, algorithm='sha256', workers=None,
+              cache=True):
+    '''
+    Compute a chunked tree hash of a file.
+
+    The file is split into fixed-size chunks which are hashed in parallel
+    (see :func:`chunks_hashes`). The root digest is the hash of the
+    concatenation of the (binary) chunks digests. Chunks digests allow to
+    verify parts of a file, for instance an incomplete download.
+
+    As for :func:`file_hash`, the result is stored in the hash cache if
+    ``cache`` is True.
+
+    Returns
+    -------
+    tree: dict
+        JSON-compatible dictionary with the keys "algorithm", "size",
+        "chunk_size", "root" and "chunks" (list of chunks digests). It is
+        stored as the "tree_hash" item of images metadata.
+    '''
+    cache_key = 'tree:%s:%d' % (algorithm, chunk_size)
+    if cache:
+        start_ns = int(time.time() * 1e9)
+        stat = os.stat(path)
+        cached = cached_file_hash(path, algorithm=cache_key, stat=stat)
+        if cached is not None:
+            chunks = json.loads(cached)
+            return {'algorithm': algorithm,
+                    'size': stat.st_size,
+                    'chunk_size': chunk_size,
+                    'root': tree_root(chunks, algorithm),
+                    'chunks': chunks}
+    chunks = chunks_hashes(path, chunk_size, algorithm=algorithm,
+                           workers=workers)
+    new_stat = os.stat(path)
+    if cache:
+        if (stat.st_mtime_ns < start_ns - _racy_delay_ns
+                and (new_stat.st_size, new_stat.st_mtime_ns)
+                == (stat.st_size, stat.st_mtime_ns)):
+            store_file_hash(path, json.dumps(chunks), algorithm=cache_key,
+                            stat=stat)
+    return {'algorithm': algorithm,
+            'size': new_stat.st_size,
+            'chunk_size': chunk_size,
+            'root': tree_root(chunks, algorithm),
+            'chunks': chunks}
+
+
+def invalid_chunks(path, tree, chunks=None, workers=None):
+    '''
+    Verify the complete chunks of a (possibly incomplete) file against a tree
+    hash as returned by :func:`tree_hash`.
+
+    If ``chunks`` is given, only chunks with these indices are verified.
+
+    Returns
+    -------
+    indices: list of int
+        indices of the chunks present in the file whose digest does not
+        match. Chunks beyond the end of the file are not checked.
+    '''
+    chunk_size = tree['chunk_size']
+    expected = tree['chunks']
+    size = os.stat(path).st_size
+    if size >= tree['size']:
+        count = len(expected)
+    else:
+        count = size // chunk_size
+    if chunks is None:
+        chunks = range(count)
+    else:
+        chunks = [i for i in chunks if i < count]
+    digests = chunks_hashes(path, chunk_size, algorithm=tree['algorithm'],
+                            chunks=chunks, workers=workers)
+    return [i for i, d in zip(chunks, digests) if d != expected[i]]
+
+
+def _file_digest(path, algorithm='sha256', blocksize=2**20):
+    m = hashlib.new(algorithm)
     with open(path, 'rb') as f:
         while True:
             buf = f.read(blocksize)
@@ -16,6 +303,82 @@ def file_hash(path, blocksize=2**20):
     return m.hexdigest()
 
 
+def directory_manifest(path, exclude=('__pycache__', '*.pyc'),
+                       algorithm='sha256', workers=None, contents=True):
+    '''
+    Describe the contents of a directory tree.
+
+    Files are hashed in parallel threads (hashlib releases the GIL). The
+    hash cache, meant for large image files, is not used.
+
+    Parameters
+    ----------
+    path: str
+        directory to describe
+    exclude: sequence of str
+        shell patterns of the names of files and directories to ignore
+    algorithm: str
+        hashlib algorithm name
+    workers: int
+        number of threads. Default: number of CPUs, up to 8.
+    contents: bool
+        if False, files are not read: their modification time is recorded
+        instead of their hash, which is much faster for large trees.
+
+    Returns
+    -------
+    manifest: dict
+        dictionary whose keys are paths relative to ``path`` and values are
+        ``{"size": n, "hash": h}`` (or ``{"size": n, "mtime_ns": t}``) for
+        files, ``{"link": target}`` for
+        symlinks and ``{"dir": True}`` for directories.
+    '''
+    import fnmatch
+    from concurrent.futures import ThreadPoolExecutor
+
+    def excluded(name):
+        return any(fnmatch.fnmatch(name, p) for p in exclude or ())
+
+    manifest = {}
+    files = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames[:] = [d for d in dirnames if not excluded(d)]
+        for name in dirnames + filenames:
+            if excluded(name):
+                continue
+            full = os.path.join(dirpath, name)
+            rel = os.path.relpath(full, path)
+            if os.path.islink(full):
+                manifest[rel] = {'link': os.readlink(full)}
+            elif os.path.isdir(full):
+                manifest[rel] = {'dir': True}
+            else:
+                stat = os.stat(full)
+                manifest[rel] = {'size': stat.st_size}
+                if contents:
+                    files.append(rel)
+                else:
+                    manifest[rel]['mtime_ns'] = stat.st_mtime_ns
+    if workers is None:
+        workers = min(os.cpu_count() or 1, 8)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        digests = executor.map(
+            lambda rel: _file_digest(os.path.join(path, rel), algorithm),
+            files)
+        for rel, digest in zip(files, digests):
+            manifest[rel]['hash'] = digest
+    return manifest
+
+
+def manifest_fingerprint(manifest, algorithm='sha256'):
+    '''
+    Return a digest identifying the contents described by a manifest (see
+    :func:`directory_manifest`).
+    '''
+    return hashlib.new(algorithm, json.dumps(
+        manifest, sort_keys=True).encode('utf-8')).hexdigest()
+
+
 def check_hash(path, md5_file):
     if os.path.isfile(path):
         hashsum = file_hash(path)
@@ -23,3 +386,19 @@ def check_hash(path, md5_file):
         hashsum = path
     recorded_hash = open(md5_file).read().strip().split()[0]
     return hashsum == recorded_hash
+
+
+if __name__ == '__main__':
+    # Benchmark: compare file_hash and tree_hash throughputs on a file
+    # given on the command line (the cache is not used).
+    path = sys.argv[1]
+    size = os.stat(path).st_size
+    for name, func in (('file_hash (md5)',
+                        lambda: file_hash(path, cache=False)),
+                       ('tree_hash (sha256)',
+                        lambda: tree_hash(path, cache=False))):
+        start = time.time()
+        func()
+        duration = time.time() - start
+        print('%-20s %8.2fs  %8.1f MB/s'
+              % (name, duration, size / duration / 2**20))
@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+'''
+Connection pooling HTTP client.
+
+Opening a connection (and doing a TLS handshake) for each small request
+dominates the time spent fetching metadata files (images JSON files,
+directory listings, patches...). :class:`HTTPSession` keeps connections
+alive and reuses them for requests to the same host, bounds the number of
+concurrent connections per host, and retries requests which fail because a
+kept-alive connection has been closed by the server.
+
+Responses behave like the ones of ``urlopen``: they have ``read()``,
+``getcode()``, ``info()``, ``getheader()`` and ``close()`` methods and a
+``headers`` attribute, and HTTP errors raise an ``HTTPError`` exception.
+'''
+from __future__ import absolute_import, division, print_function
+
+import io
+import socket
+import threading
+import time
+
+try:
+    # Python 3 imports
+    import http.client as http_client
+    from urllib.error import HTTPError
+    from urllib.parse import urljoin, urlsplit
+    from urllib.request import (urlopen, Request, getproxies,
+                                proxy_bypass)
+except ImportError:
+    # Python 2 imports
+    import httplib as http_client
+    from urllib2 import HTTPError, urlopen, Request
+    from urlparse import urljoin, urlsplit
+    from urllib import getproxies, proxy_bypass
+
+
+# Maximum number of simultaneous connections to a given host
+default_max_connections = 8
+
+# Number of times a request failing on a connection error is retried
+default_retries = 2
+
+_redirect_codes = (301, 302, 303, 307, 308)
+
+
+class HTTPResponse(object):
+    '''
+    Response of a :class:`HTTPSession` request. The connection is given
+    back to the session pool when the body has been entirely read, or
+    closed if the response is closed before.
+    '''
+
+    def __init__(self, session, key, connection, response, url):
+        self._session = session
+        self._key = key
+        self._connection = connection
+        self._response = response
+        self.url = url
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.msg
+        if response.isclosed():
+            self._release()
+
+    def _release(self, reuse=True):
+        if self._connection is not None:
+            reuse = reuse and not self._response.will_close
+            self._session._release(self._key, self._connection, reuse)
+            self._connection = None
+
+    def read(self, amt=None):
+        try:
+            data = self._response.read(amt)
+        except Exception:
+            self._release(reuse=False)
+            raise
+        if self._response.isclosed():
+            self._release()
+        return data
+
+    def close(self):
+        if self._connection is not None:
+            # the body has not been read: the connection cannot be reused
+            self._response.close()
+            self._release(reuse=False)
+
+    def getcode(self):
+        return self.status
+
+    def info(self):
+        return self.headers
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+    def geturl(self):
+        return self.url
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class HTTPSession(object):
+    '''
+    Pool of kept-alive HTTP(S) connections.
+
+    Parameters
+    ----------
+    max_connections: int
+        maximum number of simultaneous connections to a host. Requests
+        exceeding it wait for a connection to be released.
+    retries: int
+        number of times a request is retried when the connection fails
+        before a response is received (typically because the server has
+        closed an idle connection).
+    timeout: float
+        default timeout (in seconds) of connections.
+    '''
+
+    def __init__(self, max_connections=default_max_connections,
+                 retries=default_retries, timeout=30.):
+        self.max_connections = max_connections
+        self.retries = retries
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._slots = {}
+
+    def _acquire(self, key, timeout):
+        with self._lock:
+            slots = self._slots.get(key)
+            if slots is None:
+                slots = threading.BoundedSemaphore(self.max_connections)
+                self._slots[key] = slots
+        slots.acquire()
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                connection = idle.pop()
+                connection.timeout = timeout
+                return connection, True
+        scheme, host, port = key
+        if scheme == 'https':
+            connection = http_client.HTTPSConnection(host, port,
+                                                     timeout=timeout)
+        else:
+            connection = http_client.HTTPConnection(host, port,
+                                                    timeout=timeout)
+        return connection, False
+
+    def _release(self, key, connection, reuse):
+        if reuse:
+            with self._lock:
+                self._idle.setdefault(key, []).append(connection)
+        else:
+            connection.close()
+        self._slots[key].release()
+
+    def close(self):
+        ''' Close idle connections '''
+        with self._lock:
+            idle = self._idle
+            self._idle = {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def request(self, url, method='GET', headers=None, timeout=None,
+                max_redirects=5):
+        '''
+        Send a request and return a :class:`HTTPResponse` once the
+        response headers are received. Redirections are followed. An
+        ``HTTPError`` is raised for other non-2xx responses, as ``urlopen``
+        does.
+
+        Requests going through a proxy (as configured by the environment)
+        are delegated to ``urlopen``.
+        '''
+        if timeout is None:
+            timeout = self.timeout
+        headers = dict(headers or {})
+        for redirect in range(max_redirects + 1):
+            parts = urlsplit(url)
+            if parts.scheme not in ('http', 'https') \
+                    or _use_proxy(parts.scheme, parts.hostname):
+                if method == 'GET':
+                    request = Request(url, headers=headers)
+                else:
+                    request = Request(url, headers=headers, method=method)
+                return urlopen(request, timeout=timeout)
+            key = (parts.scheme, parts.hostname, parts.port)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            response = self._send(key, method, path, headers, timeout, url)
+            status = response.status
+            if status in _redirect_codes and response.getheader('Location'):
+                response.read()
+                url = urljoin(url, response.getheader('Location'))
+                if status == 303:
+                    method = 'GET'
+                continue
+            if status >= 300:
+                body = response.read()
+                raise HTTPError(url, status, response.reason,
+                                response.headers, io.BytesIO(body))
+            return response
+        raise HTTPError(url, status, 'Too many redirections',
+                        response.headers, None)
+
+    def _send(self, key, method, path, headers, timeout, url):
+        attempt = 0
+        while True:
+            connection, reused = self._acquire(key, timeout)
+            try:
+                if connection.sock is not None:
+                    connection.sock.settimeout(timeout)
+                connection.request(method, path, headers=headers)
+                response = connection.getresponse()
+            except socket.timeout:
+                self._release(key, connection, False)
+                raise
+            except (http_client.HTTPException, socket.error, OSError):
+                self._release(key, connection, False)
+                if attempt >= self.retries:
+                    raise
+                if not reused:
+                    # a fresh connection failed: wait a bit before retrying
+                    time.sleep(0.2 * 2 ** attempt)
+                attempt += 1
+                continue
+            return HTTPResponse(self, key, connection, response, url)
+
+    def get(self, url, headers=None, timeout=None):
+        ''' GET request, see :meth:`request` '''
+        return self.request(url, headers=headers, timeout=timeout)
+
+    def fetch_all(self, urls, method='GET', headers=None, timeout=None,
+                  workers=None, return_exceptions=False):
+        '''
+        Send concurrent requests to a list of URLs and read their bodies.
+
+        The concurrency is bounded by ``workers`` (default: the session
+        ``max_connections``).
+
+        Returns
+        -------
+        results: list
+            ``(response, data)`` tuples in the order of ``urls``. If
+            ``return_exceptions`` is True, failed requests give the raised
+            exception instead of a tuple, otherwise the first error is
+            raised.
+        '''
+        from concurrent.futures import ThreadPoolExecutor
+
+        def fetch(url):
+            try:
+                with self.request(url, method=method, headers=headers,
+                                  timeout=timeout) as response:
+                    return response, response.read()
+            except Exception as e:
+                if return_exceptions:
+                    return e
+                raise
+
+        if workers is None:
+            workers = self.max_connections
+        urls = list(urls)
+        if not urls:
+            return []
+        with ThreadPoolExecutor(max_workers=min(workers, len(urls))) \
+                as executor:
+            return list(executor.map(fetch, urls))
+
+
+def _use_proxy(scheme, host):
+    proxies = getproxies()
+    return scheme in proxies and not proxy_bypass(host)
+
+
+_default_session = None
+_default_session_lock = threading.Lock()
+
+
+def default_session():
+    '''
+    Return the :class:`HTTPSession` shared by casa_distro modules in the
+    current process.
+    '''
+    global _default_session
+
+    with _default_session_lock:
+        if _default_session is None:
+            _default_session = HTTPSession()
+        return _default_session
+
+
+if __name__ == '__main__':
+    # Benchmark: fetch small files from a local server which adds an
+    # artificial latency to each new connection (as a TLS handshake would
+    # do) and to each request, with urlopen and with a session.
+    import shutil
+    import sys
+    import tempfile
+    from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+    latency = float(sys.argv[1]) if len(sys.argv) > 1 else 0.05
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    directory = tempfile.mkdtemp()
+
+    class Handler(SimpleHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def __init__(self, *args, **kwargs):
+            kwargs['directory'] = directory
+            SimpleHTTPRequestHandler.__init__(self, *args, **kwargs)
+
+        def setup(self):
+            time.sleep(latency)
+            SimpleHTTPRequestHandler.setup(self)
+
+        def send_head(self):
+            time.sleep(latency / 2)
+            return SimpleHTTPRequestHandler.send_head(self)
+
+        def log_message(self, *args):
+            pass
+
+    try:
+        for i in range(count):
+            with open('%s/%d.json' % (directory, i), 'w') as f:
+                f.write('{"image_id": "%d"}' % i)
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        urls = ['http://127.0.0.1:%d/%d.json' % (server.server_address[1], i)
+                for i in range(count)]
+
+        def with_urlopen():
+            for url in urls:
+                urlopen(url).read()
+
+        def with_session():
+            session = HTTPSession()
+            for url in urls:
+                session.get(url).read()
+
+        def with_fetch_all():
+            HTTPSession().fetch_all(urls)
+
+        for name, func in (('urlopen', with_urlopen),
+                           ('session', with_session),
+                           ('session.fetch_all', with_fetch_all)):
+            start = time.time()
+            func()
+            print('%-20s %6.2fs' % (name, time.time() - start))
+        server.shutdown()
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+'''
+Persistent container instances.
+
+Starting a container mounts the image and sets up namespaces each time,
+which dominates the duration of short commands run in scripts. In instance
+mode, a container instance is started once for an environment with
+``apptainer instance start``, and commands are run in it with
+``apptainer run instance://<name>``. The instance is stopped by a watchdog
+process when it has not been used for ``instance_timeout`` seconds.
+
+Instance mode is enabled by the ``instance`` item of the environment (or
+user) configuration, or by the ``CASA_DISTRO_INSTANCE`` environment
+variable (``yes`` / ``no``), which has priority. A single instance is
+started for an environment: commands needing other mounts or container
+options than the running instance are run in a new container, as without
+instance mode.
+
+The state of an instance is stored in a directory of
+:func:`instances_directory`, which is also mounted in the container as
+``/casa/instance`` to pass X authority files to commands.
+'''
+from __future__ import absolute_import, division, print_function
+
+import errno
+import hashlib
+import json
+import os
+import os.path as osp
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from casa_distro.log import boolean_value
+from casa_distro import budget
+from casa_distro import run_stats
+from casa_distro import trace
+
+
+default_instance_timeout = 600.
+
+instance_prefix = 'casa-distro-'
+
+
+def instances_directory():
+    '''
+    Return the directory where the state of instances is stored:
+    $XDG_RUNTIME_DIR/casa-distro/instances, or a casa-distro-<uid>
+    directory of the temporary directory if XDG_RUNTIME_DIR is not set.
+    '''
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return osp.join(runtime_dir, 'casa-distro', 'instances')
+    return osp.join(tempfile.gettempdir(), 'casa-distro-%d' % os.getuid(),
+                    'instances')
+
+
+def instance_settings(config):
+    '''
+    Return the instance mode settings of an environment configuration, as
+    a dictionary with the "name" of its instance and the idle "timeout",
+    or None if instance mode is not enabled.
+    '''
+    enabled = boolean_value(os.environ.get('CASA_DISTRO_INSTANCE', ''))
+    if enabled is None:
+        enabled = boolean_value(config.get('instance', False))
+    if not enabled or fcntl is None:
+        return None
+    directory = osp.normpath(osp.abspath(config['directory']))
+    return {'name': '%s%s-%s' % (instance_prefix,
+                                 config.get('name', 'env'),
+                                 hashlib.sha1(directory.encode('utf8'))
+                                 .hexdigest()[:8]),
+            'timeout': float(config.get('instance_timeout',
+                                        default_instance_timeout))}
+
+
+def _split_options(argv):
+    '''
+    Split the options of a "singularity run" command line into options for
+    "instance start" and options for "run instance://".
+    '''
+    start_options = []
+    run_options = ['--cleanenv']
+    options = iter(argv[2:])
+    for option in options:
+        if option == '--pwd':
+            run_options += [option, next(options)]
+        elif option != '--cleanenv':
+            start_options.append(option)
+    return start_options, run_options
+
+
+def _pid_alive(pid):
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        # EPERM: the process exists but belongs to another user
+        return e.errno == errno.EPERM
+    return True
+
+
+def _read_state(state_dir):
+    try:
+        with open(osp.join(state_dir, 'instance.json')) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _instance_pid(executable, name):
+    try:
+        output = subprocess.check_output(
+            [executable, 'instance', 'list', '--json', name],
+            universal_newlines=True)
+        for instance in json.loads(output).get('instances', []):
+            if instance.get('instance') == name:
+                return instance.get('pid')
+    except (OSError, subprocess.CalledProcessError, ValueError):
+        pass
+    return None
+
+
+def _start_instance(plan, settings, key, state_dir, start_options, verbose):
+    executable = plan['argv'][0]
+    name = settings['name']
+    if osp.exists(osp.join(state_dir, 'instance.json')):
+        # the instance has died: clean its state
+        subprocess.call([executable, 'instance', 'stop', name],
+                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        os.unlink(osp.join(state_dir, 'instance.json'))
+    options = start_options + ['--bind', '%s:/casa/instance' % state_dir]
+    if plan.get('init_script'):
+        scripts_dir = osp.join(state_dir, 'start_scripts')
+        if not osp.isdir(scripts_dir):
+            os.mkdir(scripts_dir)
+        with open(osp.join(scripts_dir, 'init.sh'), 'w') as f:
+            print('#!/bin/bash\n', file=f)
+            for line in plan['init_script']:
+                print(line, file=f)
+        options += ['--bind', '%s:/casa/start_scripts' % scripts_dir]
+    cmd = [executable, 'instance', 'start'] + options + [plan['image'], name]
+    if verbose:
+        print('Starting container instance:', *("'%s'" % i for i in cmd),
+              file=verbose)
+        verbose.flush()
+    if subprocess.call(cmd) != 0:
+        return False
+    state = {'name': name,
+             'pid': _instance_pid(executable, name),
+             'key': key,
+             'executable': executable,
+             'image': plan['image'],
+             'directory': plan['config'].get('directory'),
+             'timeout': settings['timeout'],
+             'started': time.time()}
+    with open(osp.join(state_dir, 'instance.json'), 'w') as f:
+        json.dump(state, f)
+    _touch(osp.join(state_dir, 'last_used'))
+
+    # start the watchdog which stops the instance when it is idle
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [osp.dirname(osp.dirname(osp.abspath(__file__)))]
+        + [p for p in env.get('PYTHONPATH', '').split(os.pathsep) if p])
+    with open(os.devnull, 'r+') as devnull:
+        subprocess.Popen([sys.executable, '-m', 'casa_distro.instances',
+                          'watch', state_dir],
+                         env=env, stdin=devnull, stdout=devnull,
+                         stderr=devnull, close_fds=True,
+                         start_new_session=True)
+    return True
+
+
+def _touch(path):
+    with open(path, 'a'):
+        os.utime(path, None)
+
+
+def execute_in_instance(plan, command, env_for_singularity, envvar_prefix,
+                        verbose):
+    '''
+    Run a command in the instance of the environment of a launch plan (see
+    :func:`casa_distro.singularity.launch_plan`), starting the instance if
+    it is not running.
+
+    Returns
+    -------
+    retval: int or None
+        exit code of the command, or None if the command cannot be run in
+        the instance (the instance runs with other options, or cannot be
+        started). The command should then be run in a new container.
+    '''
+    settings = plan.get('instance')
+    if not settings or plan['argv'][0] == 'sudo':
+        return None
+    start_options, run_options = _split_options(plan['argv'])
+    key = hashlib.sha1(json.dumps(
+        [start_options, plan['image'], plan.get('init_script')],
+        sort_keys=True).encode('utf8')).hexdigest()
+    state_dir = osp.join(instances_directory(), settings['name'])
+    if not osp.isdir(state_dir):
+        os.makedirs(state_dir, 0o700)
+
+    start_lock = open(osp.join(state_dir, 'start.lock'), 'a')
+    active_lock = open(osp.join(state_dir, 'active.lock'), 'a')
+    temps = []
+    try:
+        fcntl.flock(start_lock, fcntl.LOCK_EX)
+        try:
+            state = _read_state(state_dir)
+            if state is not None and _pid_alive(state.get('pid')):
+                if state.get('key') != key:
+                    if verbose:
+                        print('Container instance %s runs with other '
+                              'options: not using it.' % settings['name'],
+                              file=verbose)
+                    return None
+            else:
+                with trace.span('instance start') as span_args:
+                    span_args['started'] = _start_instance(
+                        plan, settings, key, state_dir, start_options,
+                        verbose)
+                if not span_args['started']:
+                    if verbose:
+                        print('Container instance %s cannot be started.'
+                              % settings['name'], file=verbose)
+                    return None
+            # prevent the watchdog from stopping the instance while it is
+            # used
+            fcntl.flock(active_lock, fcntl.LOCK_SH)
+            _touch(osp.join(state_dir, 'last_used'))
+        finally:
+            fcntl.flock(start_lock, fcntl.LOCK_UN)
+
+        env = dict(env_for_singularity)
+        prefix = envvar_prefix + 'ENV_'
+        if plan.get('xauthority') and os.environ.get('DISPLAY'):
+            xauthority = 'Xauthority-%d' % os.getpid()
+            temps.append(osp.join(state_dir, xauthority))
+            retcode = subprocess.call(['xauth', 'extract', temps[-1],
+                                       os.environ['DISPLAY']], bufsize=-1)
+            if retcode == 0:
+                env[prefix + 'XAUTHORITY'] = '/casa/instance/' + xauthority
+                env[prefix + 'DISPLAY'] = os.environ['DISPLAY']
+
+        cmd = ([plan['argv'][0], 'run'] + run_options
+               + ['instance://' + settings['name']] + command)
+        if verbose:
+            print('Running in container instance:',
+                  *("'%s'" % i for i in cmd), file=verbose)
+            verbose.flush()
+        retval = 127
+        try:
+            with trace.span('container command', command=command,
+                            instance=settings['name']) as span_args:
+                start = time.time()
+                retval, rusage = run_stats.call(
+                    cmd, env=env, preexec_fn=budget.affinity_setter(
+                        plan.get('cpu_affinity')))
+                run_stats.record_run(plan, command, start, time.time(),
+                                     retval, rusage)
+                span_args['exit_code'] = retval
+        except KeyboardInterrupt:
+            pass  # avoid displaying a stack trace
+        _touch(osp.join(state_dir, 'last_used'))
+        return retval
+    finally:
+        for temp in temps:
+            if osp.exists(temp):
+                os.unlink(temp)
+        active_lock.close()
+        start_lock.close()
+
+
+def list_instances():
+    '''
+    Return the states of instances, as dictionaries with the keys "name",
+    "pid", "image", "directory" (of the environment), "timeout",
+    "started", "last_used" and "running".
+    '''
+    result = []
+    directory = instances_directory()
+    if not osp.isdir(directory):
+        return result
+    for name in sorted(os.listdir(directory)):
+        state_dir = osp.join(directory, name)
+        state = _read_state(state_dir)
+        if state is None:
+            continue
+        try:
+            state['last_used'] = os.stat(
+                osp.join(state_dir, 'last_used')).st_mtime
+        except OSError:
+            state['last_used'] = state.get('started')
+        state['running'] = _pid_alive(state.get('pid'))
+        result.append(state)
+    return result
+
+
+def stop_instance(name):
+    '''
+    Stop an instance and remove its state directory. Return the exit code
+    of the "instance stop" command.
+    '''
+    state_dir = osp.join(instances_directory(), name)
+    state = _read_state(state_dir) or {}
+    retval = 0
+    if _pid_alive(state.get('pid')):
+        retval = subprocess.call([state['executable'], 'instance', 'stop',
+                                  name])
+    shutil.rmtree(state_dir, ignore_errors=True)
+    return retval
+
+
+def watch_instance(state_dir, check_interval=None):
+    '''
+    Stop an instance when it has not been used during its timeout, or when
+    no command runs in it. This is the main loop of the watchdog process
+    started with the instance.
+    '''
+    state = _read_state(state_dir)
+    if state is None:
+        return
+    timeout = state['timeout']
+    if check_interval is None:
+        check_interval = min(max(timeout / 10., 1.), 30.)
+    while True:
+        time.sleep(check_interval)
+        state = _read_state(state_dir)
+        if state is None or not _pid_alive(state.get('pid')):
+            # the instance has been stopped
+            return
+        with open(osp.join(state_dir, 'start.lock'), 'a') as start_lock:
+            fcntl.flock(start_lock, fcntl.LOCK_EX)
+            with open(osp.join(state_dir, 'active.lock'), 'a') as active:
+                try:
+                    fcntl.flock(active, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except (IOError, OSError):
+                    continue  # commands are running
+                try:
+                    last_used = os.stat(
+                        osp.join(state_dir, 'last_used')).st_mtime
+                except OSError:
+                    last_used = 0
+                if time.time() - last_used >= timeout:
+                    stop_instance(state['name'])
+                    return
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == 'watch':
+        watch_instance(sys.argv[2])
+    else:
+        sys.exit('usage: python -m casa_distro.instances watch <state_dir>')
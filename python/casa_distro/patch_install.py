@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
-from casa_distro.web import url_listdir, urlopen
+from casa_distro.web import url_listdir
+from casa_distro.http_session import default_session
 import os
 import os.path as osp
 import urllib
@@ -35,77 +36,85 @@ def get_distro_version():
     return version
 
 
+def _list_files(todo):
+    '''
+    Expand the directories (URLs ending with "/") of a list of URLs into
+    the files they contain, recursively.
+    '''
+    files = []
+    while todo:
+        item = todo.pop(0)
+        if item.endswith('/'):  # directory
+            todo += ['%s%s' % (item, urllib.parse.quote(fname))
+                     for fname in url_listdir(item)]
+        else:
+            files.append(item)
+    return files
+
+
+def _outdated_files(url, files, install_dir):
+    '''
+    Get the modification time of remote files (using concurrent HEAD
+    requests), and return ``(item, install_fname, time)`` for those which
+    are more recent than their installed version.
+    '''
+    outdated = []
+    responses = default_session().fetch_all(files, method='HEAD')
+    for item, (resp, _) in zip(files, responses):
+        rel_fname = urllib.parse.unquote(item[len(url):])
+        install_fname = install_dir + rel_fname
+        dt = tparser.parse(resp.getheader('Last-Modified'))
+        t = dt.timestamp()
+        if osp.exists(install_fname):
+            d = os.stat(install_fname).st_mtime
+            if d >= t:
+                # up to date
+                continue
+        outdated.append((item, install_fname, t))
+    return outdated
+
+
 def list_updates(patches_url='https://brainvisa.info/download/updates',
                  version=None, install_dir='/casa/host/install'):
     if version is None:
         version = get_distro_version()
     url = '%s/%s' % (patches_url, version)
-    done = []
     try:
         todo = ['%s/%s' % (url, urllib.parse.quote(fname))
                 for fname in url_listdir(url)]
     except urllib.error.HTTPError:
         return  # no patches for this version
-    while todo:
-        item = todo.pop(0)
-        if item.endswith('/'):  # directory
-            todo += ['%s%s' % (item, urllib.parse.quote(fname))
-                     for fname in url_listdir(item)]
-        else:
-            rel_fname = urllib.parse.unquote(item[len(url):])
-            install_fname = install_dir + rel_fname
-            resp = urlopen(item)
-            dt = tparser.parse(resp.getheader('Last-Modified'))
-            t = dt.timestamp()
-            if osp.exists(install_fname):
-                d = os.stat(install_fname).st_mtime
-                if d >= t:
-                    # up to date
-                    continue
-            done.append(install_fname)
-    return done
+    files = _list_files(todo)
+    return [install_fname for item, install_fname, t
+            in _outdated_files(url, files, install_dir)]
 
 
 def patch_files(url, todo, install_dir):
     done = []
-    while todo:
-        item = todo.pop(0)
-        if item.endswith('/'):  # directory
-            todo += ['%s%s' % (item, urllib.parse.quote(fname))
-                     for fname in url_listdir(item)]
-        else:
-            # print('download:', item)
-            rel_fname = urllib.parse.unquote(item[len(url):])
-            install_fname = install_dir + rel_fname
-            # print('install to:', install_fname)
-            resp = urlopen(item)
-            dt = tparser.parse(resp.getheader('Last-Modified'))
-            t = dt.timestamp()
-            if osp.exists(install_fname):
-                d = os.stat(install_fname).st_mtime
-                if d >= t:
-                    # up to date
-                    # print('up to date')
-                    continue
-            print('download:', item, 'to:', install_fname)
-            file_content = resp.read()
-            if not osp.exists(osp.dirname(install_fname)):
-                # print('mkdir', osp.dirname(install_fname))
-                os.makedirs(osp.dirname(install_fname))
-            with open(install_fname, 'wb') as f:
-                f.write(file_content)
-            if rel_fname.startswith('bin') or rel_fname.startswith('cbin'):
-                # execution flag
-                os.cmod(install_fname,
-                        stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
-            # set timestamp
-            os.utime(install_fname, (t, t))
-            # can we get the +x status from request ?
-            mod = stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH
-            if item.startswith('%s/bin/' % url):
-                mod |= stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH
-            os.chmod(install_fname, mod)
-            done.append(install_fname)
+    files = _list_files(todo)
+    outdated = _outdated_files(url, files, install_dir)
+    responses = default_session().fetch_all([o[0] for o in outdated])
+    for (item, install_fname, t), (resp, file_content) \
+            in zip(outdated, responses):
+        rel_fname = urllib.parse.unquote(item[len(url):])
+        print('download:', item, 'to:', install_fname)
+        if not osp.exists(osp.dirname(install_fname)):
+            # print('mkdir', osp.dirname(install_fname))
+            os.makedirs(osp.dirname(install_fname))
+        with open(install_fname, 'wb') as f:
+            f.write(file_content)
+        if rel_fname.startswith('bin') or rel_fname.startswith('cbin'):
+            # execution flag
+            os.cmod(install_fname,
+                    stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+        # set timestamp
+        os.utime(install_fname, (t, t))
+        # can we get the +x status from request ?
+        mod = stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH
+        if item.startswith('%s/bin/' % url):
+            mod |= stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH
+        os.chmod(install_fname, mod)
+        done.append(install_fname)
     return done
 
 
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+'''
+Resource accounting of commands run in containers.
+
+Each command run in a container is recorded in an append-only JSON lines
+log of its environment (see :func:`run_log_file`) with its wall time, user
+and system CPU times and maximum resident set size, as returned by
+``os.wait4``, along with the command, the environment name and the image.
+The log is summarized by the ``casa_distro stats`` command (see
+:func:`summarize`), in order to spot performance regressions between image
+versions.
+'''
+from __future__ import absolute_import, division, print_function
+
+import json
+import os
+import os.path as osp
+import subprocess
+
+from casa_distro.log import boolean_value
+
+
+run_log_basename = 'runs.jsonl'
+
+
+def run_log_file(container_home):
+    '''
+    Return the run log of the environment whose container home directory is
+    given. It is stored next to the home directory: in the environment
+    directory, or in $XDG_DATA_HOME/casa-distro/<environment> for read-only
+    environments.
+    '''
+    return osp.join(osp.dirname(container_home), run_log_basename)
+
+
+def _exit_code(status):
+    # same convention as subprocess: negative signal number if the process
+    # has been killed
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def call(cmd, env=None, **kwargs):
+    '''
+    Run a command as :func:`subprocess.call` does and return its exit code
+    along with its resource usage (as returned by ``os.wait4``), or None if
+    it cannot be measured on this system. Keyword arguments are passed to
+    :class:`subprocess.Popen`.
+    '''
+    if not hasattr(os, 'wait4'):
+        return subprocess.call(cmd, env=env, **kwargs), None
+    process = subprocess.Popen(cmd, env=env, **kwargs)
+    try:
+        pid, status, rusage = os.wait4(process.pid, 0)
+    except BaseException:
+        process.kill()
+        process.wait()
+        raise
+    process.returncode = _exit_code(status)
+    return process.returncode, rusage
+
+
+def record_run(plan, command, start, end, exit_code, rusage):
+    '''
+    Append a run of a command to the run log given in a launch plan (see
+    :func:`casa_distro.singularity.launch_plan`). Nothing is recorded if the
+    ``run_log`` item of the environment configuration is false.
+    '''
+    log_file = plan.get('run_log')
+    if not log_file or boolean_value(
+            plan['config'].get('run_log', True)) is False:
+        return
+    run = {'start': start,
+           'command': command,
+           'environment': plan['config'].get('name'),
+           'image': osp.basename(plan['image']),
+           'image_id': plan.get('image_id'),
+           'wall': end - start,
+           'exit_code': exit_code,
+           'instance': bool(plan.get('instance'))}
+    if rusage is not None:
+        run['user'] = rusage.ru_utime
+        run['sys'] = rusage.ru_stime
+        # ru_maxrss is given in KiB on Linux
+        run['max_rss'] = rusage.ru_maxrss * 1024
+    try:
+        fd = os.open(log_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, (json.dumps(run) + '\n').encode('utf-8'))
+        finally:
+            os.close(fd)
+    except OSError:
+        pass  # accounting must not make commands fail
+
+
+def read_runs(log_file):
+    '''
+    Return the list of runs recorded in a run log.
+    '''
+    runs = []
+    if not osp.exists(log_file):
+        return runs
+    with open(log_file) as f:
+        for line in f:
+            try:
+                runs.append(json.loads(line))
+            except ValueError:
+                pass  # truncated line
+    return runs
+
+
+def _program(run):
+    command = run.get('command') or ['<default>']
+    return osp.basename(command[0])
+
+
+def summarize(runs, limit=10):
+    '''
+    Aggregate runs read in a run log.
+
+    Returns
+    -------
+    summary: dict
+        "runs": number of runs, "slowest": the ``limit`` longest runs,
+        "memory": the ``limit`` runs using the most memory, "programs":
+        statistics per program (first word of the command) and "images":
+        statistics per image file, in the order where images have been used.
+        Statistics are dictionaries with the number of "runs" and the
+        "mean_wall", "max_wall", "mean_cpu" and "max_rss" values.
+    '''
+    def statistics(group):
+        cpu = [r['user'] + r['sys'] for r in group if 'user' in r]
+        return {'runs': len(group),
+                'mean_wall': sum(r['wall'] for r in group) / len(group),
+                'max_wall': max(r['wall'] for r in group),
+                'mean_cpu': (sum(cpu) / len(cpu) if cpu else None),
+                'max_rss': max(r.get('max_rss', 0) for r in group)}
+
+    programs = {}
+    images = {}
+    for run in runs:
+        programs.setdefault(_program(run), []).append(run)
+        images.setdefault(run.get('image'), []).append(run)
+    order = sorted(images, key=lambda i: min(r['start'] for r in images[i]))
+    return {
+        'runs': len(runs),
+        'slowest': sorted(runs, key=lambda r: r['wall'],
+                          reverse=True)[:limit],
+        'memory': sorted((r for r in runs if 'max_rss' in r),
+                         key=lambda r: r['max_rss'], reverse=True)[:limit],
+        'programs': {p: statistics(g) for p, g in programs.items()},
+        'images': [(i, images[i][-1].get('image_id'), statistics(images[i]))
+                   for i in order],
+    }
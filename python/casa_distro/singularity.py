@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import hashlib
 import json
 import locale
 import os
@@ -9,11 +10,16 @@
 import shutil
 import subprocess
 import tempfile
+import time
 import getpass
 import uuid
 import shlex
 
 from . import six
+from . import budget
+from . import instances
+from . import run_stats
+from . import trace
 from .log import boolean_value
 from casa_distro.defaults import default_base_directory
 from .thirdparty import install_thirdparty_software
@@ -36,11 +42,17 @@ class RecipeBuilder:
     symlinks.
     '''
 
-    def __init__(self, name):
+    def __init__(self, name, package_cache=None):
         self.name = name
         self.tmp_dir = None
         self.user = None
         self.sections = {}
+        # host directory of apt and pip caches mounted during the build
+        # (see package_cache_sections)
+        self.package_cache = package_cache
+        # host files and directories copied in the image, used to
+        # fingerprint build steps (see create_image)
+        self.inputs = []
         # identify image/build with a unique identifier
         self.image_id = str(uuid.uuid4())
 
@@ -78,6 +90,7 @@ def copy_root(self, source_file, dest_dir, preserve_symlinks=True,
             the source tree. Otherwise replace them with the pointed file.
             The ``rsync`` command is used to perform this.
         '''
+        self.inputs.append(source_file)
         if not preserve_symlinks:
             # this variant is safer
             # the files section copies do not preserve symlinks.
@@ -117,6 +130,7 @@ def extract_tar(self, source_file, dest_dir):
         -------
         list of root files / directories
         '''
+        self.inputs.append(source_file)
         self.sections.setdefault('setup', []).append(
             'if [ ! -d ${SINGULARITY_ROOTFS}/' + dest_dir + ' ]; then '
             'mkdir -p ${SINGULARITY_ROOTFS}/' + dest_dir + '; fi')
@@ -155,6 +169,7 @@ def copy_user(self, source_file, dest_dir, preserve_symlinks=True,
             the source tree. Otherwise replace them with the pointed file.
             The ``rsync`` command is used to perform this.
         '''
+        self.inputs.append(source_file)
         if not preserve_symlinks:
             # this variant is safer
             # the files section copies do not preserve symlinks.
@@ -183,8 +198,28 @@ def environment(self, environment_dict):
                 'export {}="{}"'.format(variable, value)
             )
 
+    def package_cache_sections(self):
+        '''
+        Recipe lines making apt and pip use the package cache mounted on
+        :data:`package_cache_mount` during the build. They are written
+        before the lines of the build steps. The cache is not part of the
+        image: only the empty mount point remains.
+        '''
+        if not self.package_cache:
+            return {}
+        return {
+            'setup': ['mkdir -p ${SINGULARITY_ROOTFS}%s'
+                      % package_cache_mount],
+            'post': ['export CASA_BUILD_CACHE=%s' % package_cache_mount,
+                     'export APT_CONFIG=%s/apt.conf' % package_cache_mount,
+                     'export PIP_CACHE_DIR=%s/pip' % package_cache_mount],
+        }
+
     def write(self, file):
+        sections = self.package_cache_sections()
         for section, lines in self.sections.items():
+            sections[section] = sections.get(section, []) + lines
+        for section, lines in sections.items():
             print('\n%%%s' % section, file=file)
             for line in lines:
                 print('   ', line, file=file)
@@ -198,7 +233,98 @@ def install_casa_distro(self, dest):
                        "-o -name '*~' -exec rm -Rf '{}' \\;") % dest)
 
 
-def _singularity_build_command(cleanup=True, force=False, fakeroot=True):
+# Mount point of the package cache during image builds
+package_cache_mount = '/casa-build-cache'
+
+
+def default_package_cache_directory():
+    '''
+    Return the default host directory of the apt and pip caches used during
+    image builds: $XDG_CACHE_HOME/casa-distro/packages
+    (~/.cache/casa-distro/packages by default).
+    '''
+    xdg_cache_home = os.environ.get('XDG_CACHE_HOME', '')
+    if not xdg_cache_home:
+        xdg_cache_home = osp.expanduser('~/.cache')
+    return osp.join(xdg_cache_home, 'casa-distro', 'packages')
+
+
+def prepare_package_cache(package_cache):
+    '''
+    Create the directories of a package cache and the apt configuration
+    which keeps downloaded packages in it. APT_CONFIG is read in addition
+    to the configuration of the image, and the "docker-clean" hook of
+    Ubuntu images only empties /var/cache/apt/archives.
+    '''
+    for d in ('apt/archives/partial', 'pip'):
+        if not osp.isdir(osp.join(package_cache, d)):
+            os.makedirs(osp.join(package_cache, d))
+    with open(osp.join(package_cache, 'apt.conf'), 'w') as f:
+        f.write('Dir::Cache::archives "%s/apt/archives";\n'
+                'APT::Keep-Downloaded-Packages "true";\n'
+                'Binary::apt::APT::Keep-Downloaded-Packages "true";\n'
+                % package_cache_mount)
+
+
+def package_cache_contents(package_cache):
+    '''
+    Return the files of a package cache, as a dictionary
+    ``{cache: {path: size}}`` where cache is "apt" or "pip".
+    '''
+    contents = {}
+    for cache, directory in (('apt', 'apt/archives'), ('pip', 'pip')):
+        files = contents[cache] = {}
+        root = osp.join(package_cache, directory)
+        for dirpath, dirnames, filenames in os.walk(root):
+            if cache == 'apt':
+                dirnames[:] = []  # skip partial downloads
+            for name in filenames:
+                path = osp.join(dirpath, name)
+                if cache == 'apt' and not name.endswith('.deb'):
+                    continue
+                try:
+                    files[osp.relpath(path, root)] = os.stat(path).st_size
+                except OSError:
+                    pass
+    return contents
+
+
+def package_cache_report(before, after):
+    '''
+    Compare the contents of a package cache before and after a build (see
+    :func:`package_cache_contents`). Files added during the build are cache
+    misses (downloads). Files which were already there could be reused: apt
+    and pip do not tell which ones have actually been used.
+
+    Returns
+    -------
+    report: dict
+        ``{cache: {"cached": n, "cached_bytes": n, "downloaded": n,
+        "downloaded_bytes": n}}``
+    '''
+    report = {}
+    for cache in sorted(after):
+        old = before.get(cache, {})
+        new = dict((path, size) for path, size in after[cache].items()
+                   if path not in old)
+        report[cache] = {'cached': len(old),
+                         'cached_bytes': sum(old.values()),
+                         'downloaded': len(new),
+                         'downloaded_bytes': sum(new.values())}
+    return report
+
+
+def _print_package_cache_report(package_cache, report):
+    print('Package cache (%s):' % package_cache)
+    for cache, stats in sorted(report.items()):
+        print('    %s: %d files in cache before the build (%.1f MiB), '
+              '%d downloaded (%.1f MiB)'
+              % (cache, stats['cached'], stats['cached_bytes'] / 1048576.,
+                 stats['downloaded'], stats['downloaded_bytes'] / 1048576.))
+
+
+def _singularity_build_command(cleanup=True, force=False, fakeroot=True,
+                               package_cache=None):
     build_command = []
     if not fakeroot:
         build_command += ['sudo']
@@ -217,6 +343,9 @@ def _singularity_build_command(cleanup=True, force=False, fakeroot=True):
         build_command.append('--no-cleanup')
     if force:
         build_command.append('--force')
+    if package_cache:
+        build_command += ['--bind', '%s:%s' % (osp.abspath(package_cache),
+                                               package_cache_mount)]
     return build_command
 
 
@@ -226,8 +355,19 @@ def create_image(base, base_metadata,
                  cleanup='yes',
                  force='no',
                  fakeroot='yes',
+                 step_cache='no',
+                 package_cache='no',
                  verbose=None):
     '''
+    If ``step_cache`` is true, each step of the image builder is built as
+    an intermediate image which is kept in a cache (see
+    :func:`create_image_with_step_cache`), so that a new build resumes from
+    the first step which has changed.
+
+    ``package_cache`` is a host directory where apt and pip keep the
+    packages they download, which is mounted during the build. If it is
+    true, :func:`default_package_cache_directory` is used.
+
     Returns
     -------
     uuid, msg: tuple
@@ -242,11 +382,7 @@ def create_image(base, base_metadata,
         image_id = str(uuid.uuid4())
         return (image_id, None)
     else:
-        recipe = tempfile.NamedTemporaryFile(mode='wt')
-        recipe.write('''\
-Bootstrap: localimage
-    From: {base}
-
+        runscript = '''\
 %runscript
     export CASA_SYSTEM='{system}'
     export CASA_TYPE='{type}'
@@ -291,73 +427,333 @@ def create_image(base, base_metadata,
         echo
         echo 'Please visit https://brainvisa.info/ for complete help.'
     fi
-'''.format(base=base,  # noqa: E501
-           system=metadata['system'],
-           type=type))
-
-        installer = RecipeBuilder(output)
-        installer.image_version = metadata['image_version']
-        installer.metadata = metadata
-        for step in image_builder.steps:
-            if verbose:
-                print('Performing:', step.__doc__, file=verbose)
-            step(base_dir=image_builder.build_dir,
-                 builder=installer)
-        installer.write(recipe)
-        if verbose:
-            print('---------- Singularity recipe ----------', file=verbose)
-            print(open(recipe.name).read(), file=verbose)
-            print('----------------------------------------', file=verbose)
-            verbose.flush()
-        build_command = _singularity_build_command(cleanup=cleanup,
-                                                   force=force,
-                                                   fakeroot=fakeroot)
+'''.format(system=metadata['system'],  # noqa: E501
+           type=type)
+
+        if boolean_value(package_cache) is not None:
+            package_cache = (default_package_cache_directory()
+                             if boolean_value(package_cache) else None)
+        if package_cache:
+            prepare_package_cache(package_cache)
+            cache_contents = package_cache_contents(package_cache)
+        build_command = _singularity_build_command(
+            cleanup=cleanup, force=force, fakeroot=fakeroot,
+            package_cache=package_cache)
+        if boolean_value(step_cache):
+            result = create_image_with_step_cache(
+                base, output, metadata, image_builder, runscript,
+                build_command, fakeroot=fakeroot, package_cache=package_cache,
+                verbose=verbose)
+        else:
+            result = _create_image(base, output, metadata, image_builder,
+                                   runscript, build_command,
+                                   fakeroot=fakeroot,
+                                   package_cache=package_cache,
+                                   verbose=verbose)
+        if package_cache:
+            _print_package_cache_report(
+                package_cache,
+                package_cache_report(cache_contents,
+                                     package_cache_contents(package_cache)))
+        return result
+
+
+def _create_image(base, output, metadata, image_builder, runscript,
+                  build_command, fakeroot=True, package_cache=None,
+                  verbose=None):
+    '''
+    Build an image from a single recipe made of all the steps of the image
+    builder.
+    '''
+    recipe = tempfile.NamedTemporaryFile(mode='wt')
+    recipe.write('''\
+Bootstrap: localimage
+    From: {base}
+
+'''.format(base=base))
+    recipe.write(runscript)
+
+    installer = RecipeBuilder(output, package_cache=package_cache)
+    installer.image_version = metadata['image_version']
+    installer.metadata = metadata
+    for step in image_builder.steps:
         if verbose:
-            print('run create command:\n',
-                  *(build_command + [output, recipe.name]))
-        # Set cwd to a directory that root is allowed to 'cd' into, to avoid a
-        # permission issue with --fakeroot and NFS root_squash.
-        try:
-            subprocess.check_call(build_command + [output, recipe.name],
-                                  cwd='/')
-        except Exception:
-            if fakeroot:
-                print('** Image creation has failed **', file=sys.stderr)
-                print('If you see an error message about fakeroot not working '
-                      'on your system, then try the following command (you '
-                      'need sudo permissions):', file=sys.stderr)
-                print('sudo %s config fakeroot --add %s'
-                      % (singularity_name(), getpass.getuser()),
-                      file=sys.stderr)
-                print(file=sys.stderr)
-            raise
+            print('Performing:', step.__doc__, file=verbose)
+        step(base_dir=image_builder.build_dir,
+             builder=installer)
+    installer.write(recipe)
+    if verbose:
+        print('---------- Singularity recipe ----------', file=verbose)
+        print(open(recipe.name).read(), file=verbose)
+        print('----------------------------------------', file=verbose)
+        verbose.flush()
+    _build_recipe(build_command, output, recipe.name, fakeroot, verbose)
 
-        return (installer.image_id, None)
+    return (installer.image_id, None)
 
 
-def create_user_image(base_image,
-                      dev_config,
-                      version,
-                      output,
-                      force='no',
-                      fakeroot='yes',
-                      base_directory=default_base_directory,
-                      verbose=None,
-                      install_thirdparty='all',
-                      cleanup=True):
+def _build_recipe(build_command, output, recipe_file, fakeroot, verbose):
+    if verbose:
+        print('run create command:\n',
+              *(build_command + [output, recipe_file]))
+    # Set cwd to a directory that root is allowed to 'cd' into, to avoid a
+    # permission issue with --fakeroot and NFS root_squash.
+    try:
+        subprocess.check_call(build_command + [output, recipe_file],
+                              cwd='/')
+    except Exception:
+        if fakeroot:
+            print('** Image creation has failed **', file=sys.stderr)
+            print('If you see an error message about fakeroot not working '
+                  'on your system, then try the following command (you '
+                  'need sudo permissions):', file=sys.stderr)
+            print('sudo %s config fakeroot --add %s'
+                  % (singularity_name(), getpass.getuser()),
+                  file=sys.stderr)
+            print(file=sys.stderr)
+        raise
+
+
+def build_step_cache_directory():
+    '''
+    Return the directory where the intermediate images of build steps are
+    kept (see :func:`create_image_with_step_cache`): $CASA_DISTRO_BUILD_CACHE
+    if it is set, otherwise $XDG_CACHE_HOME/casa-distro/build_steps
+    (~/.cache/casa-distro/build_steps by default).
+    '''
+    cache_dir = os.environ.get('CASA_DISTRO_BUILD_CACHE')
+    if cache_dir:
+        return cache_dir
+    xdg_cache_home = os.environ.get('XDG_CACHE_HOME', '')
+    if not xdg_cache_home:
+        xdg_cache_home = osp.expanduser('~/.cache')
+    return osp.join(xdg_cache_home, 'casa-distro', 'build_steps')
+
+
+def _hash_file(path, hasher):
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            hasher.update(chunk)
+
+
+def _hash_input(path, hasher):
+    '''
+    Add the contents of a file or directory copied in an image to a hash.
+    Symlinks found in directories are identified by their target.
+    '''
+    hasher.update(('\0input %s\0' % path).encode('utf-8'))
+    if osp.islink(path):
+        hasher.update(('link %s\0' % os.readlink(path)).encode('utf-8'))
+    if osp.isfile(path):
+        _hash_file(path, hasher)
+    elif osp.isdir(path):
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for name in sorted(dirnames + filenames):
+                full = osp.join(dirpath, name)
+                hasher.update(('\0%s\0' % osp.relpath(full, path))
+                              .encode('utf-8'))
+                if osp.islink(full):
+                    hasher.update(('link %s' % os.readlink(full))
+                                  .encode('utf-8'))
+                elif osp.isfile(full):
+                    _hash_file(full, hasher)
+    else:
+        hasher.update(b'missing')
+
+
+def _step_fingerprint(previous, sections, inputs, image_id):
+    '''
+    Fingerprint of a build step: it depends on the fingerprint of the
+    previous step, on the recipe lines generated by the step and on the
+    contents of the host files it copies. The identifier of the image being
+    built, which changes at each build, is ignored.
+    '''
+    hasher = hashlib.sha256(previous.encode('utf-8'))
+    sections = dict((section, [line.replace(image_id, '{image_id}')
+                               for line in lines])
+                    for section, lines in sections.items())
+    hasher.update(json.dumps(sections, sort_keys=True).encode('utf-8'))
+    for path in inputs:
+        _hash_input(path, hasher)
+    return hasher.hexdigest()
+
+
+def _write_layer_recipe(file, base, sections, environment, runscript=None,
+                        prologue=None):
+    file.write('''\
+Bootstrap: localimage
+    From: {base}
+
+'''.format(base=base))
+    if runscript:
+        file.write(runscript)
+    layer_sections = dict(prologue or {})
+    for section, lines in sections.items():
+        if section != 'environment':
+            layer_sections[section] = layer_sections.get(section, []) + lines
+    sections = layer_sections
+    if environment:
+        # the %environment section of a recipe replaces the one of its base
+        # image
+        sections['environment'] = environment
+    for section, lines in sections.items():
+        if lines:
+            print('\n%%%s' % section, file=file)
+            for line in lines:
+                print('   ', line, file=file)
+    file.flush()
+
+
+def _prune_step_cache(cache_dir, base, build_file, layers):
+    '''
+    Remove the layers of the build step cache which have been superseded:
+    the layers built from the same base image and build file as the given
+    (current) layers, for the same steps, but with other fingerprints.
+    Return the number of removed layers.
     '''
+    current = {}
+    for layer in layers:
+        with open(layer + '.json') as f:
+            current[json.load(f)['step']] = layer
+    removed = 0
+    for name in os.listdir(cache_dir):
+        if not name.endswith('.sif.json'):
+            continue
+        layer = osp.join(cache_dir, name[:-5])
+        try:
+            with open(layer + '.json') as f:
+                layer_metadata = json.load(f)
+        except (IOError, OSError, ValueError):
+            continue
+        step = layer_metadata.get('step')
+        if (layer_metadata.get('base') == base
+                and layer_metadata.get('build_file') == build_file
+                and step in current and current[step] != layer):
+            for path in (layer, layer + '.json'):
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            removed += 1
+    return removed
+
+
+def create_image_with_step_cache(base, output, metadata, image_builder,
+                                 runscript, build_command, fakeroot=True,
+                                 package_cache=None, verbose=None):
+    '''
+    Build an image with one intermediate image (layer) per step of the image
+    builder. Layers are kept in :func:`build_step_cache_directory`, named
+    after the fingerprint of their step, which depends on the previous
+    steps, on the recipe lines of the step and on the contents of the files
+    it copies. The build resumes from the first step which is not in the
+    cache, then the output image is built on top of the last layer. The
+    lines of reused steps which contain the identifier of the image (such as
+    the one writing /casa/image_id) are replayed in this last build.
+
+    Once the image is built, the layers of previous builds of the same
+    build file on the same base image which have been replaced by a
+    modified step (and by the steps following it) are removed from the
+    cache, so that it does not grow at each modification of the recipe.
+
     Returns
     -------
     uuid, msg: tuple
     '''
-    force = boolean_value(force)
-    fakeroot = boolean_value(fakeroot)
-    recipe = tempfile.NamedTemporaryFile(mode='wt')
-    recipe.write('''\
-Bootstrap: localimage
-    From: {base_image}
+    cache_dir = build_step_cache_directory()
+    if not osp.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    installer = RecipeBuilder(output, package_cache=package_cache)
+    installer.image_version = metadata['image_version']
+    installer.metadata = metadata
+
+    base = osp.abspath(base)
+    fingerprint = hashlib.sha256(
+        json.dumps(_image_fingerprint(base),
+                   sort_keys=True).encode('utf-8')).hexdigest()
+    layer = base
+    layers = []
+    replay = {}
+    report = []
+    for step in image_builder.steps:
+        if verbose:
+            print('Performing:', step.__doc__, file=verbose)
+        sizes = dict((s, len(l)) for s, l in installer.sections.items())
+        first_input = len(installer.inputs)
+        step(base_dir=image_builder.build_dir,
+             builder=installer)
+        sections = dict((s, l[sizes.get(s, 0):])
+                        for s, l in installer.sections.items()
+                        if len(l) > sizes.get(s, 0))
+        fingerprint = _step_fingerprint(fingerprint, sections,
+                                        installer.inputs[first_input:],
+                                        installer.image_id)
+        if not set(sections).difference(['environment']):
+            # nothing to do in the image, the environment is set in the
+            # last build
+            report.append((step.__name__, 'no-op'))
+            continue
+        cached = osp.join(cache_dir, fingerprint + '.sif')
+        if osp.exists(cached):
+            report.append((step.__name__, 'reused'))
+            for section, lines in sections.items():
+                lines = [line for line in lines if installer.image_id in line]
+                if lines and section != 'environment':
+                    replay.setdefault(section, []).extend(lines)
+        else:
+            start = time.time()
+            tmp = '%s.%d.tmp' % (cached, os.getpid())
+            with tempfile.NamedTemporaryFile(mode='wt') as recipe:
+                _write_layer_recipe(
+                    recipe, layer, sections,
+                    installer.sections.get('environment'),
+                    prologue=installer.package_cache_sections())
+                try:
+                    _build_recipe(build_command, tmp, recipe.name, fakeroot,
+                                  verbose)
+                except BaseException:
+                    if osp.exists(tmp):
+                        os.unlink(tmp)
+                    raise
+            with open(cached + '.json', 'w') as f:
+                json.dump({'step': step.__name__,
+                           'build_file': image_builder.build_file,
+                           'base': base,
+                           'parent': layer,
+                           'creation_time': time.time()}, f, indent=4)
+            os.rename(tmp, cached)
+            report.append((step.__name__,
+                           'built in %.0f s' % (time.time() - start)))
+        layer = cached
+        layers.append(layer)
+
+    with tempfile.NamedTemporaryFile(mode='wt') as recipe:
+        _write_layer_recipe(recipe, layer, replay,
+                            installer.sections.get('environment'),
+                            runscript=runscript,
+                            prologue=installer.package_cache_sections())
+        if verbose:
+            print('---------- Singularity recipe ----------', file=verbose)
+            print(open(recipe.name).read(), file=verbose)
+            print('----------------------------------------', file=verbose)
+            verbose.flush()
+        _build_recipe(build_command, output, recipe.name, fakeroot, verbose)
 
-%runscript
+    removed = _prune_step_cache(cache_dir, base, image_builder.build_file,
+                                layers)
+    print('Build steps (cache: %s):' % cache_dir)
+    for name, status in report:
+        print('    %s: %s' % (name, status))
+    if removed:
+        print('%d superseded step images removed from the cache' % removed)
+    return (installer.image_id, None)
+
+
+# Run script of user images. It is formatted with the system, type, distro
+# and version of the image.
+_user_runscript = '''\
     export CASA_SYSTEM='{system}'
     export CASA_TYPE='{type}'
     export CASA_DISTRO='{distro}'
@@ -369,6 +765,9 @@ def create_user_image(base_image,
         if [ -f /casa/host/install/bin/bv_env ]; then
             # try r/w install
             /usr/local/bin/entrypoint /casa/host/install/bin/bv_env "$@"
+        elif [ -x /casa/bv_env_snapshot -a -z "$CASA_DYNAMIC_BV_ENV" ]; then
+            # environment of the builtin install, computed at image creation
+            /usr/local/bin/entrypoint /casa/bv_env_snapshot "$@"
         elif [ -f /casa/install/bin/bv_env ]; then
             # otherwise use the builtin (read-only) install in the image
             /usr/local/bin/entrypoint /casa/install/bin/bv_env "$@"
@@ -403,13 +802,78 @@ def create_user_image(base_image,
         echo
         echo 'Please visit https://brainvisa.info/ for complete help.'
     fi
-'''.format(base_image=base_image,
-           system=dev_config['system'],
-           type='user',
-           distro=dev_config['distro'],
-           version=version))
+'''
+
+
+def create_user_image(base_image,
+                      dev_config,
+                      version,
+                      output,
+                      force='no',
+                      fakeroot='yes',
+                      base_directory=default_base_directory,
+                      verbose=None,
+                      install_thirdparty='all',
+                      cleanup=True,
+                      builder='recipe'):
+    '''
+    ``builder`` is "recipe" to build a new image from a recipe based on the
+    run image, or "overlay" to add the installed files to a copy of the run
+    image as an overlay partition (see :func:`create_user_image_overlay`).
+
+    Returns
+    -------
+    uuid, msg: tuple
+    '''
+    if builder == 'overlay':
+        return create_user_image_overlay(
+            base_image, dev_config, version, output, force=force,
+            fakeroot=fakeroot, verbose=verbose,
+            install_thirdparty=install_thirdparty, cleanup=cleanup)
+    elif builder != 'recipe':
+        raise ValueError('Unknown user image builder: {0}'.format(builder))
+    force = boolean_value(force)
+    fakeroot = boolean_value(fakeroot)
+    recipe = tempfile.NamedTemporaryFile(mode='wt')
+    recipe.write('''\
+Bootstrap: localimage
+    From: {base_image}
+
+%runscript
+'''.format(base_image=base_image))
+    recipe.write(_user_runscript.format(system=dev_config['system'],
+                                        type='user',
+                                        distro=dev_config['distro'],
+                                        version=version))
 
     rb = RecipeBuilder(output)
+    temps = _install_user_files(rb, dev_config, install_thirdparty)
+    try:
+        rb.write(recipe)
+        recipe.flush()
+
+        if verbose:
+            print('---------- Singularity recipe ----------', file=verbose)
+            print(open(recipe.name).read(), file=verbose)
+            print('----------------------------------------', file=verbose)
+            verbose.flush()
+        build_command = _singularity_build_command(force=force,
+                                                   fakeroot=fakeroot,
+                                                   cleanup=cleanup)
+        _build_recipe(build_command, output, recipe.name, fakeroot, verbose)
+
+        return (rb.image_id, None)
+    finally:
+        for d in temps:
+            shutil.rmtree(d)
+
+
+def _install_user_files(rb, dev_config, install_thirdparty):
+    '''
+    Install the files of a user image with a builder (:class:`RecipeBuilder`
+    or :class:`OverlayBuilder`). Return the list of temporary directories
+    to delete once the image is built.
+    '''
     rb.copy_root(dev_config['directory'] + '/install', '/casa')
 
     temps = install_thirdparty_software(install_thirdparty, rb)
@@ -427,39 +891,235 @@ def create_user_image(base_image,
                     'database-*.sqlite; fi')
         rb.run_user('echo "{\\"image_id\\": \\"%s\\"}" > /casa/image_id'
                     % rb.image_id)
+        # Precompute the bv_env environment of the builtin install, in the
+        # environment set by the entrypoint when the container runs. It can
+        # be disabled at run time with CASA_DYNAMIC_BV_ENV=1 (to compare
+        # start times, for instance).
+        rb.run_user('if [ -f /casa/install/bin/bv_env ]; then '
+                    '/usr/local/bin/entrypoint '
+                    '/casa/casa-distro/cbin/casa_container bv_env_snapshot; '
+                    'fi')
+    except Exception:
+        for d in temps:
+            shutil.rmtree(d)
+        raise
+    return temps
 
-        rb.write(recipe)
-        recipe.flush()
 
+class OverlayBuilder:
+
+    '''
+    Builder with the interface of :class:`RecipeBuilder` which installs
+    files in a directory used as an overlay of an image: files are copied in
+    its "upper" subdirectory, and shell commands are run afterwards (see
+    :meth:`run_commands`) in a container of the image with this directory as
+    a writable overlay.
+    '''
+
+    def __init__(self, name, overlay_dir):
+        self.name = name
+        self.user = None
+        self.overlay_dir = overlay_dir
+        self.upper = osp.join(overlay_dir, 'upper')
+        for d in (self.upper, osp.join(overlay_dir, 'work')):
+            if not osp.isdir(d):
+                os.makedirs(d)
+        self.commands = []
+        self.env = {}
+        # identify image/build with a unique identifier
+        self.image_id = str(uuid.uuid4())
+
+    def host_path(self, path):
+        '''
+        Location in the overlay directory of a path of the image
+        '''
+        return osp.join(self.upper, path.lstrip('/'))
+
+    def run_user(self, command):
+        self.commands.append(command)
+
+    def run_root(self, command):
+        self.commands.append(command)
+
+    def copy_root(self, source_file, dest_dir, preserve_symlinks=True,
+                  preserve_ext_symlinks=True):
+        dest_dir = self.host_path(dest_dir)
+        if not osp.isdir(dest_dir):
+            os.makedirs(dest_dir)
+        # files are copied (not hard linked) since commands run in the
+        # overlay may modify them. Copy-on-write is used when the
+        # filesystem supports it.
+        cmd = ['cp', '-a', '--reflink=auto']
+        if not preserve_symlinks:
+            cmd.append('-L')
+        subprocess.check_call(cmd + [source_file, dest_dir + '/'])
+
+    def copy_user(self, source_file, dest_dir, preserve_symlinks=True,
+                  preserve_ext_symlinks=True):
+        self.copy_root(source_file, dest_dir,
+                       preserve_symlinks=preserve_symlinks,
+                       preserve_ext_symlinks=preserve_ext_symlinks)
+
+    def extract_tar(self, source_file, dest_dir):
+        dest_dir = self.host_path(dest_dir)
+        if not osp.isdir(dest_dir):
+            os.makedirs(dest_dir)
+        subprocess.check_call(['tar', '-C', dest_dir, '--no-same-owner',
+                               '-xf', osp.realpath(source_file)])
+
+    def symlink(self, target, link_name):
+        os.symlink(target, self.host_path(link_name))
+
+    def environment(self, environment_dict):
+        self.env.update(environment_dict)
+
+    def install_casa_distro(self, dest):
+        source = osp.dirname(osp.dirname(osp.dirname(__file__)))
+        for i in ('bin', 'cbin', 'python', 'etc', 'share'):
+            self.copy_root(osp.join(source, i), dest)
+        for dirpath, dirnames, filenames in os.walk(self.host_path(dest)):
+            for d in [d for d in dirnames if d == '__pycache__']:
+                shutil.rmtree(osp.join(dirpath, d))
+                dirnames.remove(d)
+            for f in filenames:
+                if f.endswith('.pyc') or f.endswith('~'):
+                    os.unlink(osp.join(dirpath, f))
+
+    def write_runscript(self, runscript):
+        '''
+        Write the run script and the environment of the image, which replace
+        the ones of the base image, as the %runscript and %environment
+        sections of a recipe do (the environment is written in
+        90-environment.sh only if it is not empty).
+        '''
+        sdir = self.host_path('/.singularity.d')
+        if not osp.isdir(osp.join(sdir, 'env')):
+            os.makedirs(osp.join(sdir, 'env'))
+        with open(osp.join(sdir, 'runscript'), 'w') as f:
+            f.write('#!/bin/sh\n' + runscript)
+        os.chmod(osp.join(sdir, 'runscript'), 0o755)
+        if self.env:
+            with open(osp.join(sdir, 'env', '90-environment.sh'),
+                      'w') as f:
+                for variable, value in sorted(self.env.items()):
+                    f.write('export {}="{}"\n'.format(variable, value))
+
+    def run_commands(self, image, fakeroot=True, verbose=None):
+        '''
+        Run the shell commands in a container of the image with the overlay
+        directory mounted as a writable overlay.
+        '''
+        if not self.commands:
+            return
+        cmd = [] if fakeroot else ['sudo']
+        cmd += [singularity_executable(), 'exec', '--cleanenv', '--contain']
+        if fakeroot:
+            cmd.append('--fakeroot')
+        cmd += ['--overlay', self.overlay_dir, image,
+                'sh', '-c', '\n'.join(['set -e'] + self.commands)]
         if verbose:
-            print('---------- Singularity recipe ----------', file=verbose)
-            print(open(recipe.name).read(), file=verbose)
-            print('----------------------------------------', file=verbose)
-            verbose.flush()
-        build_command = _singularity_build_command(force=force,
-                                                   fakeroot=fakeroot,
-                                                   cleanup=cleanup)
-        # Set cwd to a directory that root is allowed to 'cd' into, to avoid a
-        # permission issue with --fakeroot and NFS root_squash.
-        try:
-            subprocess.check_call(build_command + [output, recipe.name],
-                                  cwd='/')
-        except Exception:
-            if fakeroot:
-                print('** Image creation has failed **', file=sys.stderr)
-                print('If you see an error message about fakeroot not working '
-                      'on your system, then try the following command (you '
-                      'need sudo permissions):', file=sys.stderr)
-                print('sudo %s config fakeroot --add %s'
-                      % (singularity_name(), getpass.getuser()),
-                      file=sys.stderr)
-                print(file=sys.stderr)
-            raise
+            print('run overlay commands:\n', *cmd, file=verbose)
+        subprocess.check_call(cmd, cwd='/')
+
+
+# SIF architecture codes of overlay partitions
+_sif_architectures = {
+    'i386': 1, 'i686': 1, 'x86_64': 2, 'amd64': 2, 'armv7l': 3,
+    'aarch64': 4, 'arm64': 4, 'ppc64': 5, 'ppc64le': 6, 's390x': 11,
+    'riscv64': 12,
+}
+
+
+def create_user_image_overlay(base_image,
+                              dev_config,
+                              version,
+                              output,
+                              force='no',
+                              fakeroot='yes',
+                              verbose=None,
+                              install_thirdparty='all',
+                              cleanup=True):
+    '''
+    Create a user image made of a copy of the run image with an additional
+    read-only squashfs overlay partition, which contains only the files
+    installed in the user image (/casa/install, casa-distro, third-party
+    software, run script). The base system is not compressed again, thus
+    the image is built faster. The run image is copied with copy-on-write
+    when the filesystem supports it, so that the base bytes are shared on
+    disk.
+
+    The work directory is created next to the output image and removed
+    once the image is built. If the build fails, it is kept for inspection
+    unless ``cleanup`` is true.
 
-        return (rb.image_id, None)
+    Returns
+    -------
+    uuid, msg: tuple
+    '''
+    import platform
+
+    force = boolean_value(force)
+    fakeroot = boolean_value(fakeroot)
+    start = time.time()
+    if osp.exists(output) and not force:
+        raise ValueError('{0} already exists, use force=yes to replace it'
+                         .format(output))
+    mksquashfs = shutil.which('mksquashfs')
+    if not mksquashfs:
+        raise RuntimeError('mksquashfs (squashfs-tools) is required to '
+                           'build overlay images')
+    arch = _sif_architectures.get(platform.machine())
+    if arch is None:
+        raise RuntimeError('Unsupported architecture: {0}'
+                           .format(platform.machine()))
+    # the work directory is next to the output image, in order to use
+    # copy-on-write copies and an atomic rename
+    work_dir = tempfile.mkdtemp(prefix='casa_distro_overlay_',
+                                dir=osp.dirname(osp.abspath(output)))
+    success = False
+    try:
+        ob = OverlayBuilder(output, osp.join(work_dir, 'overlay'))
+        temps = _install_user_files(ob, dev_config, install_thirdparty)
+        try:
+            ob.write_runscript(_user_runscript.format(
+                system=dev_config['system'], type='user',
+                distro=dev_config['distro'], version=version))
+            ob.run_commands(base_image, fakeroot=fakeroot, verbose=verbose)
+        finally:
+            for d in temps:
+                shutil.rmtree(d)
+
+        squashfs = osp.join(work_dir, 'overlay.sqfs')
+        subprocess.check_call([mksquashfs, ob.upper, squashfs, '-noappend',
+                               '-all-root'],
+                              stdout=(verbose if verbose else
+                                      subprocess.DEVNULL))
+        image = osp.join(work_dir, 'image.sif')
+        subprocess.check_call(['cp', '--reflink=auto', base_image, image])
+        subprocess.check_call([singularity_executable(), 'sif', 'add',
+                               '--datatype', '4',  # partition
+                               '--partfs', '1',  # squashfs
+                               '--parttype', '4',  # overlay
+                               '--partarch', str(arch),
+                               '--groupid', '1',
+                               image, squashfs])
+        os.rename(image, output)
+        print('User image built in %.0f s: %.1f MiB (run image: %.1f MiB, '
+              'overlay partition: %.1f MiB)'
+              % (time.time() - start,
+                 os.stat(output).st_size / 1048576.,
+                 os.stat(base_image).st_size / 1048576.,
+                 os.stat(squashfs).st_size / 1048576.))
+        success = True
     finally:
-        for d in temps:
-            shutil.rmtree(d)
+        if success or cleanup:
+            # the overlay work directory may contain files which cannot be
+            # removed without privileges
+            shutil.rmtree(work_dir, ignore_errors=True)
+        else:
+            print('Overlay build directory kept:', work_dir)
+
+    return (ob.image_id, None)
 
 
 _singularity_raw_version = None
@@ -551,21 +1211,224 @@ def singularity_raw_version():
     return _singularity_raw_version
 
 
-def _X_has_proprietary_nvidia():
-    """Test if the X server is configured for the proprietary NVidia driver.
-    """
+# Version of the format of the host probes cache file
+_probe_cache_version = 1
+
+
+def probe_cache_file():
+    '''
+    Return the file where the results of host capability probes (see
+    :func:`cached_probe`) are stored:
+    $XDG_CACHE_HOME/casa-distro/host_probes.json
+    (~/.cache/casa-distro/host_probes.json by default).
+    '''
+    xdg_cache_home = os.environ.get('XDG_CACHE_HOME', '')
+    if not xdg_cache_home:
+        xdg_cache_home = osp.expanduser('~/.cache')
+    return osp.join(xdg_cache_home, 'casa-distro', 'host_probes.json')
+
+
+def _read_probe_cache():
+    try:
+        with open(probe_cache_file()) as f:
+            cache = json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+    if not isinstance(cache, dict) \
+            or cache.get('version') != _probe_cache_version:
+        return {}
+    return cache.get('probes', {})
+
+
+def _write_probe_cache(probes):
+    cache_file = probe_cache_file()
+    try:
+        if not osp.isdir(osp.dirname(cache_file)):
+            os.makedirs(osp.dirname(cache_file))
+        tmp = '%s.%d.tmp' % (cache_file, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump({'version': _probe_cache_version, 'probes': probes}, f,
+                      indent=1, sort_keys=True)
+        os.rename(tmp, cache_file)
+    except (IOError, OSError):
+        pass  # the cache is only an optimization
+
+
+def cached_probe(name, key, probe):
+    '''
+    Return the result of a host capability probe, which is cached across
+    runs as long as its inputs do not change.
+
+    Parameters
+    ----------
+    name: str
+        name of the probe in the cache
+    key: JSON-compatible value
+        description of the inputs the probe result depends on (driver
+        version, X server identity, image...). The cached result is
+        discarded when it changes.
+    probe: function
+        function performing the probe. It returns a JSON-compatible value,
+        or None if the probe fails, in which case the result is not cached.
+    '''
+    # normalize the key as it will be read back from JSON
+    key = json.loads(json.dumps(key))
+    probes = _read_probe_cache()
+    entry = probes.get(name)
+    if entry is not None and entry.get('key') == key:
+        return entry.get('value')
+    value = probe()
+    if value is not None:
+        # re-read the cache to keep probes written concurrently
+        probes = _read_probe_cache()
+        probes[name] = {'key': key, 'value': value}
+        _write_probe_cache(probes)
+    return value
+
+
+def _nvidia_fingerprint():
+    '''
+    Identify the NVidia driver installed on the host: version of the loaded
+    kernel module and /dev/nvidia* devices.
+    '''
+    try:
+        with open('/proc/driver/nvidia/version') as f:
+            driver = f.read().strip()
+    except (IOError, OSError):
+        driver = None
+    try:
+        devices = sorted(d for d in os.listdir('/dev')
+                         if d.startswith('nvidia'))
+    except OSError:
+        devices = []
+    return {'driver': driver, 'devices': devices}
+
+
+def _display_fingerprint():
+    '''
+    Identify the X server of the DISPLAY: for a local server, its socket
+    (which is recreated when the server restarts), otherwise the SSH
+    connection which forwards it.
+    '''
+    display = os.environ.get('DISPLAY')
+    fingerprint = {'display': display}
+    if display:
+        m = re.match(r'^(.*):(\d+)(\.\d+)?$', display)
+        if m and m.group(1) in ('', 'unix'):
+            try:
+                st = os.stat('/tmp/.X11-unix/X%s' % m.group(2))
+                fingerprint['socket'] = [st.st_ino, st.st_mtime]
+            except OSError:
+                pass
+        else:
+            fingerprint['ssh'] = os.environ.get('SSH_CONNECTION')
+    return fingerprint
+
+
+def _image_fingerprint(image):
+    '''
+    Identify a container image by the image_id of its metadata file, or by
+    its size and modification time.
+    '''
+    try:
+        with open(image + '.json') as f:
+            image_id = json.load(f).get('image_id')
+    except (IOError, OSError, ValueError):
+        image_id = None
+    if image_id:
+        return {'image_id': image_id}
+    st = os.stat(image)
+    return {'image': osp.abspath(image),
+            'size': st.st_size,
+            'mtime': st.st_mtime}
+
+
+def _probe_X_proprietary_nvidia():
     try:
         with open(os.devnull, 'w') as devnull:
             stdoutdata = subprocess.check_output('xdpyinfo', bufsize=-1,
                                                  stderr=devnull,
                                                  universal_newlines=True)
     except (OSError, subprocess.CalledProcessError):
+        return None
+    return bool(re.search(r'^\s+NV-GLX\s*$', stdoutdata, re.M))
+
+
+def _X_has_proprietary_nvidia():
+    """Test if the X server is configured for the proprietary NVidia driver.
+
+    The result is cached for a given X server and NVidia driver (see
+    :func:`cached_probe`).
+    """
+    key = {'nvidia': _nvidia_fingerprint(),
+           'display': _display_fingerprint()}
+    result = cached_probe('X_proprietary_nvidia', key,
+                          _probe_X_proprietary_nvidia)
+    if result is None:
         # xdpyinfo cannot be found or returns an error. Stay on the safe side
         # by returning False, which triggers the fallback to software
         # rendering.
         return False
-    else:
-        return bool(re.search(r'^\s+NV-GLX\s*$', stdoutdata, re.M))
+    return result
+
+
+def _cgroups_limits_supported(root):
+    """Tell if CPU and memory limits can be set with the cgroups options of
+    Apptainer / Singularity (``--cpus``, ``--memory``). Unprivileged users
+    need cgroups v2.
+    """
+    if not root and not osp.exists('/sys/fs/cgroup/cgroup.controllers'):
+        return False
+    executable = singularity_executable()
+    try:
+        st = os.stat(executable)
+    except OSError:
+        return False
+
+    def probe():
+        try:
+            output = subprocess.check_output([executable, 'run', '--help'],
+                                             stderr=subprocess.STDOUT,
+                                             universal_newlines=True)
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        return '--cpus' in output and '--memory' in output
+
+    return bool(cached_probe('cgroups_options',
+                             {'executable': executable,
+                              'size': st.st_size,
+                              'mtime': st.st_mtime},
+                             probe))
+
+
+def _budget_options(run_budget, root):
+    """Return the container options enforcing a resources budget (see
+    :mod:`casa_distro.budget`), and the CPU affinity to set on the container
+    process.
+    """
+    options = []
+    cpu_affinity = run_budget['cpu_affinity']
+    if run_budget['cpus'] or run_budget['memory']:
+        if _cgroups_limits_supported(root):
+            if run_budget['cpus']:
+                options += ['--cpus', '%g' % run_budget['cpus']]
+            if run_budget['memory']:
+                options += ['--memory', str(run_budget['memory'])]
+        else:
+            print('WARNING: CPU and memory limits cannot be set with cgroups '
+                  'on this system.', file=sys.stderr)
+            if run_budget['memory']:
+                print('WARNING: the memory limit is ignored.',
+                      file=sys.stderr)
+            # The CPUs budget is only applied through the number of threads
+            # of computing libraries: binding every container to the same
+            # first CPUs would pile up the runs of all users on them.
+    if cpu_affinity and hasattr(os, 'sched_getaffinity'):
+        unavailable = set(cpu_affinity) - os.sched_getaffinity(0)
+        if unavailable:
+            raise ValueError('CPUs not available for cpu_affinity: %s'
+                             % ','.join(str(i) for i in sorted(unavailable)))
+    return options, cpu_affinity
 
 
 def _guess_opengl_mode():
@@ -626,21 +1489,25 @@ def _nv_libs_binds(image=None):
 
     _nv_libs_binds() adds the additional missing lib directory (tls/)
 
+    If ``image`` is given, the libc of the host is also bound into the
+    container when it is newer than the container one.
+
+    The libraries list and the libc versions are cached (see
+    :func:`cached_probe`) until the NVidia driver, the host libc or the
+    image change.
     '''
-    added_libs = []
-    try:
-        with open(os.devnull, 'w') as devnull:
-            out_data = subprocess.check_output(
-                ['nvidia-container-cli', 'list', '--libraries'],
-                bufsize=-1, stderr=devnull,
-                universal_newlines=True,  # return decoded str instead of bytes
-            )
-        libs = out_data.strip().split()
-    except OSError:
-        libs = []  # nvidia-container-cli not found
-    except subprocess.CalledProcessError:
-        libs = []  # nvidia-container-cli returns an error
+    nvidia_cli = shutil.which('nvidia-container-cli')
+    if nvidia_cli:
+        libs = cached_probe(
+            'nvidia_libraries',
+            {'nvidia': _nvidia_fingerprint(), 'cli': nvidia_cli},
+            _probe_nvidia_libraries)
+    else:
+        libs = None
+    if libs is None:
+        libs = []  # nvidia-container-cli not found or returns an error
 
+    added_libs = []
     for lib in libs:
         ldir, blib = osp.split(lib)
         if blib.startswith('libnvidia-tls.so'):
@@ -661,26 +1528,17 @@ def _nv_libs_binds(image=None):
     host_ver = None
     cont_ver = None
     if osp.exists(libc_path):
-        try:
-            out_data = subprocess.check_output([libc_path]).decode()
-            ver_line = out_data.split('\n')[0]
-            m = re.match('^.* version ([0-9.]+)\\.$', ver_line)
-            if m is not None:
-                ver_s = m.group(1)
-                host_ver = [int(x) for x in ver_s.split('.')]
-        except subprocess.CalledProcessError:
-            pass
+        st = os.stat(libc_path)
+        host_ver = cached_probe(
+            'host_glibc',
+            {'libc': libc_path, 'inode': st.st_ino, 'mtime': st.st_mtime},
+            lambda: _glibc_version([libc_path]))
     if host_ver is not None:
-        try:
-            cmd = [singularity_executable(), 'exec', image, libc_path]
-            out_data = subprocess.check_output(cmd).decode()
-            ver_line = out_data.split('\n')[0]
-            m = re.match('^.* version ([0-9.]+)\\.$', ver_line)
-            if m is not None:
-                ver_s = m.group(1)
-                cont_ver = [int(x) for x in ver_s.split('.')]
-        except subprocess.CalledProcessError:
-            pass
+        cont_ver = cached_probe(
+            'image_glibc:%s' % osp.abspath(image),
+            _image_fingerprint(image),
+            lambda: _glibc_version([singularity_executable(), 'exec', image,
+                                    libc_path]))
         if cont_ver is not None and cont_ver < host_ver:
             added_libs += [
                 '%s:%s' % (libc_path, libc_path),
@@ -689,15 +1547,75 @@ def _nv_libs_binds(image=None):
     return added_libs
 
 
+def _probe_nvidia_libraries():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            out_data = subprocess.check_output(
+                ['nvidia-container-cli', 'list', '--libraries'],
+                bufsize=-1, stderr=devnull,
+                universal_newlines=True,  # return decoded str instead of bytes
+            )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out_data.strip().split()
+
+
+def _glibc_version(cmd):
+    '''
+    Run a libc.so.6 (with ``cmd``) to get its version as a list of ints,
+    or None if it cannot be determined.
+    '''
+    try:
+        out_data = subprocess.check_output(cmd).decode()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    ver_line = out_data.split('\n')[0]
+    m = re.match('^.* version ([0-9.]+)\\.$', ver_line)
+    if m is None:
+        return None
+    return [int(x) for x in m.group(1).split('.')]
+
+
 def run(config, command, gui, opengl, root, cwd, env, image, container_options,
-        base_directory, verbose):
+        base_directory, verbose, resources=None):
     """Run a command in the Singularity container.
 
     Return the exit code of the command, or raise an exception if the command
     cannot be run.
     """
-    temps = []
+    with trace.span('singularity.run'):
+        plan = launch_plan(config, gui=gui, opengl=opengl, root=root,
+                           cwd=cwd, env=env, image=image,
+                           container_options=container_options,
+                           base_directory=base_directory,
+                           resources=resources)
+        return execute_plan(plan, command, verbose)
+
+
+def launch_plan(config, gui, opengl, root, cwd, env, image, container_options,
+                base_directory, resources=None):
+    """Resolve the way to start a container, independently of the command.
 
+    Returns
+    -------
+    plan: dict
+        JSON-compatible dictionary containing the singularity command line
+        up to the image ("argv"), the "image", the environment variables to
+        set in the container ("container_env"), whether the X authority
+        should be forwarded ("xauthority"), the lines of the
+        /casa/start_scripts/init.sh script ("init_script"), the mount
+        sources which do not exist and are skipped ("missing_sources"), the
+        instance mode settings ("instance", see
+        :func:`casa_distro.instances.instance_settings`), the CPUs the
+        container is bound to ("cpu_affinity"), the "image_id"
+        of the image, the file where runs are recorded ("run_log", see
+        :mod:`casa_distro.run_stats`) and the consolidated environment
+        configuration ("config"). It is run by :func:`execute_plan`.
+
+    ``resources`` is a dictionary which may give the "cpus", "memory" and
+    "cpu_affinity" of the run, overriding the environment configuration
+    (see :mod:`casa_distro.budget`).
+    """
     singularity = [singularity_executable(), 'run', '--cleanenv']
     if root:
         singularity = ['sudo'] + singularity
@@ -717,21 +1635,9 @@ def run(config, command, gui, opengl, root, cwd, env, image, container_options,
     # This configuration key is always set by
     # casa_distro.environment.run_container
     casa_home_host_path = config['mounts']['/casa/home']
-    if gui and os.environ.get('DISPLAY'):
-        # Use a temporary file for each run, because a single ~/.Xauthority
-        # file could be overwritten by concurrent runs... which may not all be
-        # using the same X server.
-        with tempfile.NamedTemporaryFile(prefix='casa-distro-',
-                                         suffix='.Xauthority',
-                                         delete=False) as f:
-            xauthority_tmpfile = f.name
-        temps.append(xauthority_tmpfile)
-        retcode = subprocess.call(['xauth', 'extract', xauthority_tmpfile,
-                                   os.environ['DISPLAY']], bufsize=-1)
-        if retcode == 0:
-            config['mounts']['/casa/Xauthority'] = xauthority_tmpfile
-            configured_env['XAUTHORITY'] = '/casa/Xauthority'
-            configured_env['DISPLAY'] = os.environ['DISPLAY']
+    # The X authority is extracted to a temporary file for each run (see
+    # execute_plan)
+    xauthority = bool(gui and os.environ.get('DISPLAY'))
 
     # Make the host ssh-agent usable in the container
     if 'SSH_AUTH_SOCK' in os.environ:
@@ -743,7 +1649,9 @@ def run(config, command, gui, opengl, root, cwd, env, image, container_options,
         config['mounts']['/var/lib/xkb'] = osp.join(casa_home_host_path,
                                                     '.varlib/xkb')
 
+    binds_start = time.time()
     home_mount = False
+    missing_sources = []
     host_homedir = os.path.realpath(os.path.expanduser('~'))
     for dest, source in config.get('mounts', {}).items():
         if not source:
@@ -753,10 +1661,8 @@ def run(config, command, gui, opengl, root, cwd, env, image, container_options,
         dest = dest.format(**config)
         dest = osp.expandvars(dest)
         if not os.path.exists(source):
-            print('WARNING: the path {0} cannot be found on your system, '
-                  'so it cannot be mounted in the container as requested by '
-                  'your casa-distro configuration.'.format(source),
-                  file=sys.stderr)
+            # the warning is printed by execute_plan(), at each run
+            missing_sources.append(source)
             continue
         singularity += ['--bind', '%s:%s' % (source, dest)]
         if source == host_homedir:
@@ -769,6 +1675,8 @@ def run(config, command, gui, opengl, root, cwd, env, image, container_options,
     if not home_mount:
         # singularity 3 doesn't mount the home directory automatically.
         singularity += ['--bind', host_homedir]
+    trace.add_span('validate binds', binds_start, time.time(),
+                   missing=len(missing_sources))
 
     singularity_home = None
 
@@ -813,7 +1721,9 @@ def run(config, command, gui, opengl, root, cwd, env, image, container_options,
             container_options += [osp.expandvars(i) for i in gui_options]
 
     if opengl == 'auto':
-        opengl = _guess_opengl_mode()
+        with trace.span('opengl probe') as span_args:
+            opengl = _guess_opengl_mode()
+            span_args['opengl'] = opengl
 
     # These options/environment variables can interfere, unset them.
     while '--nv' in container_options:
@@ -839,7 +1749,8 @@ def run(config, command, gui, opengl, root, cwd, env, image, container_options,
     if opengl == 'nv':
         if '--nv' not in container_options:
             container_options.append('--nv')
-        nv_binds = _nv_libs_binds(image=image)
+        with trace.span('nvidia libraries probe'):
+            nv_binds = _nv_libs_binds(image=image)
         for ldir in nv_binds:
             if ':' in ldir:
                 singularity += ['--bind', ldir]
@@ -862,47 +1773,129 @@ def run(config, command, gui, opengl, root, cwd, env, image, container_options,
     else:
         raise ValueError('Invalid value for the opengl option')
 
-    if init_script:
-        tmpdir = tempfile.mkdtemp(prefix='casa_singularity')
-        script = osp.join(tmpdir, 'init.sh')
-        with open(script, 'w') as f:
-            print('#!/bin/bash\n', file=f)
-            for line in init_script:
-                print(line, file=f)
-        container_options += ['--bind', '%s:/casa/start_scripts' % tmpdir]
-        temps.append(tmpdir)
+    # CPU, memory and threads budget
+    run_budget = budget.resource_budget(config, **(resources or {}))
+    budget_options, cpu_affinity = _budget_options(run_budget, root)
+    container_options += budget_options
+    for name, value in budget.thread_environment(
+            dict(run_budget, cpu_affinity=cpu_affinity)).items():
+        # explicitly configured variables have priority
+        container_env.setdefault(name, value)
 
     singularity += container_options
 
-    singularity += [image]
-    singularity += command
+    return {'argv': singularity,
+            'image': image,
+            'container_env': container_env,
+            'xauthority': xauthority,
+            'init_script': init_script,
+            'missing_sources': missing_sources,
+            'instance': instances.instance_settings(config),
+            'cpu_affinity': cpu_affinity,
+            'image_id': _image_fingerprint(image).get('image_id'),
+            'run_log': run_stats.run_log_file(casa_home_host_path),
+            'config': config}
+
+
+def _singularity_environment(container_env):
     env_for_singularity = os.environ.copy()
     for n, v in six.iteritems(container_env):
         env_for_singularity[envvar_prefix() + 'ENV_' + n] = v
-    if verbose:
-        print('-' * 40, file=verbose)
-        print('Consolidated casa_distro environment configuration:',
-              file=verbose)
-        json.dump(config, verbose,
-                  indent=4, separators=(',', ': '), sort_keys=True)
-        print('\nRunning singularity with the following command:',
-              file=verbose)
-        print(*("'%s'" % i for i in singularity), file=verbose)
-        print('\nUsing the following environment:', file=verbose)
-        for n in sorted(env_for_singularity):
-            v = env_for_singularity[n]
-            print('    %s=%s' % (n, v), file=verbose)
-        print('-' * 40, file=verbose)
-        # When verbose is stdout or stderr we must flush buffers to avoid the
-        # output of the singularity command to be intermixed with verbose
-        # output.
-        verbose.flush()
+    return env_for_singularity
+
+
+def execute_plan(plan, command, verbose):
+    """Run a command in a container started as described by a plan returned
+    by :func:`launch_plan`.
 
-    retval = 127
+    In instance mode, the command is run in the persistent instance of the
+    environment when possible (see :mod:`casa_distro.instances`).
+
+    Return the exit code of the command, or raise an exception if the command
+    cannot be run.
+    """
+    for source in plan.get('missing_sources', []):
+        print('WARNING: the path {0} cannot be found on your system, '
+              'so it cannot be mounted in the container as requested by '
+              'your casa-distro configuration.'.format(source),
+              file=sys.stderr)
+
+    if plan.get('instance'):
+        retval = instances.execute_in_instance(
+            plan, command, _singularity_environment(plan['container_env']),
+            envvar_prefix(), verbose)
+        if retval is not None:
+            return retval
+
+    temps = []
+    singularity = list(plan['argv'])
+    container_env = dict(plan['container_env'])
     try:
-        retval = subprocess.call(singularity, env=env_for_singularity)
-    except KeyboardInterrupt:
-        pass  # avoid displaying a stack trace
+        if plan.get('xauthority') and os.environ.get('DISPLAY'):
+            # Use a temporary file for each run, because a single
+            # ~/.Xauthority file could be overwritten by concurrent runs...
+            # which may not all be using the same X server.
+            with tempfile.NamedTemporaryFile(prefix='casa-distro-',
+                                             suffix='.Xauthority',
+                                             delete=False) as f:
+                xauthority_tmpfile = f.name
+            temps.append(xauthority_tmpfile)
+            with trace.span('xauth extract'):
+                retcode = subprocess.call(['xauth', 'extract',
+                                           xauthority_tmpfile,
+                                           os.environ['DISPLAY']], bufsize=-1)
+            if retcode == 0:
+                singularity += ['--bind',
+                                '%s:/casa/Xauthority' % xauthority_tmpfile]
+                container_env['XAUTHORITY'] = '/casa/Xauthority'
+                container_env['DISPLAY'] = os.environ['DISPLAY']
+
+        if plan.get('init_script'):
+            tmpdir = tempfile.mkdtemp(prefix='casa_singularity')
+            temps.append(tmpdir)
+            script = osp.join(tmpdir, 'init.sh')
+            with open(script, 'w') as f:
+                print('#!/bin/bash\n', file=f)
+                for line in plan['init_script']:
+                    print(line, file=f)
+            singularity += ['--bind', '%s:/casa/start_scripts' % tmpdir]
+
+        singularity += [plan['image']]
+        singularity += command
+        env_for_singularity = _singularity_environment(container_env)
+        if verbose:
+            print('-' * 40, file=verbose)
+            print('Consolidated casa_distro environment configuration:',
+                  file=verbose)
+            json.dump(plan['config'], verbose,
+                      indent=4, separators=(',', ': '), sort_keys=True)
+            print('\nRunning singularity with the following command:',
+                  file=verbose)
+            print(*("'%s'" % i for i in singularity), file=verbose)
+            print('\nUsing the following environment:', file=verbose)
+            for n in sorted(env_for_singularity):
+                v = env_for_singularity[n]
+                print('    %s=%s' % (n, v), file=verbose)
+            print('-' * 40, file=verbose)
+            # When verbose is stdout or stderr we must flush buffers to avoid
+            # the output of the singularity command to be intermixed with
+            # verbose output.
+            verbose.flush()
+
+        retval = 127
+        try:
+            with trace.span('container command',
+                            command=command) as span_args:
+                start = time.time()
+                retval, rusage = run_stats.call(
+                    singularity, env=env_for_singularity,
+                    preexec_fn=budget.affinity_setter(
+                        plan.get('cpu_affinity')))
+                run_stats.record_run(plan, command, start, time.time(),
+                                     retval, rusage)
+                span_args['exit_code'] = retval
+        except KeyboardInterrupt:
+            pass  # avoid displaying a stack trace
     finally:
         for temp in temps:
             if os.path.isdir(temp):
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+'''
+Timing of the steps of casa_distro commands.
+
+When the ``CASA_DISTRO_TRACE`` environment variable is set to a file name,
+timed spans of the launch of commands (environment selection, home
+directory preparation, OpenGL probing, X authority extraction, container
+run...) are appended to this file. Events are written in the Chrome trace
+event format ("JSON Array Format"), one event per line, so that the file can
+be loaded in chrome://tracing or https://ui.perfetto.dev, or read as JSON
+lines with :func:`read_trace` in order to compare timings across releases.
+Several processes (``bv``, ``casa_distro``...) can write in the same file.
+'''
+from __future__ import absolute_import, division, print_function
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+
+def trace_file():
+    '''
+    Return the trace file given by the ``CASA_DISTRO_TRACE`` environment
+    variable, or None if timings are not recorded.
+    '''
+    return os.environ.get('CASA_DISTRO_TRACE') or None
+
+
+def add_span(name, start, end, **args):
+    '''
+    Record a span of time in the trace file, if any. ``start`` and ``end``
+    are given in seconds, as returned by :func:`time.time`. Keyword
+    arguments are recorded in the "args" of the event.
+    '''
+    path = trace_file()
+    if not path:
+        return
+    event = {'name': name,
+             'cat': 'casa_distro',
+             'ph': 'X',
+             'ts': int(start * 1e6),
+             'dur': int((end - start) * 1e6),
+             'pid': os.getpid(),
+             'tid': threading.current_thread().ident,
+             'args': args}
+    line = json.dumps(event, default=str) + ',\n'
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size == 0:
+                line = '[\n' + line
+            # a single write per event, so that concurrent processes do not
+            # mix their lines
+            os.write(fd, line.encode('utf-8'))
+        finally:
+            os.close(fd)
+    except OSError:
+        pass  # timings must not make commands fail
+
+
+@contextlib.contextmanager
+def span(name, **args):
+    '''
+    Context manager recording the time spent in a block. It returns the
+    dictionary of arguments of the event, which can be completed in the
+    block (with an exit code for instance).
+    '''
+    start = time.time()
+    try:
+        yield args
+    finally:
+        add_span(name, start, time.time(), **args)
+
+
+def read_trace(path):
+    '''
+    Return the list of events of a trace file.
+    '''
+    events = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip().rstrip(',')
+            if line in ('', '[', ']'):
+                continue
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                pass  # line being written by another process
+    return events
@@ -13,8 +13,9 @@
                                      iter_distros,
                                      iter_environments,
                                      run_container,
-                                     select_environment,
-                                     update_image,
+                                     run_environment,
+                                     update_images,
+                                     string_to_byte_count,
                                      find_image_update_url)
 from casa_distro.log import verbose_file
 
@@ -229,6 +230,9 @@ def run(type=None, distro=None, branch=None, system=None, image_version=None,
         env=None,
         image=None,
         container_options=None,
+        cpus=None,
+        memory=None,
+        cpu_affinity=None,
         args_list=[],
         verbose=None):
     """
@@ -238,6 +242,13 @@ def run(type=None, distro=None, branch=None, system=None, image_version=None,
 
         casa_distro branch=master ls -als /casa
 
+    The way to start the container of the environment (command line,
+    mounts, environment variables) is cached in
+    ~/.cache/casa-distro/launch_plans, and reused as long as the
+    configuration files, the image and the host environment variables do not
+    change. With the verbose option, whether the cached plan is used is
+    displayed.
+
     Parameters
     ----------
     {type}
@@ -255,20 +266,22 @@ def run(type=None, distro=None, branch=None, system=None, image_version=None,
     {env}
     {image}
     {container_options}
+    {cpus}
+    {memory}
+    {cpu_affinity}
     {verbose}
 
     """
     verbose = verbose_file(verbose)
     gui = check_boolean('gui', gui)
     root = check_boolean('root', root)
-    config = select_environment(base_directory,
-                                type=type,
-                                distro=distro,
-                                branch=branch,
-                                system=system,
-                                image_version=image_version,
-                                name=name,
-                                version=version)
+    selection = dict(type=type,
+                     distro=distro,
+                     branch=branch,
+                     system=system,
+                     image_version=image_version,
+                     name=name,
+                     version=version)
     if container_options:
         container_options = parse_list(container_options)
     if env:
@@ -279,18 +292,20 @@ def run(type=None, distro=None, branch=None, system=None, image_version=None,
             raise ValueError('env syntax error. Should be in the shape '
                              '"VAR1=value1,VAR2=value2" etc.')
     command = args_list
-
-    return run_container(config,
-                         command=command,
-                         gui=gui,
-                         opengl=opengl,
-                         root=root,
-                         cwd=cwd,
-                         env=env,
-                         image=image,
-                         container_options=container_options,
-                         base_directory=base_directory,
-                         verbose=verbose)
+    resources = dict(cpus=cpus, memory=memory, cpu_affinity=cpu_affinity)
+
+    return run_environment(base_directory,
+                           selection,
+                           command=command,
+                           gui=gui,
+                           opengl=opengl,
+                           root=root,
+                           cwd=cwd,
+                           env=env,
+                           image=image,
+                           container_options=container_options,
+                           verbose=verbose,
+                           resources=resources)
 
 
 @command
@@ -298,7 +313,8 @@ def pull_image(distro=None, branch=None, system=None, image_version=None,
                version=None, name=None, type=None,
                image=None, base_directory=casa_distro_directory(),
                url=default_download_url,
-               mode='standard', cleanup='yes', verbose=None):
+               mode='standard', cleanup='yes', segments=1, connections=8,
+               bandwidth='0', delta='yes', verbose=None):
     '''Update the container images. By default the current image and
     all images that are used by at least one casa-distro environment
     are selected (these environments are listed by the ``list`` command).
@@ -309,7 +325,8 @@ def pull_image(distro=None, branch=None, system=None, image_version=None,
 
            casa_distro pull_image type=dev image_version=5.0
 
-    2. directly specifying an image file name
+    2. directly specifying an image file name, or a comma-separated list of
+       image file names
 
            casa_distro pull_image image=/home/me/casa-run-5.0.sif
 
@@ -317,7 +334,9 @@ def pull_image(distro=None, branch=None, system=None, image_version=None,
     site given by ``url`` parameter. These files are downloaded (as well as
     the corresponding JSON metadata file) and the config files using the
     current images are modified to use the updated ones. Finally, the original
-    images are deleted (unless ``cleanup=no`` is used).
+    images are deleted (unless ``cleanup=no`` is used). Several images are
+    downloaded at the same time, within the limits given by the
+    ``connections`` and ``bandwidth`` parameters.
 
     Updated images are located using file name pattern. An updatable image
     file name must match the following pattern:
@@ -362,9 +381,32 @@ def pull_image(distro=None, branch=None, system=None, image_version=None,
         default={cleanup_default}
         if true (or 1, or yes), remove current image when successfully finished
         to download new one.
+    segments
+        default={segments_default}
+        number of parallel connections used to download each image. Each
+        connection downloads a separate byte range of the image file. Values
+        greater than 1 need the server to support HTTP range requests.
+    connections
+        default={connections_default}
+        maximum number of simultaneous connections to the server. Up to
+        ``connections / segments`` images are downloaded at the same time.
+    bandwidth
+        default={bandwidth_default}
+        maximum total download speed, in bytes per second, possibly with a
+        K, M or G suffix (for instance ``bandwidth=10M``). 0 means no limit.
+    delta
+        default={delta_default}
+        if true (or 1, or yes), and if the server provides block checksums
+        for an updated image, only download the parts of the new image
+        which differ from the current one. The new image is checked
+        against its md5 sum before config files are modified.
     {verbose}
     '''
     mode = mode.lower()
+    segments = int(segments)
+    connections = int(connections)
+    bandwidth = string_to_byte_count(str(bandwidth))
+    delta = check_boolean('delta', delta)
     if mode == 'fake':
         verbose = 'yes'
     elif mode == 'force':
@@ -372,10 +414,13 @@ def pull_image(distro=None, branch=None, system=None, image_version=None,
     verbose = verbose_file(verbose)
 
     to_update = {}
+    images = []
     if image:
-        if not osp.isabs(image):
-            image = osp.normpath(osp.join(os.getcwd(), image))
-        to_update[image] = []
+        for i in image.split(','):
+            if not osp.isabs(i):
+                i = osp.normpath(osp.join(os.getcwd(), i))
+            images.append(i)
+            to_update[i] = []
     for environment in iter_environments(base_directory,
                                          distro=distro,
                                          branch=branch,
@@ -390,8 +435,8 @@ def pull_image(distro=None, branch=None, system=None, image_version=None,
             full_image = osp.join(
                 environment.get('directory', os.getcwd()), full_image)
         full_image = osp.normpath(full_image)
-        if image:
-            if image == full_image:
+        if images:
+            if full_image in images:
                 to_update[full_image].append(environment)
         else:
             # don't look for a run image associated with a user image
@@ -446,6 +491,7 @@ def pull_image(distro=None, branch=None, system=None, image_version=None,
             else:
                 print(image, '==', file=verbose)
     if mode != 'fake':
+        image_updates = []
         for image, environments in to_update.items():
             update_url = updates.get(image)
             if update_url:
@@ -457,8 +503,11 @@ def pull_image(distro=None, branch=None, system=None, image_version=None,
                 config_files = ['{}/conf/casa_distro.json'.format(
                     e["directory"]) for e in environments]
                 rel_images = [e.get('image') for e in environments]
-                update_image(image, update_url, config_files,
-                             do_update=do_update, rel_images=rel_images)
+                image_updates.append((image, update_url, config_files,
+                                      rel_images, do_update))
+        update_images(image_updates, connections=connections,
+                      bandwidth=bandwidth, segments=segments,
+                      delta=delta)
 
 
 @command
@@ -525,6 +574,9 @@ def mrun(type=None, distro=None, branch=None, system=None,
          env=None,
          image=None,
          container_options=[],
+         cpus=None,
+         memory=None,
+         cpu_affinity=None,
          args_list=[],
          verbose=None):
     '''
@@ -554,6 +606,9 @@ def mrun(type=None, distro=None, branch=None, system=None,
     {env}
     {image}
     {container_options}
+    {cpus}
+    {memory}
+    {cpu_affinity}
     {verbose}
 
     '''
@@ -571,6 +626,7 @@ def mrun(type=None, distro=None, branch=None, system=None,
             raise ValueError('env syntax error. Should be in the shape '
                              '"VAR1=value1,VAR2=value2" etc.')
     command = args_list
+    resources = dict(cpus=cpus, memory=memory, cpu_affinity=cpu_affinity)
     res = []
 
     for config in iter_environments(base_directory,
@@ -592,7 +648,8 @@ def mrun(type=None, distro=None, branch=None, system=None,
                                  image=image,
                                  container_options=container_options,
                                  base_directory=base_directory,
-                                 verbose=verbose))
+                                 verbose=verbose,
+                                 resources=resources))
 
     if all(r == 0 for r in res):
         return 0
@@ -638,3 +695,147 @@ def bv_maker(type='dev', distro=None, branch=None, system=None,
                container_options=container_options,
                args_list=args_list,
                verbose=verbose)
+
+
+@command
+def instances(action='list', instance=None, verbose=None):
+    '''
+    List or stop the persistent container instances.
+
+    When instance mode is enabled (``instance`` variable set to ``true`` in
+    the environment or user configuration, or ``CASA_DISTRO_INSTANCE=yes``
+    in the environment), commands of an environment are run in a container
+    instance which is started once and stopped after staying idle for
+    ``instance_timeout`` seconds (600 by default). Commands needing other
+    mounts or container options than the running instance are run in a new
+    container.
+
+    Parameters
+    ----------
+    action
+        default={action_default}
+        ``list``: display the instances, ``stop``: stop instances.
+    instance
+        name of the instance to stop. All instances are stopped by default.
+    {verbose}
+    '''
+    from casa_distro import instances as instances_module
+    import time
+
+    verbose = verbose_file(verbose)
+    states = instances_module.list_instances()
+    if action == 'list':
+        now = time.time()
+        for state in states:
+            print(state['name'])
+            print('  running:', 'yes' if state['running'] else 'no')
+            print('  directory:', state.get('directory'))
+            print('  image:', state.get('image'))
+            print('  idle: %ds (timeout: %ds)'
+                  % (now - state['last_used'], state['timeout']))
+            if verbose:
+                print('  pid:', state.get('pid'))
+    elif action == 'stop':
+        result = 0
+        for state in states:
+            if instance is None or state['name'] == instance:
+                if verbose:
+                    print('stopping', state['name'], file=verbose)
+                result = max(result,
+                             instances_module.stop_instance(state['name']))
+        return result
+    else:
+        raise ValueError('Invalid action: {0}'.format(action))
+
+
+@command
+def stats(type=None, distro=None, branch=None, system=None,
+          image_version=None, name=None,
+          base_directory=casa_distro_directory(),
+          limit=10, json='no', verbose=None):
+    '''
+    Display statistics of the commands run in environments.
+
+    Each command run in a container is recorded with its wall time, CPU
+    time and memory peak (maximum resident set size) in a log of its
+    environment (runs.jsonl, next to the home directory of the container).
+    This command summarizes these logs: slowest commands, memory peaks,
+    statistics per program and per image, in order to compare image
+    versions. Recording can be disabled with the ``run_log`` item of the
+    environment or user configuration.
+
+    Parameters
+    ----------
+    {type}
+    {distro}
+    {branch}
+    {system}
+    {image_version}
+    {name}
+    {base_directory}
+    limit
+        default={limit_default}
+        number of commands displayed in the lists of slowest commands and
+        memory peaks.
+    json
+        default={json_default}
+        The summary of each environment is written in JSON format.
+    {verbose}
+    '''
+    import json as json_module
+
+    from casa_distro import run_stats
+    from casa_distro.environment import container_home_directory
+
+    json_output = check_boolean('json', json)
+    verbose = verbose_file(verbose)
+    limit = int(limit)
+
+    def mib(size):
+        return '%.1f MiB' % (size / (1024. * 1024))
+
+    def run_line(run):
+        return '%9.2fs %12s  %s' % (run['wall'], mib(run.get('max_rss', 0)),
+                                    ' '.join(run.get('command') or []))
+
+    json_result = {}
+    for config in iter_environments(base_directory,
+                                    type=type,
+                                    distro=distro,
+                                    branch=branch,
+                                    system=system,
+                                    image_version=image_version,
+                                    name=name):
+        log_file = run_stats.run_log_file(container_home_directory(config))
+        summary = run_stats.summarize(run_stats.read_runs(log_file),
+                                      limit=limit)
+        if json_output:
+            json_result[config['name']] = summary
+            continue
+        print(config['name'])
+        if verbose:
+            print('  run log:', log_file)
+        print('  runs:', summary['runs'])
+        if not summary['runs']:
+            continue
+        print('  slowest commands:')
+        for run in summary['slowest']:
+            print('   ', run_line(run))
+        if summary['memory']:
+            print('  memory peaks:')
+            for run in summary['memory']:
+                print('   ', run_line(run))
+        for title, items in (
+                ('programs', sorted(summary['programs'].items(),
+                                    key=lambda i: -i[1]['mean_wall'])),
+                ('images', [(i[0], i[2]) for i in summary['images']])):
+            print('  %s:' % title)
+            for item, s in items:
+                print('    %s: %d runs, mean wall %.2fs (max %.2fs), '
+                      'mean CPU %s, max memory %s'
+                      % (item, s['runs'], s['mean_wall'], s['max_wall'],
+                         '-' if s['mean_cpu'] is None
+                         else '%.2fs' % s['mean_cpu'],
+                         mib(s['max_rss'])))
+    if json_output:
+        json_module.dump(json_result, sys.stdout, indent=2)
@@ -1,15 +1,38 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division, print_function
 
+import hashlib
+import json
+import os
+import os.path as osp
+import threading
+import time
+
 try:
     # Python 2 imports
-    from urllib import urlopen
+    from urllib2 import HTTPError
     from HTMLParser import HTMLParser
 except ImportError:
     # Python 3 imports
-    from urllib.request import urlopen
+    from urllib.error import HTTPError
     from html.parser import HTMLParser
 
+from casa_distro.http_session import default_session
+
+
+# Default delay (in seconds) during which a directory listing is reused
+# without contacting the server. Afterwards, the listing is revalidated
+# using a conditional request. It can be set with the
+# CASA_DISTRO_LISTDIR_TTL environment variable.
+default_listdir_ttl = 600.
+
+# Name of the images catalog file of download directories
+catalog_basename = 'catalog.json'
+
+# In-process memo of directory listings: {url: (time, entries)}
+_listdir_memo = {}
+_listdir_lock = threading.Lock()
+
 
 class ListdirHTMLParser(HTMLParser):
 
@@ -43,12 +66,159 @@ def handle_data(self, data):
             self.listdir.append(data)
 
 
-def url_listdir(url):
+def listdir_cache_directory():
+    '''
+    Return the directory where directory listings and image catalogs are
+    cached: $XDG_CACHE_HOME/casa-distro/listdir
+    (~/.cache/casa-distro/listdir by default).
+    '''
+    xdg_cache_home = os.environ.get('XDG_CACHE_HOME', '')
+    if not xdg_cache_home:
+        xdg_cache_home = osp.expanduser('~/.cache')
+    return osp.join(xdg_cache_home, 'casa-distro', 'listdir')
+
+
+def listdir_ttl():
+    '''
+    Return the time (in seconds) during which a cached directory listing is
+    used without contacting the server.
+    '''
+    ttl = os.environ.get('CASA_DISTRO_LISTDIR_TTL')
+    if ttl:
+        return float(ttl)
+    return default_listdir_ttl
+
+
+def _listdir_cache_file(url):
+    return osp.join(listdir_cache_directory(),
+                    hashlib.sha1(url.encode('utf8')).hexdigest() + '.json')
+
+
+def _read_listdir_cache(url):
+    try:
+        with open(_listdir_cache_file(url)) as f:
+            cached = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if cached.get('url') != url:
+        return None
+    return cached
+
+
+def _write_listdir_cache(url, cached):
+    # Errors are ignored: the cache is only an optimization.
+    cache_file = _listdir_cache_file(url)
+    tmp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+    try:
+        if not osp.isdir(osp.dirname(cache_file)):
+            os.makedirs(osp.dirname(cache_file))
+        with open(tmp_file, 'w') as f:
+            json.dump(cached, f)
+        os.rename(tmp_file, cache_file)
+    except (IOError, OSError):
+        pass
+
+
+def clear_listdir_memo():
+    '''
+    Forget directory listings and catalogs memorized in the current process.
+    The on-disk cache is kept.
+    '''
+    with _listdir_lock:
+        _listdir_memo.clear()
+
+
+def _cached_url_get(url, parse, ttl=None):
+    '''
+    Get the content of an URL, parsed by the function ``parse`` into a
+    JSON-compatible value, using the in-process memo and the on-disk cache
+    (see :func:`url_listdir`).
+    '''
+    if ttl is None:
+        ttl = listdir_ttl()
+    now = time.time()
+    with _listdir_lock:
+        memo = _listdir_memo.get(url)
+    if memo is not None and now - memo[0] < ttl:
+        return memo[1]
+
+    cached = _read_listdir_cache(url)
+    if cached is not None and 0 <= now - cached['time'] < ttl:
+        data = cached['data']
+        now = cached['time']
+    else:
+        headers = {}
+        if cached is not None:
+            if cached.get('etag'):
+                headers['If-None-Match'] = cached['etag']
+            if cached.get('last_modified'):
+                headers['If-Modified-Since'] = cached['last_modified']
+        try:
+            response = default_session().request(url, headers=headers)
+        except HTTPError as e:
+            if e.code != 304 or cached is None:
+                raise
+            # not modified
+            data = cached['data']
+            cached['time'] = now
+        else:
+            data = parse(response.read().decode('utf8'))
+            cached = {'url': url,
+                      'time': now,
+                      'etag': response.headers.get('ETag'),
+                      'last_modified': response.headers.get('Last-Modified'),
+                      'data': data}
+        _write_listdir_cache(url, cached)
+    with _listdir_lock:
+        _listdir_memo[url] = (now, data)
+    return data
+
+
+def _parse_listdir(html):
+    parser = ListdirHTMLParser()
+    parser.feed(html)
+    return parser.listdir[1:]
+
+
+def url_listdir(url, ttl=None):
     '''
     Return the list of file or directory entries given a web URL corresponding
     to a directory. This function is specialized in parsing directories as
     returned by an Apache server when no index.html file is present.
+
+    Listings are memorized in the current process and cached on disk (see
+    :func:`listdir_cache_directory`). A cached listing younger than ``ttl``
+    seconds (default: :func:`listdir_ttl`) is returned without contacting
+    the server. An older one is revalidated using the ETag and
+    Last-Modified headers sent by the server, so that an unchanged listing
+    is not downloaded and parsed again. A ``ttl`` of 0 always revalidates.
     '''
-    parser = ListdirHTMLParser()
-    parser.feed(urlopen(url).read().decode('utf8'))
-    return parser.listdir[1:]
+    return list(_cached_url_get(url, _parse_listdir, ttl=ttl))
+
+
+def url_catalog(url, ttl=None):
+    '''
+    Return the images catalog of a download directory, as written by the
+    ``publish_base_image`` and ``publish_user_image`` commands in the
+    :data:`catalog_basename` file, or None if the directory has no catalog.
+
+    The catalog is a dictionary whose keys are image file names, and values
+    are dictionaries with the "name", "version", "patch", "image_id", "md5",
+    "size" and "compatibility" items of images metadata. It is cached as
+    directory listings are (see :func:`url_listdir`).
+    '''
+    catalog_url = '%s/%s' % (url.rstrip('/'), catalog_basename)
+    try:
+        catalog = _cached_url_get(catalog_url, json.loads, ttl=ttl)
+    except HTTPError as e:
+        if e.code != 404:
+            raise
+        catalog = None
+        with _listdir_lock:
+            _listdir_memo[catalog_url] = (time.time(), None)
+    except ValueError:
+        # corrupted catalog: ignore it
+        catalog = None
+    if catalog is None:
+        return None
+    return catalog.get('images')
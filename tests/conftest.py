@@ -1,5 +1,20 @@
 # -*- coding: utf-8 -*-
 
+import hashlib
+import json
+import os
+import re
+import signal
+import sys
+import threading
+import time
+
+try:
+    from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+    from email.utils import formatdate
+except ImportError:
+    SimpleHTTPRequestHandler = ThreadingHTTPServer = None
+
 import pytest
 
 
@@ -7,3 +22,273 @@
 def isolate_from_home(tmp_path, monkeypatch):
     monkeypatch.setenv("HOME", str(tmp_path))
     monkeypatch.delenv("CASA_BASE_DIRECTORY", raising=False)
+    monkeypatch.delenv("XDG_CACHE_HOME", raising=False)
+    monkeypatch.delenv("CASA_DISTRO_HASH_CACHE", raising=False)
+
+
+class RangeHTTPRequestHandler(SimpleHTTPRequestHandler):
+    '''
+    Static files HTTP/1.1 handler supporting Range requests, used to test
+    downloads. Directories are listed as an Apache server does, with ETag
+    and Last-Modified headers. Requests are recorded in the server
+    ``requests`` list as ``(method, path, range)`` tuples.
+    '''
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        self.server.connections += 1
+        SimpleHTTPRequestHandler.setup(self)
+
+    def record_request(self):
+        server = self.server
+        server.requests.append((self.command, self.path,
+                                self.headers.get('Range')))
+        if server.latency:
+            time.sleep(server.latency)
+
+    def do_HEAD(self):
+        self.record_request()
+        SimpleHTTPRequestHandler.do_HEAD(self)
+
+    def do_GET(self):
+        server = self.server
+        self.record_request()
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            return self.send_apache_listing(path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        with open(path, 'rb') as f:
+            data = f.read()
+        start = 0
+        rng = self.headers.get('Range')
+        if rng and server.ranges:
+            m = re.match(r'bytes=(\d+)-(\d*)$', rng)
+            start = int(m.group(1))
+            end = len(data) - 1
+            if m.group(2):
+                end = min(int(m.group(2)), end)
+            body = data[start:end + 1]
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             'bytes %d-%d/%d' % (start, end, len(data)))
+        else:
+            body = data
+            self.send_response(200)
+        if server.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if rng and start in server.stall:
+            # simulate a stalled connection, once
+            server.stall.discard(start)
+            time.sleep(server.stall_delay)
+        try:
+            self.wfile.write(body)
+        except (IOError, OSError):
+            pass  # client gave up
+
+    def send_apache_listing(self, path):
+        entries = sorted(
+            e + '/' if os.path.isdir(os.path.join(path, e)) else e
+            for e in os.listdir(path))
+        body = ''.join(['<table><tr><th>Name</th></tr>',
+                        '<tr><td><a href="../">Parent Directory</a></td>'
+                        '</tr>']
+                       + ['<tr><td><a href="%s">%s</a></td></tr>' % (e, e)
+                          for e in entries]
+                       + ['</table>']).encode('utf8')
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified',
+                         formatdate(os.stat(path).st_mtime, usegmt=True))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def http_server(tmp_path):
+    '''
+    Local HTTP server serving files of a temporary directory. The server
+    object has the additional attributes:
+
+    url:
+        base URL of the server
+    directory:
+        served directory
+    requests:
+        list of received requests
+    connections:
+        number of connections opened by clients
+    ranges:
+        set to False to disable support of Range requests
+    stall:
+        set of range start positions for which the response will stall once
+    latency:
+        delay (in seconds) added before each response
+    '''
+    if ThreadingHTTPServer is None:
+        pytest.skip('http.server.ThreadingHTTPServer is not available')
+    directory = tmp_path / 'www'
+    directory.mkdir()
+
+    class Handler(RangeHTTPRequestHandler):
+        def __init__(self, *args, **kwargs):
+            kwargs['directory'] = str(directory)
+            RangeHTTPRequestHandler.__init__(self, *args, **kwargs)
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    server.url = 'http://127.0.0.1:%d' % server.server_address[1]
+    server.directory = str(directory)
+    server.requests = []
+    server.connections = 0
+    server.ranges = True
+    server.stall = set()
+    server.stall_delay = 2.
+    server.latency = 0
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+fake_singularity_script = '''#!{python}
+import json
+import os
+import signal
+import subprocess
+import sys
+
+state = {state!r}
+with open({calls!r}, 'a') as f:
+    f.write(' '.join(sys.argv[1:]) + '\\n')
+args = sys.argv[1:]
+if args == ['--version']:
+    print('apptainer version 1.2.0')
+elif args[:1] == ['run'] and 'instance://' not in ' '.join(args):
+    # behaviour of the container command, used to test bv
+    if os.environ.get('FAKE_SINGULARITY_SLEEP'):
+        import time
+        time.sleep(float(os.environ['FAKE_SINGULARITY_SLEEP']))
+    sys.exit(int(os.environ.get('FAKE_SINGULARITY_EXIT', 0)))
+elif args[:1] == ['build']:
+    # the image is a copy of the recipe
+    with open(args[-1]) as f:
+        recipe = f.read()
+    with open(args[-2], 'w') as f:
+        f.write(recipe)
+elif args[:2] == ['sif', 'add']:
+    # the partition is appended to the image
+    with open(args[-1]) as f:
+        partition = f.read()
+    with open(args[-2], 'a') as f:
+        f.write(partition)
+elif args[:2] == ['instance', 'start']:
+    # the instance is simulated by a sleeping process
+    with open(os.devnull, 'r+') as devnull:
+        process = subprocess.Popen(['sleep', '1000'], stdin=devnull,
+                                   stdout=devnull, stderr=devnull,
+                                   start_new_session=True)
+    with open(os.path.join(state, args[-1]), 'w') as f:
+        f.write(str(process.pid))
+elif args[:2] == ['instance', 'list']:
+    instances = []
+    if os.path.exists(os.path.join(state, args[-1])):
+        with open(os.path.join(state, args[-1])) as f:
+            instances.append({{'instance': args[-1], 'pid': int(f.read())}})
+    print(json.dumps({{'instances': instances}}))
+elif args[:2] == ['instance', 'stop']:
+    if os.path.exists(os.path.join(state, args[-1])):
+        with open(os.path.join(state, args[-1])) as f:
+            os.kill(int(f.read()), signal.SIGTERM)
+        os.unlink(os.path.join(state, args[-1]))
+'''
+
+
+@pytest.fixture
+def fake_singularity(tmp_path, monkeypatch):
+    '''
+    Environment named "test", of type run, with a fake singularity
+    executable which records its arguments in a file, one line per call.
+    Instances are simulated by sleeping processes.
+
+    Returns
+    -------
+    ``(base_directory, config_file, calls_file)``
+    '''
+    from casa_distro import singularity
+
+    calls = tmp_path / 'calls.txt'
+    state = tmp_path / 'fake_instances'
+    state.mkdir()
+    executable = tmp_path / 'bin' / 'singularity'
+    executable.parent.mkdir()
+    executable.write_text(fake_singularity_script.format(
+        python=sys.executable, state=str(state), calls=str(calls)))
+    executable.chmod(0o755)
+    monkeypatch.setattr(singularity, '_singularity_executable',
+                        str(executable))
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    monkeypatch.setenv('XDG_RUNTIME_DIR', str(tmp_path / 'run'))
+    monkeypatch.delenv('DISPLAY', raising=False)
+    monkeypatch.delenv('CASA_DISTRO_INSTANCE', raising=False)
+    base = tmp_path / 'base'
+    env_dir = base / 'test'
+    (env_dir / 'conf').mkdir(parents=True)
+    (env_dir / 'image.sif').write_text('image')
+    config = env_dir / 'conf' / 'casa_distro.json'
+    config.write_text(json.dumps({'name': 'test',
+                                  'system': 'ubuntu-22.04',
+                                  'distro': 'opensource',
+                                  'container_type': 'singularity',
+                                  'image': str(env_dir / 'image.sif')}))
+    try:
+        yield str(base), str(config), calls
+    finally:
+        for name in os.listdir(str(state)):
+            with open(str(state / name)) as f:
+                try:
+                    os.kill(int(f.read()), signal.SIGTERM)
+                except OSError:
+                    pass
+
+
+@pytest.fixture
+def fake_mksquashfs(tmp_path, monkeypatch):
+    '''
+    Fake mksquashfs executable, put first in the PATH, whose "squashfs
+    image" is the sorted list of the files of the directory.
+
+    Returns
+    -------
+    path of the executable
+    '''
+    mksquashfs = tmp_path / 'bin' / 'mksquashfs'
+    if not mksquashfs.parent.is_dir():
+        mksquashfs.parent.mkdir()
+    mksquashfs.write_text('''#!/bin/sh
+cd "$1" && find . | sort > "$2"
+''')
+    mksquashfs.chmod(0o755)
+    monkeypatch.setenv('PATH', '%s:%s' % (mksquashfs.parent,
+                                          os.environ['PATH']))
+    return mksquashfs
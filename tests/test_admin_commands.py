@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+
+import pytest
+
+from casa_distro import admin_commands
+
+
+pytestmark = pytest.mark.usefixtures("isolate_from_home")
+
+
+def test_user_image_fingerprint(tmp_path):
+    install = tmp_path / 'install'
+    install.mkdir()
+    (install / 'file').write_bytes(b'data')
+    metadata = {'name': 'test', 'version': '5.4.0', 'origin_run': 'run-id'}
+    fingerprint = admin_commands.user_image_fingerprint(
+        str(install), metadata, 'none')
+    assert admin_commands.user_image_fingerprint(
+        str(install), metadata, 'none') == fingerprint
+    # another base run image
+    assert admin_commands.user_image_fingerprint(
+        str(install), dict(metadata, origin_run='other-id'),
+        'none') != fingerprint
+    # third-party software
+    assert admin_commands.user_image_fingerprint(
+        str(install), metadata,
+        'spm12-standalone=%s' % tmp_path) != fingerprint
+    # modified third-party software
+    thirdparty = tmp_path / 'spm12-standalone'
+    thirdparty.mkdir()
+    (thirdparty / 'run_spm12.sh').write_bytes(b'v1')
+    spm = admin_commands.user_image_fingerprint(
+        str(install), metadata, 'spm12-standalone=%s' % thirdparty)
+    (thirdparty / 'spm12_mcr').write_bytes(b'mcr')
+    assert admin_commands.user_image_fingerprint(
+        str(install), metadata,
+        'spm12-standalone=%s' % thirdparty) != spm
+
+
+def test_incremental_install(tmp_path):
+    install = tmp_path / 'install'
+    build = tmp_path / 'build'
+    for d in ('bin', 'python/pkg/__pycache__', 'old'):
+        (install / d).mkdir(parents=True)
+    for f in ('bin/bv_env', 'bin/removed', 'python/pkg/m.py',
+              'python/pkg/__pycache__/m.cpython-312.pyc',
+              'python/pkg/__pycache__/gone.cpython-312.pyc',
+              'old/file'):
+        (install / f).write_text('data')
+        # files of a previous install
+        os.utime(str(install / f), (1000000, 1000000))
+    os.symlink('bv_env', str(install / 'bin' / 'link'))
+    # written by this install but not listed in manifests
+    (install / 'bin' / 'generated').write_text('data')
+    inode = os.stat(str(install / 'bin' / 'bv_env')).st_ino
+
+    (build / 'project').mkdir(parents=True)
+    (build / 'project' / 'install_manifest_runtime.txt').write_text(
+        '/casa/host/install/bin/bv_env\n'
+        '/casa/host/install/bin/link\n'
+        '/casa/host/install/python/pkg/m.py\n')
+    # manifest of a previous install
+    old_manifest = build / 'install_manifest_old.txt'
+    old_manifest.write_text('/casa/host/install/bin/removed\n')
+    os.utime(str(old_manifest), (1000000, 1000000))
+
+    assert admin_commands.installed_files(
+        str(tmp_path / 'empty'), 0, '/casa/host/install') is None
+    installed = admin_commands.installed_files(
+        str(build), 1000010, '/casa/host/install')
+    assert installed == {'bin/bv_env', 'bin/link', 'python/pkg/m.py'}
+
+    removed = admin_commands.prune_install_tree(str(install), installed,
+                                                1000010)
+    assert sorted(removed) == ['bin/removed', 'old/file',
+                               'python/pkg/__pycache__/gone.cpython-312.pyc']
+    assert not (install / 'old').exists()
+    assert (install / 'python/pkg/__pycache__/m.cpython-312.pyc').exists()
+    assert os.path.islink(str(install / 'bin' / 'link'))
+    assert (install / 'bin' / 'generated').exists()
+    assert os.stat(str(install / 'bin' / 'bv_env')).st_ino == inode
+
+
+def test_create_user_image_overlay_builder(fake_singularity, fake_mksquashfs,
+                                           tmp_path):
+    base, config, calls = fake_singularity
+    env_dir = os.path.join(base, 'dev')
+    os.makedirs(os.path.join(env_dir, 'conf'))
+    os.makedirs(os.path.join(env_dir, 'install', 'bin'))
+    with open(os.path.join(env_dir, 'install', 'bin', 'bv_env'), 'w') as f:
+        f.write('bv_env')
+    with open(os.path.join(env_dir, 'conf', 'casa_distro.json'), 'w') as f:
+        json.dump({'name': 'dev', 'type': 'dev', 'distro': 'opensource',
+                   'system': 'ubuntu-22.04', 'image_version': '5.4',
+                   'container_type': 'singularity',
+                   'image': os.path.join(env_dir, 'dev.sif')}, f)
+    with open(os.path.join(env_dir, 'dev.sif.json'), 'w') as f:
+        json.dump({'origin_run': 'run-id'}, f)
+    run_image = os.path.join(base, 'casa-run-5.4.sif')
+    with open(run_image, 'w') as f:
+        f.write('run image\n')
+    with open(run_image + '.json', 'w') as f:
+        json.dump({'image_id': 'run-id'}, f)
+
+    admin_commands.create_user_image(
+        version='5.4.0', environment_name='dev', base_directory=base,
+        install='no', install_thirdparty='none', verbose='no',
+        builder='overlay')
+
+    output = os.path.join(base, 'opensource-5.4.0.sif')
+    with open(output) as f:
+        assert './casa/install/bin/bv_env' in f.read()
+    with open(output + '.json') as f:
+        assert json.load(f)['builder'] == 'overlay'
+    assert '--parttype 4' in calls.read_text()
+
+
+def test_numbered_file_script(tmp_path):
+    import hashlib
+    import subprocess
+    import sys
+
+    def run(metadata):
+        script = tmp_path / 'script.py'
+        script.write_text(admin_commands._numbered_file_script(
+            str(publish / 'image.sif.json'), metadata))
+        return subprocess.check_output(
+            [sys.executable, str(script)]).decode().splitlines()
+
+    publish = tmp_path / 'publish'
+    publish.mkdir()
+    (publish / 'image.sif').write_bytes(b'image')
+    with open(str(publish / 'image.sif.json'), 'w') as f:
+        json.dump({'image_id': 'a',
+                   'md5': hashlib.md5(b'image').hexdigest()}, f)
+    assert run({'image_id': 'a'})[2] == '-- up-to-date --'
+    assert run({'image_id': 'b'}) == [str(publish / 'image-1.sif.json'),
+                                      '1']
+    # the hash cache is not written in the published directory
+    assert sorted(os.listdir(str(publish))) == [
+        'image-1.sif.json', 'image.sif', 'image.sif.json']
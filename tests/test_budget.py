@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+from casa_distro import budget
+from casa_distro import run_stats
+
+
+pytestmark = pytest.mark.usefixtures("isolate_from_home")
+
+
+def test_parse_budget():
+    assert budget.parse_cpu_list('0-3,8, 2') == [0, 1, 2, 3, 8]
+    assert budget.parse_cpu_list([3, 1]) == [1, 3]
+    with pytest.raises(ValueError):
+        budget.parse_cpu_list('0-a')
+    assert budget.parse_memory('512M') == 512 * 1024 ** 2
+    assert budget.parse_memory('1.5g') == 1.5 * 1024 ** 3
+    with pytest.raises(ValueError):
+        budget.parse_memory('a lot')
+
+    config = {'cpus': 4, 'memory': '8G'}
+    assert budget.resource_budget(config, cpus='2.5') == {
+        'cpus': 2.5, 'memory': 8 * 1024 ** 3, 'cpu_affinity': None}
+    run_budget = budget.resource_budget(config, cpu_affinity='0-2')
+    assert budget.thread_count(run_budget) == 3
+    env = budget.thread_environment(run_budget)
+    assert env['OMP_NUM_THREADS'] == env['OPENBLAS_NUM_THREADS'] == '3'
+    assert budget.thread_environment(budget.resource_budget({})) == {}
+
+
+@pytest.mark.skipif(not hasattr(os, 'sched_setaffinity'),
+                    reason='CPU affinity is not supported')
+def test_affinity():
+    cpu = min(os.sched_getaffinity(0))
+    output = subprocess.check_output(
+        [sys.executable, '-c', 'import os; print(os.sched_getaffinity(0))'],
+        preexec_fn=budget.affinity_setter([cpu]), universal_newlines=True)
+    assert output.strip() == str({cpu})
+    retval, rusage = run_stats.call(
+        [sys.executable, '-c',
+         'import os, sys; sys.exit(len(os.sched_getaffinity(0)))'],
+        preexec_fn=budget.affinity_setter([cpu]))
+    assert retval == 1
+
+
+def test_budget_launch_plan(fake_singularity):
+    from casa_distro.environment import (container_launch_plan,
+                                         select_environment)
+
+    base_directory, config, calls = fake_singularity
+
+    def plan(resources, env=None):
+        return container_launch_plan(
+            select_environment(base_directory, name='test'), gui=False,
+            opengl='container', root=False, cwd=None, env=env, image=None,
+            container_options=None, base_directory=base_directory,
+            resources=resources)
+
+    # the fake singularity does not support cgroups options: only the
+    # number of threads is limited, the container is not bound to CPUs
+    result = plan({'cpus': '1', 'memory': '1G'})
+    assert '--cpus' not in result['argv']
+    assert result['cpu_affinity'] is None
+    assert result['container_env']['OMP_NUM_THREADS'] == '1'
+
+    result = plan({'cpus': '1', 'cpu_affinity': '0'})
+    assert result['cpu_affinity'] == [0]
+
+    result = plan({'cpu_affinity': '0'}, env={'OMP_NUM_THREADS': '4'})
+    assert result['container_env']['OMP_NUM_THREADS'] == '4'
+    assert result['container_env']['MKL_NUM_THREADS'] == '1'
+
+    with pytest.raises(ValueError):
+        plan({'cpu_affinity': [max(os.sched_getaffinity(0)) + 1]})
+
+
+def test_budget_cgroups_options(fake_singularity, monkeypatch):
+    from casa_distro import singularity
+    from casa_distro.environment import (container_launch_plan,
+                                         select_environment)
+
+    base_directory, config, calls = fake_singularity
+    monkeypatch.setattr(singularity, '_cgroups_limits_supported',
+                        lambda root: True)
+    result = container_launch_plan(
+        select_environment(base_directory, name='test'), gui=False,
+        opengl='container', root=False, cwd=None, env=None, image=None,
+        container_options=None, base_directory=base_directory,
+        resources={'cpus': '2.5', 'memory': '1G'})
+    argv = result['argv']
+    assert argv[argv.index('--cpus') + 1] == '2.5'
+    assert argv[argv.index('--memory') + 1] == str(1024 ** 3)
+    assert result['cpu_affinity'] is None
+    assert result['container_env']['OMP_NUM_THREADS'] == '2'
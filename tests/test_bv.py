@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import pytest
+
+
+pytestmark = pytest.mark.usefixtures("isolate_from_home")
+
+source_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def bv(fake_singularity, tmp_path):
+    '''
+    bv script of the environment of the fake_singularity fixture. Returns
+    a function which starts bv with the given arguments and environment
+    variables.
+    '''
+    base_directory, config, calls = fake_singularity
+    env_dir = os.path.join(base_directory, 'test')
+    os.mkdir(os.path.join(env_dir, 'bin'))
+    os.symlink(os.path.join(source_directory, 'bin', 'bv'),
+               os.path.join(env_dir, 'bin', 'bv'))
+    os.symlink(source_directory, os.path.join(env_dir, 'casa-distro'))
+
+    def start(args, **environ):
+        env = dict(os.environ)
+        env['PATH'] = os.pathsep.join([str(tmp_path / 'bin'),
+                                       env.get('PATH', '')])
+        env.pop('PYTHONPATH', None)
+        env.update(environ)
+        return subprocess.Popen([sys.executable,
+                                 os.path.join(env_dir, 'bin', 'bv')] + args,
+                                env=env, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                universal_newlines=True)
+
+    start.calls = calls
+    return start
+
+
+def test_bv_run(bv):
+    process = bv(['anatomist'])
+    stdout, stderr = process.communicate()
+    assert process.returncode == 0, stderr
+    runs = [line for line in bv.calls.read_text().splitlines()
+            if line.startswith('run ')]
+    assert len(runs) == 1 and runs[0].endswith('image.sif anatomist')
+
+
+def test_bv_exit_code(bv):
+    process = bv(['false'], FAKE_SINGULARITY_EXIT='3')
+    process.communicate()
+    assert process.returncode == 3
+
+
+def test_bv_interrupted(bv):
+    process = bv(['anatomist'], FAKE_SINGULARITY_SLEEP='30')
+    start = time.time()
+    while not (bv.calls.exists() and 'anatomist' in bv.calls.read_text()):
+        assert time.time() - start < 10
+        time.sleep(0.05)
+    process.send_signal(signal.SIGINT)
+    stdout, stderr = process.communicate()
+    # as with the default handler, bv is terminated by SIGINT without
+    # displaying a stack trace
+    assert process.returncode == -signal.SIGINT
+    assert 'Traceback' not in stderr
+
+
+def test_bv_trace(bv, tmp_path):
+    from casa_distro.trace import read_trace
+
+    trace_file = str(tmp_path / 'trace.json')
+    process = bv(['anatomist'], CASA_DISTRO_TRACE=trace_file)
+    process.communicate()
+    assert process.returncode == 0
+    with open(trace_file) as f:
+        assert f.readline() == '[\n'
+    events = {e['name']: e for e in read_trace(trace_file)}
+    for name in ('bv startup', 'casa_distro run', 'select_environment',
+                 'prepare homedir', 'validate binds', 'container command',
+                 'bv'):
+        assert events[name]['ph'] == 'X'
+    assert events['container command']['args']['exit_code'] == 0
+    # spans are nested in the bv span
+    bv_span = events['bv']
+    for event in events.values():
+        assert event['ts'] >= bv_span['ts']
+        assert (event['ts'] + event['dur']
+                <= bv_span['ts'] + bv_span['dur'] + 1)
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 
+import shutil
 import subprocess
+import sys
 
 import pytest
 
@@ -51,3 +53,24 @@ def test_distro_subcommand():
     stdoutdata, _ = p.communicate()
     assert p.returncode == 0
     assert 'brainvisa' in stdoutdata
+
+
+def test_startup_imports():
+    # modules which are only needed by some commands must not be imported
+    # when casa_distro starts
+    heavy = {'casa_distro.web', 'casa_distro.http_session',
+             'casa_distro.bbi_daily', 'casa_distro.hash', 'casa_distro.vbox',
+             'casa_distro.docker', 'casa_distro.apptainer_pixi',
+             'http.client', 'ssl', 'sqlite3', 'brainvisa_cmake'}
+    p = subprocess.Popen([sys.executable, '-X', 'importtime',
+                          shutil.which('casa_distro'), '--help'],
+                         stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                         universal_newlines=True)
+    _, importtime = p.communicate()
+    assert p.returncode == 0
+    # lines of -X importtime: "import time: self | cumulative | module"
+    imported = set(line.split('|')[-1].strip()
+                   for line in importtime.splitlines()
+                   if line.startswith('import time:'))
+    assert 'casa_distro.user_commands' in imported
+    assert not heavy & imported
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import pytest
+
+from casa_distro.container_environment import (
+    environment_snapshot, write_bv_env_snapshot, _command_environment,
+    _snapshot_ignored_variables)
+
+
+pytestmark = pytest.mark.usefixtures("isolate_from_home")
+
+
+def test_environment_snapshot():
+    before = {'PATH': '/usr/bin:/bin', 'REMOVED': 'x', 'SAME': 'y',
+              'LD_LIBRARY_PATH': '/usr/local/lib', 'VALUE': 'old'}
+    after = {'PATH': '/casa/install/bin:/usr/bin:/bin', 'SAME': 'y',
+             'LD_LIBRARY_PATH': '/casa/install/lib:/usr/local/lib:/opt/lib',
+             'VALUE': 'new', 'NEW': 'a b'}
+    assert environment_snapshot(before, after) == [
+        'unset REMOVED',
+        'export LD_LIBRARY_PATH=/casa/install/lib"${LD_LIBRARY_PATH:+:'
+        '$LD_LIBRARY_PATH}":/opt/lib',
+        "export NEW='a b'",
+        'export PATH=/casa/install/bin"${PATH:+:$PATH}"',
+        'export VALUE=new',
+    ]
+
+
+def run_env(command, env):
+    result = _command_environment(command, env)
+    for name in _snapshot_ignored_variables:
+        result.pop(name, None)
+    return result
+
+
+def test_bv_env_snapshot(tmp_path, monkeypatch):
+    install = tmp_path / 'install'
+    (install / 'bin').mkdir(parents=True)
+    bv_env = install / 'bin' / 'bv_env'
+    bv_env.write_text('''#!/bin/sh
+export PATH=%s/bin:$PATH
+export LD_LIBRARY_PATH=%s/lib${LD_LIBRARY_PATH:+:$LD_LIBRARY_PATH}
+export BRAINVISA_SHARE="%s/share"
+unset UNWANTED
+exec "$@"
+''' % (install, install, install))
+    bv_env.chmod(0o755)
+    monkeypatch.setenv('UNWANTED', '1')
+    monkeypatch.delenv('LD_LIBRARY_PATH', raising=False)
+    snapshot = str(tmp_path / 'bv_env_snapshot')
+    write_bv_env_snapshot(str(install), snapshot)
+
+    # the snapshot gives the same environment as bv_env, including in an
+    # environment modified at run time
+    for ld_library_path in (None, '/usr/local/lib/mesa'):
+        env = dict(os.environ)
+        if ld_library_path:
+            env['LD_LIBRARY_PATH'] = ld_library_path
+        assert run_env([snapshot], env) == run_env([str(bv_env)], env)
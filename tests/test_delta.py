@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import os
+
+import pytest
+
+from casa_distro import delta
+from casa_distro.environment import update_image
+
+
+pytestmark = pytest.mark.usefixtures("isolate_from_home")
+
+
+@pytest.fixture
+def images(http_server, tmp_path):
+    '''
+    An old image, and a new one where data has been inserted, removed and
+    modified. The new one is published with its block checksums.
+    '''
+    old = os.urandom(4 * 1024 * 1024)
+    new = (old[:500000] + os.urandom(1000) + old[500000:2000000]
+           + old[2100000:3000000] + os.urandom(5000) + old[3005000:])
+    old_image = str(tmp_path / 'casa-run-5.0-1.sif')
+    with open(old_image, 'wb') as f:
+        f.write(old)
+    new_image = os.path.join(http_server.directory, 'casa-run-5.0-2.sif')
+    with open(new_image, 'wb') as f:
+        f.write(new)
+    with open(new_image + '.json', 'w') as f:
+        json.dump({'image_id': 'new', 'md5': hashlib.md5(new).hexdigest()},
+                  f)
+    delta.write_block_index(new_image)
+    return (old_image, http_server.url + '/casa-run-5.0-2.sif', new)
+
+
+def downloaded_bytes(http_server):
+    total = 0
+    for r in http_server.requests:
+        if r[2]:
+            start, end = r[2].split('=')[1].split('-')
+            total += int(end) - int(start) + 1
+    return total
+
+
+def test_iter_blocks(tmp_path):
+    data = os.urandom(2 * 1024 * 1024)
+    path = str(tmp_path / 'data')
+    with open(path, 'wb') as f:
+        f.write(data)
+    blocks = list(delta.iter_blocks(path))
+    assert sum(b[1] for b in blocks) == len(data)
+    for offset, length, digest in blocks:
+        assert delta.default_min_size <= length <= delta.default_max_size \
+            or offset + length == len(data)
+        assert hashlib.md5(data[offset:offset + length]).hexdigest() \
+            == digest
+    # blocks boundaries follow shifted data
+    with open(path, 'wb') as f:
+        f.write(b'x' * 100 + data)
+    shifted = set(b[2] for b in delta.iter_blocks(path))
+    assert len(shifted & set(b[2] for b in blocks)) >= len(blocks) - 2
+
+
+def test_delta_download(http_server, images, tmp_path):
+    old_image, url, new = images
+    dest = str(tmp_path / 'casa-run-5.0-2.sif')
+    control = json.loads(open(os.path.join(
+        http_server.directory, 'casa-run-5.0-2.sif.blocks.json')).read())
+    downloaded = delta.delta_download(
+        url, dest, old_image, control,
+        md5_check=hashlib.md5(new).hexdigest())
+    with open(dest, 'rb') as f:
+        assert f.read() == new
+    assert downloaded == downloaded_bytes(http_server)
+    assert downloaded < len(new) // 4
+
+
+def test_update_image_delta(http_server, images, tmp_path):
+    old_image, url, new = images
+    config = tmp_path / 'env' / 'conf' / 'casa_distro.json'
+    config.parent.mkdir(parents=True)
+    config.write_text(json.dumps({'image': old_image}))
+    # part of an interrupted full download, not used by the delta update
+    new_image = str(tmp_path / 'casa-run-5.0-2.sif')
+    with open(new_image + '.part', 'wb') as f:
+        f.write(new[:1000])
+    update_image(old_image, url, [str(config)], callback=None)
+    with open(new_image, 'rb') as f:
+        assert f.read() == new
+    with open(new_image + '.part', 'rb') as f:
+        assert f.read() == new[:1000]
+    assert not os.path.exists(new_image + '.lock')
+    assert json.loads(config.read_text())['image'] == new_image
+    assert not os.path.exists(old_image)
+    assert downloaded_bytes(http_server) < len(new) // 4
+
+
+def test_update_image_delta_fallback(http_server, images, tmp_path):
+    old_image, url, new = images
+    # wrong block checksums: the whole image is downloaded
+    control_file = os.path.join(http_server.directory,
+                                'casa-run-5.0-2.sif.blocks.json')
+    with open(control_file) as f:
+        control = json.load(f)
+    control['md5'] = ['0' * 32] * len(control['md5'])
+    with open(control_file, 'w') as f:
+        json.dump(control, f)
+    update_image(old_image, url, [], callback=None)
+    with open(str(tmp_path / 'casa-run-5.0-2.sif'), 'rb') as f:
+        assert f.read() == new
+    assert not os.path.exists(
+        str(tmp_path / 'casa-run-5.0-2.sif.delta.part'))
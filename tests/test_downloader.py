@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+from casa_distro import downloader
+
+
+pytestmark = pytest.mark.usefixtures("isolate_from_home")
+
+
+@pytest.fixture
+def remote_file(http_server):
+    data = os.urandom(1024 * 1024 + 123)
+    with open(os.path.join(http_server.directory, 'image.sif'), 'wb') as f:
+        f.write(data)
+    return http_server.url + '/image.sif', data
+
+
+def range_requests(http_server):
+    return [r[2] for r in http_server.requests if r[2]]
+
+
+def test_segmented_download(http_server, remote_file, tmp_path):
+    url, data = remote_file
+    dest = str(tmp_path / 'image.sif')
+    downloader.download_file_segmented(url, dest, segments=4)
+    with open(dest, 'rb') as f:
+        assert f.read() == data
+    assert len(range_requests(http_server)) == 4
+    assert not os.path.exists(dest + '.segments')
+
+
+def test_internal_download_without_range_support(http_server, remote_file,
+                                                 tmp_path):
+    http_server.ranges = False
+    url, data = remote_file
+    dest = str(tmp_path / 'image.sif')
+    downloader.download_file_internal(url, dest, segments=4)
+    with open(dest, 'rb') as f:
+        assert f.read() == data
+    assert range_requests(http_server) == []
+
+
+def test_segmented_download_stalled_segment(http_server, remote_file,
+                                            tmp_path):
+    url, data = remote_file
+    http_server.stall.add(0)
+    dest = str(tmp_path / 'image.sif')
+    downloader.download_file(url, dest, method='internal', segments=4,
+                             timeout=0.5)
+    with open(dest, 'rb') as f:
+        assert f.read() == data
+    # the first segment has been requested twice
+    starts = [r.split('=')[1].split('-')[0]
+              for r in range_requests(http_server)]
+    assert starts.count('0') == 2
+
+
+def test_segmented_download_stalled_server(tmp_path):
+    import socket
+    import threading
+
+    class StalledSession(object):
+        requests = 0
+
+        def get(self, url, headers=None, timeout=None):
+            self.requests += 1
+            raise socket.timeout('timed out')
+
+    session = StalledSession()
+    fd = os.open(str(tmp_path / 'image.sif'), os.O_WRONLY | os.O_CREAT)
+    try:
+        with pytest.raises(socket.timeout):
+            downloader._download_segment(
+                'http://server/image.sif', fd, [0, 1024], 0.1,
+                threading.Event(), max_retries=2, session=session)
+    finally:
+        os.close(fd)
+    assert session.requests == 3
+
+
+def test_segmented_download_continue(http_server, remote_file, tmp_path):
+    url, data = remote_file
+    dest = str(tmp_path / 'image.sif')
+    half = len(data) // 2
+    # simulate an interrupted download where only the first half is done
+    with open(dest, 'wb') as f:
+        f.write(data[:half])
+        f.write(b'\0' * (len(data) - half))
+    with open(dest + '.segments', 'w') as f:
+        json.dump({'url': url, 'size': len(data),
+                   'segments': [[half, len(data)]]}, f)
+    downloader.download_file_segmented(url, dest, segments=4,
+                                       allow_continue=True)
+    with open(dest, 'rb') as f:
+        assert f.read() == data
+    assert range_requests(http_server) == ['bytes=%d-%d'
+                                           % (half, len(data) - 1)]
+
+
+@pytest.mark.parametrize('method,segments', [
+    ('internal', 1),
+    ('internal', 4),
+    ('wget_no_dl', 1),
+])
+def test_md5_computed_while_downloading(http_server, remote_file, tmp_path,
+                                        monkeypatch, method, segments):
+    from casa_distro import hash
+
+    if method == 'wget_no_dl':
+        try:
+            downloader.wget_command(download_container=False)
+        except RuntimeError:
+            pytest.skip('wget is not installed')
+
+    def no_reread(path, *args, **kwargs):
+        raise AssertionError('the downloaded file should not be read again')
+
+    monkeypatch.setattr(hash, 'file_hash', no_reread)
+    url, data = remote_file
+    dest = str(tmp_path / 'image.sif')
+    md5 = hashlib.md5(data).hexdigest()
+    downloader.download_file(url, dest, method=method, segments=segments,
+                             md5_check=md5)
+    with open(dest, 'rb') as f:
+        assert f.read() == data
+
+    os.unlink(dest)
+    with pytest.raises(RuntimeError):
+        downloader.download_file(url, dest, method=method,
+                                 segments=segments, md5_check='0' * 32)
+
+
+def test_md5_continued_download(http_server, remote_file, tmp_path):
+    url, data = remote_file
+    dest = str(tmp_path / 'image.sif')
+    with open(dest + '.part', 'wb') as f:
+        f.write(data[:1000])
+    downloader.download_file(url, dest, method='internal',
+                             allow_continue=True,
+                             md5_check=hashlib.md5(data).hexdigest())
+    with open(dest, 'rb') as f:
+        assert f.read() == data
+    assert range_requests(http_server) == ['bytes=1000-%d' % len(data)]
+
+
+def test_continue_with_invalid_chunks(http_server, remote_file, tmp_path):
+    from casa_distro.hash import tree_hash
+
+    url, data = remote_file
+    source = os.path.join(http_server.directory, 'image.sif')
+    tree = tree_hash(source, chunk_size=1024 * 64, cache=False)
+    dest = str(tmp_path / 'image.sif')
+    # incomplete download with a corrupted third chunk
+    part = bytearray(data[:1024 * 300])
+    part[1024 * 150] ^= 0xff
+    with open(dest + '.part', 'wb') as f:
+        f.write(part)
+    downloader.download_file(url, dest, method='internal',
+                             allow_continue=True, tree_hash=tree,
+                             md5_check=hashlib.md5(data).hexdigest())
+    with open(dest, 'rb') as f:
+        assert f.read() == data
+    assert range_requests(http_server) == ['bytes=%d-%d'
+                                           % (1024 * 128, len(data))]
+
+
+def test_continue_segmented_with_invalid_chunks(http_server, remote_file,
+                                                tmp_path):
+    from casa_distro.hash import tree_hash
+
+    url, data = remote_file
+    source = os.path.join(http_server.directory, 'image.sif')
+    chunk = 1024 * 64
+    tree = tree_hash(source, chunk_size=chunk, cache=False)
+    dest = str(tmp_path / 'image.sif')
+    half = len(data) // 2
+    part = bytearray(data[:half])
+    part[chunk] ^= 0xff
+    with open(dest + '.part', 'wb') as f:
+        f.write(part)
+        f.write(b'\0' * (len(data) - half))
+    with open(dest + '.part.segments', 'w') as f:
+        json.dump({'url': url, 'size': len(data),
+                   'segments': [[half, len(data)]]}, f)
+    downloader.download_file(url, dest, method='internal', segments=4,
+                             allow_continue=True, tree_hash=tree,
+                             md5_check=hashlib.md5(data).hexdigest())
+    with open(dest, 'rb') as f:
+        assert f.read() == data
+    assert set(range_requests(http_server)) == {
+        'bytes=%d-%d' % (chunk, 2 * chunk - 1),
+        'bytes=%d-%d' % (half, len(data) - 1)}
+
+
+def download_process(url, dest, md5, rate=None):
+    '''
+    Run download_file in another process. The download is throttled to
+    ``rate`` bytes/s.
+    '''
+    script = '''
+import sys
+from casa_distro import downloader
+throttle = downloader.TokenBucket(%r, 1024) if %r else None
+downloader.download_file(%r, %r, method='internal', md5_check=%r,
+                         allow_continue=True, throttle=throttle,
+                         callback=downloader.stdout_progress)
+''' % (rate, rate, url, dest, md5)
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(downloader.__file__))]
+        + env.get('PYTHONPATH', '').split(os.pathsep))
+    return subprocess.Popen([sys.executable, '-c', script], env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+
+def wait_for(condition, timeout=10.):
+    start = time.time()
+    while not condition():
+        assert time.time() - start < timeout
+        time.sleep(0.05)
+
+
+def test_concurrent_processes(http_server, remote_file, tmp_path):
+    url, data = remote_file
+    md5 = hashlib.md5(data).hexdigest()
+    dest = str(tmp_path / 'image.sif')
+    first = download_process(url, dest, md5, rate=1024 * 1024)
+    wait_for(lambda: os.path.exists(dest + '.lock'))
+    second = download_process(url, dest, md5)
+    output = second.communicate()[0].decode()
+    assert first.wait() == 0
+    assert second.returncode == 0
+    assert 'is being downloaded by' in output
+    with open(dest, 'rb') as f:
+        assert f.read() == data
+    # the file has been downloaded once
+    assert [r[0] for r in http_server.requests
+            if r[1] == '/image.sif'].count('GET') == 1
+    assert not os.path.exists(dest + '.lock')
+
+
+def test_killed_process_lock(http_server, remote_file, tmp_path):
+    url, data = remote_file
+    md5 = hashlib.md5(data).hexdigest()
+    dest = str(tmp_path / 'image.sif')
+    first = download_process(url, dest, md5, rate=512 * 1024)
+    wait_for(lambda: os.path.exists(dest + '.part')
+             and os.stat(dest + '.part').st_size > 0)
+    first.kill()
+    first.wait()
+    assert os.path.exists(dest + '.lock')
+    # the lock is released by the system: the download is continued
+    downloader.download_file(url, dest, method='internal', md5_check=md5,
+                             allow_continue=True)
+    with open(dest, 'rb') as f:
+        assert f.read() == data
+    assert range_requests(http_server)
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import os
+import time
+
+import pytest
+
+from casa_distro import downloader
+from casa_distro.environment import update_images
+
+
+pytestmark = pytest.mark.usefixtures("isolate_from_home")
+
+
+def publish(http_server, name, data, md5=None):
+    with open(os.path.join(http_server.directory, name), 'wb') as f:
+        f.write(data)
+    with open(os.path.join(http_server.directory, name + '.json'), 'w') as f:
+        json.dump({'image_id': name,
+                   'md5': md5 or hashlib.md5(data).hexdigest()}, f)
+    return '%s/%s' % (http_server.url, name)
+
+
+def environment(tmp_path, name, image):
+    config = tmp_path / name / 'conf' / 'casa_distro.json'
+    config.parent.mkdir(parents=True)
+    config.write_text(json.dumps({'name': name, 'image': image}))
+    return str(config)
+
+
+def test_token_bucket():
+    bucket = downloader.TokenBucket(1024 * 1024, burst=1024)
+    start = time.time()
+    for i in range(8):
+        bucket.consume(64 * 1024)
+    assert time.time() - start >= 0.45
+
+
+def test_update_images(http_server, tmp_path):
+    images = tmp_path / 'images'
+    images.mkdir()
+    updates = []
+    data = {}
+    for name in ('a', 'b', 'c'):
+        image = str(images / ('%s-5.0-1.sif' % name))
+        data[name] = os.urandom(300 * 1024)
+        url = publish(http_server, '%s-5.0-2.sif' % name, data[name],
+                      md5='0' * 32 if name == 'c' else None)
+        updates.append((image, url, [environment(tmp_path, name, image)],
+                        None, True))
+    # a second environment using the same new image
+    updates.append((str(images / 'a-5.0-0.sif'), updates[0][1],
+                    [environment(tmp_path, 'a2', 'a-5.0-0.sif')], None,
+                    False))
+
+    start = time.time()
+    with pytest.raises(RuntimeError):
+        update_images(updates, connections=4, bandwidth=1024 * 1024)
+    # 900KiB at 1MiB/s (with a 1MiB burst)
+    assert time.time() - start < 2
+
+    for name in ('a', 'b'):
+        with open(str(images / ('%s-5.0-2.sif' % name)), 'rb') as f:
+            assert f.read() == data[name]
+    for name in ('a', 'a2', 'b'):
+        config = json.loads(
+            (tmp_path / name / 'conf' / 'casa_distro.json').read_text())
+        assert config['image'].endswith('%s-5.0-2.sif' % name[0])
+    # wrong md5: the image is not renamed and the config is not modified
+    assert not os.path.exists(str(images / 'c-5.0-2.sif'))
+    config = json.loads(
+        (tmp_path / 'c' / 'conf' / 'casa_distro.json').read_text())
+    assert config['image'] == str(images / 'c-5.0-1.sif')
+
+
+def run_bv(base_directory, command, container_options=None, exit_code=0):
+    import io
+    from casa_distro.environment import run_environment
+
+    verbose = io.StringIO()
+    retval = run_environment(base_directory, {'name': 'test'},
+                             command=command, gui=False, opengl='container',
+                             root=False, cwd=None, env=None, image=None,
+                             container_options=container_options,
+                             verbose=verbose)
+    assert retval == exit_code
+    return verbose.getvalue()
+
+
+def test_launch_plan_cache(fake_singularity, monkeypatch):
+    from casa_distro import environment
+
+    base_directory, config, calls = fake_singularity
+    assert 'resolved' in run_bv(base_directory, ['anatomist'])
+
+    def no_selection(*args, **kwargs):
+        raise AssertionError('the environment should not be selected')
+
+    with monkeypatch.context() as m:
+        m.setattr(environment, 'select_environment', no_selection)
+        assert 'cached' in run_bv(base_directory, ['brainvisa'])
+    lines = calls.read_text().splitlines()
+    assert len(lines) == 2
+    assert lines[0].endswith('image.sif anatomist')
+    assert lines[1] == lines[0].replace('anatomist', 'brainvisa')
+
+    # a modification of the configuration invalidates the plan
+    with open(config) as f:
+        data = json.load(f)
+    data['env'] = {'TEST_VAR': 'value'}
+    with open(config, 'w') as f:
+        json.dump(data, f)
+    os.utime(config, (time.time() + 10, time.time() + 10))
+    assert 'resolved' in run_bv(base_directory, ['anatomist'])
+    assert 'cached' in run_bv(base_directory, ['anatomist'])
+
+    # as well as a change of environment variables
+    monkeypatch.setenv('SOME_VARIABLE', '1')
+    assert 'resolved' in run_bv(base_directory, ['anatomist'])
+
+    # or of the CPUs the caller may run on
+    if hasattr(os, 'sched_getaffinity'):
+        assert 'cached' in run_bv(base_directory, ['anatomist'])
+        cpus = os.sched_getaffinity(0)
+        monkeypatch.setattr(os, 'sched_getaffinity',
+                            lambda pid: cpus | {max(cpus) + 1})
+        assert 'resolved' in run_bv(base_directory, ['anatomist'])
+
+
+def test_launch_plan_cache_failures(fake_singularity, monkeypatch, capfd):
+    base_directory, config, calls = fake_singularity
+    missing = os.path.join(base_directory, 'missing')
+    with open(config) as f:
+        data = json.load(f)
+    data['mounts'] = {'/missing': missing}
+    with open(config, 'w') as f:
+        json.dump(data, f)
+
+    # a failure of the command does not invalidate the plan, and skipped
+    # mounts are reported at each run
+    monkeypatch.setenv('FAKE_SINGULARITY_EXIT', '127')
+    assert 'resolved' in run_bv(base_directory, ['false'], exit_code=127)
+    assert missing in capfd.readouterr().err
+    assert 'cached' in run_bv(base_directory, ['false'], exit_code=127)
+    assert missing in capfd.readouterr().err
+    monkeypatch.delenv('FAKE_SINGULARITY_EXIT')
+
+    # a missing container runtime does
+    from casa_distro import environment
+    cache = environment.launch_plan_cache_directory()
+    plan_files = os.listdir(cache)
+    assert len(plan_files) == 1
+    with open(os.path.join(cache, plan_files[0])) as f:
+        plan = json.load(f)
+    assert environment._launch_plan_runnable(plan)
+    plan['argv'][0] += '-uninstalled'
+    assert not environment._launch_plan_runnable(plan)
+
+
+def test_environments_index(tmp_path, monkeypatch):
+    from casa_distro import environment
+
+    monkeypatch.setenv('XDG_CONFIG_HOME', str(tmp_path / 'config'))
+    monkeypatch.delenv('CASA_DIR', raising=False)
+    base = tmp_path / 'base'
+    base.mkdir()
+    for name in ('a', 'b'):
+        config = base / name / 'conf' / 'casa_distro.json'
+        config.parent.mkdir(parents=True)
+        config.write_text(json.dumps({'name': name,
+                                      'container_type': 'singularity'}))
+
+    def names(**filter):
+        return sorted(c['name'] for c in
+                      environment.iter_environments(str(base), **filter))
+
+    assert names() == ['a', 'b']
+    assert os.path.exists(environment.environments_index_file(str(base)))
+
+    # an unchanged file (same modification time, size and inode) is not
+    # read again
+    config = base / 'a' / 'conf' / 'casa_distro.json'
+    st = os.stat(str(config))
+    config.write_text(config.read_text().replace('"a"', '"x"'))
+    os.utime(str(config), ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert names() == ['a', 'b']
+    os.utime(str(config), ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    assert names() == ['b', 'x']
+    assert names(name='b') == ['b']
+
+    # environments added or removed by other processes
+    config = base / 'c' / 'conf' / 'casa_distro.json'
+    config.parent.mkdir(parents=True)
+    config.write_text(json.dumps({'name': 'c',
+                                  'container_type': 'singularity'}))
+    assert names() == ['b', 'c', 'x']
+    os.unlink(str(base / 'b' / 'conf' / 'casa_distro.json'))
+    assert names() == ['c', 'x']
+
+    # the user configuration is merged, but is not stored in the index
+    # which is shared by all users
+    user_config = environment.user_config_filename()
+    os.makedirs(os.path.dirname(user_config))
+    with open(user_config, 'w') as f:
+        json.dump({'env': {'USER_VAR': 'yes'}}, f)
+    [config] = environment.iter_environments(str(base), name='c')
+    assert config['env']['USER_VAR'] == 'yes'
+    assert config['config_files'][-1] == user_config
+    with open(environment.environments_index_file(str(base))) as f:
+        index = f.read()
+    assert 'USER_VAR' not in index and user_config not in index
+    # returned configurations are copies
+    config['env']['USER_VAR'] = 'no'
+    [config] = environment.iter_environments(str(base), name='c')
+    assert config['env']['USER_VAR'] == 'yes'
+
+
+def test_run_stats(fake_singularity, capsys):
+    from casa_distro import run_stats
+    from casa_distro.environment import container_home_directory
+    from casa_distro.user_commands import stats
+
+    base_directory, config, calls = fake_singularity
+    run_bv(base_directory, ['anatomist'])
+    run_bv(base_directory, ['brainvisa', '--help'])
+    # the environment has no home directory: the log is next to the
+    # container home directory in XDG_DATA_HOME
+    log_file = run_stats.run_log_file(container_home_directory(
+        {'directory': os.path.join(base_directory, 'test')}))
+    assert log_file.startswith(os.path.expanduser('~'))
+    runs = run_stats.read_runs(log_file)
+    assert [r['command'] for r in runs] == [['anatomist'],
+                                            ['brainvisa', '--help']]
+    for run in runs:
+        assert run['environment'] == 'test'
+        assert run['image'] == 'image.sif'
+        assert run['exit_code'] == 0
+        assert run['wall'] > 0 and run['max_rss'] > 0
+
+    summary = run_stats.summarize(runs, limit=1)
+    assert summary['runs'] == 2
+    assert len(summary['slowest']) == 1
+    assert set(summary['programs']) == {'anatomist', 'brainvisa'}
+    [(image, image_id, statistics)] = summary['images']
+    assert image == 'image.sif' and statistics['runs'] == 2
+
+    stats(base_directory=base_directory)
+    output = capsys.readouterr().out
+    assert 'runs: 2' in output
+    assert 'image.sif: 2 runs' in output
+
+    stats(base_directory=base_directory, json='yes')
+    result = json.loads(capsys.readouterr().out)
+    assert result['test']['runs'] == 2
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import os
+
+import pytest
+
+from casa_distro import hash
+
+
+pytestmark = pytest.mark.usefixtures("isolate_from_home")
+
+
+def write_file(path, data, mtime=None):
+    with open(path, 'wb') as f:
+        f.write(data)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+
+def test_file_hash_cache(tmp_path):
+    images = tmp_path / 'images'
+    images.mkdir()
+    image = str(images / 'image.sif')
+    write_file(image, b'a' * 1000, mtime=1000000)
+    md5 = hashlib.md5(b'a' * 1000).hexdigest()
+    assert hash.cached_file_hash(image) is None
+    assert hash.file_hash(image) == md5
+    assert hash.cached_file_hash(image) == md5
+    # the cache is not written in the (possibly published) image directory
+    assert os.listdir(str(images)) == ['image.sif']
+    assert os.path.exists(str(tmp_path / '.cache' / 'casa-distro'
+                              / hash.hash_cache_basename))
+
+    # same inode, size and mtime: the cached value is used without reading
+    # the file
+    write_file(image, b'b' * 1000, mtime=1000000)
+    assert hash.file_hash(image) == md5
+    assert hash.file_hash(image, cache=False) != md5
+
+    # file rewritten in place
+    write_file(image, b'b' * 1000, mtime=1000001)
+    assert hash.cached_file_hash(image) is None
+    assert hash.file_hash(image) == hashlib.md5(b'b' * 1000).hexdigest()
+
+
+def test_file_hash_cache_recent_file(tmp_path, monkeypatch):
+    monkeypatch.setenv('CASA_DISTRO_HASH_CACHE', str(tmp_path / 'hashes'))
+    image = str(tmp_path / 'image.sif')
+    write_file(image, b'a' * 1000)
+    assert hash.file_hash(image) == hashlib.md5(b'a' * 1000).hexdigest()
+    # the file may still be modified without changing its mtime
+    assert hash.cached_file_hash(image) is None
+
+
+def test_tree_hash(tmp_path):
+    image = str(tmp_path / 'image.sif')
+    data = os.urandom(10 * 1024 + 100)
+    write_file(image, data, mtime=1000000)
+    tree = hash.tree_hash(image, chunk_size=1024, workers=4)
+    chunks = [hashlib.sha256(data[i:i + 1024]).hexdigest()
+              for i in range(0, len(data), 1024)]
+    assert tree['chunks'] == chunks
+    assert tree['size'] == len(data)
+    assert tree['root'] == hashlib.sha256(
+        b''.join(bytes.fromhex(c) for c in chunks)).hexdigest()
+    # cached value
+    assert hash.tree_hash(image, chunk_size=1024) == tree
+    assert hash.invalid_chunks(image, tree) == []
+
+    # incomplete and corrupted file
+    corrupted = bytearray(data[:5000])
+    corrupted[3000] ^= 0xff
+    write_file(image, bytes(corrupted))
+    assert hash.invalid_chunks(image, tree) == [2]
+
+
+def test_directory_manifest(tmp_path):
+    install = tmp_path / 'install'
+    (install / 'bin').mkdir(parents=True)
+    (install / 'bin' / 'bv_env').write_bytes(b'env')
+    (install / 'lib' / '__pycache__').mkdir(parents=True)
+    (install / 'lib' / '__pycache__' / 'm.pyc').write_bytes(b'pyc')
+    os.symlink('bin/bv_env', str(install / 'bv_env'))
+    manifest = hash.directory_manifest(str(install))
+    assert manifest == {
+        'bin': {'dir': True},
+        'bin/bv_env': {'size': 3,
+                       'hash': hashlib.sha256(b'env').hexdigest()},
+        'lib': {'dir': True},
+        'bv_env': {'link': 'bin/bv_env'},
+    }
+    fingerprint = hash.manifest_fingerprint(manifest)
+
+    # compiled Python files are ignored
+    (install / 'lib' / '__pycache__' / 'm.pyc').write_bytes(b'new pyc')
+    assert hash.manifest_fingerprint(
+        hash.directory_manifest(str(install))) == fingerprint
+    # contents and symlinks changes are detected
+    (install / 'bin' / 'bv_env').write_bytes(b'ENV')
+    assert hash.manifest_fingerprint(
+        hash.directory_manifest(str(install))) != fingerprint
+    (install / 'bin' / 'bv_env').write_bytes(b'env')
+    os.unlink(str(install / 'bv_env'))
+    os.symlink('bin/other', str(install / 'bv_env'))
+    assert hash.manifest_fingerprint(
+        hash.directory_manifest(str(install))) != fingerprint
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+import os
+import socket
+import time
+
+import pytest
+
+from casa_distro.http_session import HTTPSession, HTTPError
+
+
+pytestmark = pytest.mark.usefixtures("isolate_from_home")
+
+
+@pytest.fixture
+def json_files(http_server):
+    urls = []
+    for i in range(8):
+        with open(os.path.join(http_server.directory,
+                               '%d.json' % i), 'w') as f:
+            f.write('{"image_id": "%d"}' % i)
+        urls.append('%s/%d.json' % (http_server.url, i))
+    return urls
+
+
+def test_keep_alive(http_server, json_files):
+    session = HTTPSession()
+    for url in json_files:
+        response = session.get(url)
+        assert response.getcode() == 200
+        assert response.read().startswith(b'{"image_id"')
+    assert http_server.connections == 1
+
+    with pytest.raises(HTTPError) as e:
+        session.get(http_server.url + '/missing.json')
+    assert e.value.code == 404
+    # the server closes the connection after an error
+    assert session.get(json_files[0]).read()
+    assert http_server.connections == 2
+
+
+def test_retry_closed_connection(http_server, json_files):
+    session = HTTPSession()
+    session.get(json_files[0]).read()
+    # simulate a server closing idle connections
+    for connections in session._idle.values():
+        for connection in connections:
+            connection.sock.shutdown(socket.SHUT_RDWR)
+    assert session.get(json_files[1]).read() == b'{"image_id": "1"}'
+
+
+def test_fetch_all(http_server, json_files):
+    http_server.latency = 0.2
+    session = HTTPSession(max_connections=4)
+    start = time.time()
+    results = session.fetch_all(json_files)
+    duration = time.time() - start
+    assert [data for response, data in results] == [
+        ('{"image_id": "%d"}' % i).encode() for i in range(8)]
+    # 8 requests on 4 concurrent connections
+    assert duration < 8 * 0.2
+    assert http_server.connections == 4
+
+    results = session.fetch_all(json_files + [http_server.url + '/missing'],
+                                return_exceptions=True)
+    assert isinstance(results[-1], HTTPError)
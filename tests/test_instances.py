@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+import json
+import time
+
+import pytest
+
+from casa_distro import instances
+
+from test_environment import run_bv
+
+
+pytestmark = pytest.mark.usefixtures("isolate_from_home")
+
+
+def wait_for(condition, timeout=10.):
+    start = time.time()
+    while not condition():
+        assert time.time() - start < timeout
+        time.sleep(0.1)
+
+
+def test_instance_mode(fake_singularity, monkeypatch):
+    base_directory, config, calls = fake_singularity
+    monkeypatch.setenv('CASA_DISTRO_INSTANCE', 'yes')
+    run_bv(base_directory, ['anatomist'])
+    run_bv(base_directory, ['brainvisa'])
+    lines = calls.read_text().splitlines()
+    assert len([line for line in lines
+                if line.startswith('instance start')]) == 1
+    runs = [line for line in lines if line.startswith('run ')]
+    assert len(runs) == 2
+    assert all('instance://casa-distro-test-' in line for line in runs)
+    assert runs[1].endswith(' brainvisa')
+
+    [state] = instances.list_instances()
+    assert state['running']
+    assert state['directory'].endswith('test')
+
+    # other options: the command is run in a new container
+    run_bv(base_directory, ['anatomist'], container_options=['--contain'])
+    last = calls.read_text().splitlines()[-1]
+    assert 'instance://' not in last
+    assert '--contain' in last and last.endswith('image.sif anatomist')
+
+    instances.stop_instance(state['name'])
+    assert instances.list_instances() == []
+    assert calls.read_text().splitlines()[-1].startswith('instance stop')
+
+
+def test_instance_idle_timeout(fake_singularity, monkeypatch):
+    base_directory, config, calls = fake_singularity
+    with open(config) as f:
+        data = json.load(f)
+    data['instance'] = True
+    data['instance_timeout'] = 1
+    with open(config, 'w') as f:
+        json.dump(data, f)
+    run_bv(base_directory, ['anatomist'])
+    assert [s['running'] for s in instances.list_instances()] == [True]
+    # the watchdog stops the idle instance
+    wait_for(lambda: instances.list_instances() == [])
+    assert calls.read_text().splitlines()[-1].startswith('instance stop')
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import subprocess
+
+import pytest
+
+from casa_distro import singularity
+
+
+pytestmark = pytest.mark.usefixtures("isolate_from_home")
+
+
+@pytest.fixture
+def probe_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    return singularity.probe_cache_file()
+
+
+def test_cached_probe(probe_cache):
+    calls = []
+
+    def probe():
+        calls.append(1)
+        return len(calls)
+
+    assert singularity.cached_probe('test', {'a': 1}, probe) == 1
+    assert singularity.cached_probe('test', {'a': 1}, probe) == 1
+    assert len(calls) == 1
+    assert os.path.exists(probe_cache)
+    # a change of the inputs invalidates the result
+    assert singularity.cached_probe('test', {'a': 2}, probe) == 2
+    assert singularity.cached_probe('test', {'a': 2}, probe) == 2
+    assert len(calls) == 2
+
+
+def test_failed_probe_not_cached(probe_cache):
+    calls = []
+
+    def probe():
+        calls.append(1)
+        return None
+
+    assert singularity.cached_probe('test', [1], probe) is None
+    assert singularity.cached_probe('test', [1], probe) is None
+    assert len(calls) == 2
+    assert not os.path.exists(probe_cache)
+
+
+def test_X_has_proprietary_nvidia_cached(probe_cache, monkeypatch):
+    calls = []
+
+    def probe():
+        calls.append(1)
+        return True
+
+    monkeypatch.setattr(singularity, '_probe_X_proprietary_nvidia', probe)
+    monkeypatch.setenv('DISPLAY', 'remote:10.0')
+    monkeypatch.setenv('SSH_CONNECTION', '1.2.3.4 5000 5.6.7.8 22')
+    assert singularity._X_has_proprietary_nvidia()
+    assert singularity._X_has_proprietary_nvidia()
+    assert len(calls) == 1
+    # another SSH session forwards another X server
+    monkeypatch.setenv('SSH_CONNECTION', '1.2.3.4 5001 5.6.7.8 22')
+    assert singularity._X_has_proprietary_nvidia()
+    assert len(calls) == 2
+
+
+def test_image_fingerprint(tmp_path):
+    image = str(tmp_path / 'image.sif')
+    with open(image, 'w') as f:
+        f.write('image')
+    fingerprint = singularity._image_fingerprint(image)
+    assert fingerprint['size'] == 5
+    with open(image + '.json', 'w') as f:
+        json.dump({'image_id': 'abc'}, f)
+    assert singularity._image_fingerprint(image) == {'image_id': 'abc'}
+
+
+build_file = '''
+from casa_distro.image_builder import ImageBuilder
+
+builder = ImageBuilder('casa-test', base='base.sif')
+
+
+@builder.step
+def copy_files(base_dir, builder):
+    """Copy files."""
+    builder.copy_root(base_dir + '/files', '/build')
+    builder.run_user('echo %s > /casa/image_id' % builder.image_id)
+
+
+@builder.step
+def environment(base_dir, builder):
+    """Set environment."""
+    builder.environment({'CASA_TEST': '1'})
+
+
+@builder.step
+def install(base_dir, builder):
+    """Install."""
+    builder.run_root('/build/files/install.sh')
+'''
+
+
+def test_create_image_step_cache(fake_singularity, tmp_path, capsys):
+    from casa_distro.image_builder import get_image_builder
+
+    base, config, calls = fake_singularity
+    recipe_dir = tmp_path / 'recipe'
+    (recipe_dir / 'files').mkdir(parents=True)
+    (recipe_dir / 'build_image.py').write_text(build_file)
+    (recipe_dir / 'files' / 'install.sh').write_text('install')
+    base_image = tmp_path / 'base.sif'
+    base_image.write_text('base')
+    metadata = {'type': 'run', 'system': 'ubuntu-22.04',
+                'image_version': '5.4'}
+
+    def build():
+        if calls.exists():
+            calls.unlink()
+        output = str(tmp_path / 'output.sif')
+        image_id, msg = singularity.create_image(
+            str(base_image), {}, output, metadata,
+            get_image_builder(str(recipe_dir / 'build_image.py')),
+            step_cache='yes')
+        builds = [line for line in calls.read_text().splitlines()
+                  if line.startswith('build ')]
+        with open(output) as f:
+            image = f.read()
+        return image_id, builds, image, capsys.readouterr().out
+
+    image_id, builds, image, out = build()
+    assert len(builds) == 3  # 2 steps and the output image
+    assert 'copy_files: built' in out
+    assert 'environment: no-op' in out
+    assert 'install: built' in out
+    assert 'export CASA_TEST="1"' in image
+
+    # nothing has changed: only the output image is built, and the image
+    # identifier is written again
+    new_id, builds, image, out = build()
+    assert new_id != image_id
+    assert len(builds) == 1
+    assert 'copy_files: reused' in out
+    assert 'install: reused' in out
+    assert 'echo %s > /casa/image_id' % new_id in image
+
+    # a copied file has changed: the build resumes from its step
+    (recipe_dir / 'files' / 'install.sh').write_text('new install')
+    new_id, builds, image, out = build()
+    assert len(builds) == 3
+    assert 'copy_files: built' in out
+    assert 'install: built' in out
+    # the replaced step images are removed
+    assert '2 superseded step images removed' in out
+    cache = singularity.build_step_cache_directory()
+    assert len([f for f in os.listdir(cache) if f.endswith('.sif')]) == 2
+
+
+def test_create_image_package_cache(fake_singularity, tmp_path, capsys):
+    from casa_distro.image_builder import get_image_builder
+
+    base, config, calls = fake_singularity
+    recipe_dir = tmp_path / 'recipe'
+    (recipe_dir / 'files').mkdir(parents=True)
+    (recipe_dir / 'build_image.py').write_text(build_file)
+    (recipe_dir / 'files' / 'install.sh').write_text('install')
+    base_image = tmp_path / 'base.sif'
+    base_image.write_text('base')
+    package_cache = tmp_path / 'packages'
+    (package_cache / 'apt' / 'archives').mkdir(parents=True)
+    (package_cache / 'apt' / 'archives' / 'gcc.deb').write_text('deb')
+    output = tmp_path / 'output.sif'
+    singularity.create_image(
+        str(base_image), {}, str(output),
+        {'type': 'run', 'system': 'ubuntu-22.04', 'image_version': '5.4'},
+        get_image_builder(str(recipe_dir / 'build_image.py')),
+        package_cache=str(package_cache))
+
+    [build] = [line for line in calls.read_text().splitlines()
+               if line.startswith('build ')]
+    assert '--bind %s:/casa-build-cache' % package_cache in build
+    recipe = output.read_text()
+    assert 'export APT_CONFIG=/casa-build-cache/apt.conf' in recipe
+    # the cache settings come before the commands of the steps
+    assert recipe.index('PIP_CACHE_DIR') < recipe.index('install.sh')
+    assert (package_cache / 'apt.conf').exists()
+    assert (package_cache / 'pip').is_dir()
+    out = capsys.readouterr().out
+    assert 'apt: 1 files in cache before the build' in out
+
+    before = singularity.package_cache_contents(str(package_cache))
+    (package_cache / 'pip' / 'wheel').write_text('wheel')
+    report = singularity.package_cache_report(
+        before, singularity.package_cache_contents(str(package_cache)))
+    assert report['apt']['cached'] == 1
+    assert report['apt']['downloaded'] == 0
+    assert report['pip'] == {'cached': 0, 'cached_bytes': 0,
+                             'downloaded': 1, 'downloaded_bytes': 5}
+
+
+def test_create_user_image_overlay(fake_singularity, fake_mksquashfs,
+                                   tmp_path):
+    base, config, calls = fake_singularity
+    mksquashfs = fake_mksquashfs
+    script = mksquashfs.read_text()
+    dev = tmp_path / 'dev'
+    (dev / 'install' / 'bin').mkdir(parents=True)
+    (dev / 'install' / 'bin' / 'bv_env').write_text('bv_env')
+    run_image = tmp_path / 'casa-run.sif'
+    run_image.write_text('run image\n')
+    output = tmp_path / 'user.sif'
+    dev_config = {'directory': str(dev), 'system': 'ubuntu-22.04',
+                  'distro': 'brainvisa'}
+
+    image_id, msg = singularity.create_user_image(
+        str(run_image), dev_config, '5.4.0', str(output),
+        install_thirdparty='none', builder='overlay')
+
+    lines = output.read_text().splitlines()
+    # copy of the run image with the overlay partition
+    assert lines[0] == 'run image'
+    assert './casa/install/bin/bv_env' in lines
+    assert './casa/casa-distro/python/casa_distro/singularity.py' in lines
+    assert './.singularity.d/runscript' in lines
+    assert not [line for line in lines if '__pycache__' in line]
+    # commands are run in a container with the overlay
+    calls = calls.read_text()
+    assert ' --overlay ' in calls
+    assert image_id in calls and 'bv_env_snapshot' in calls
+    [add] = [line for line in calls.splitlines()
+             if line.startswith('sif add ')]
+    assert '--parttype 4' in add
+    # the work directory is removed
+    assert not [f for f in os.listdir(str(tmp_path))
+                if f.startswith('casa_distro_overlay_')]
+    # even when it is not cleaned up on failure
+    singularity.create_user_image(
+        str(run_image), dev_config, '5.4.0', str(output),
+        install_thirdparty='none', builder='overlay', force='yes',
+        cleanup=False)
+    assert not [f for f in os.listdir(str(tmp_path))
+                if f.startswith('casa_distro_overlay_')]
+    # but kept if the build fails
+    mksquashfs.write_text('#!/bin/sh\nexit 1\n')
+    with pytest.raises(subprocess.CalledProcessError):
+        singularity.create_user_image(
+            str(run_image), dev_config, '5.4.0', str(output),
+            install_thirdparty='none', builder='overlay', force='yes',
+            cleanup=False)
+    assert [f for f in os.listdir(str(tmp_path))
+            if f.startswith('casa_distro_overlay_')]
+    mksquashfs.write_text(script)
+
+    # an existing image is not replaced without force
+    with pytest.raises(ValueError):
+        singularity.create_user_image(
+            str(run_image), dev_config, '5.4.0', str(output),
+            install_thirdparty='none', builder='overlay')
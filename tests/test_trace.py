@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import pytest
+
+from casa_distro import trace
+
+
+def test_span(tmp_path, monkeypatch):
+    trace_file = str(tmp_path / 'trace.json')
+    monkeypatch.setenv('CASA_DISTRO_TRACE', trace_file)
+    with trace.span('outer', step=1) as args:
+        with trace.span('inner'):
+            pass
+        args['exit_code'] = 3
+    with pytest.raises(ValueError):
+        with trace.span('failed'):
+            raise ValueError()
+    inner, outer, failed = trace.read_trace(trace_file)
+    assert [inner['name'], outer['name'], failed['name']] == [
+        'inner', 'outer', 'failed']
+    assert outer['args'] == {'step': 1, 'exit_code': 3}
+    assert outer['pid'] == os.getpid()
+    assert outer['ts'] <= inner['ts']
+    assert inner['ts'] + inner['dur'] <= outer['ts'] + outer['dur'] + 1
+
+
+def test_no_trace(tmp_path, monkeypatch):
+    monkeypatch.delenv('CASA_DISTRO_TRACE', raising=False)
+    with trace.span('span'):
+        pass
+    assert os.listdir(str(tmp_path)) == []
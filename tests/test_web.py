@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+
+import pytest
+
+from casa_distro import web
+
+
+pytestmark = pytest.mark.usefixtures("isolate_from_home")
+
+
+@pytest.fixture
+def listing(http_server, monkeypatch):
+    monkeypatch.delenv('XDG_CACHE_HOME', raising=False)
+    monkeypatch.delenv('CASA_DISTRO_LISTDIR_TTL', raising=False)
+    web.clear_listdir_memo()
+    for name in ('a-5.0-1.sif', 'a-5.0-2.sif'):
+        with open(os.path.join(http_server.directory, name), 'w') as f:
+            f.write(name)
+    os.mkdir(os.path.join(http_server.directory, 'sub'))
+    yield http_server.url + '/'
+    web.clear_listdir_memo()
+
+
+def listing_requests(http_server):
+    return [r for r in http_server.requests if r[1] == '/']
+
+
+def test_url_listdir(http_server, listing):
+    expected = ['a-5.0-1.sif', 'a-5.0-2.sif', 'sub/']
+    assert web.url_listdir(listing) == expected
+    # memorized in the current process
+    assert web.url_listdir(listing) == expected
+    assert len(listing_requests(http_server)) == 1
+
+    # cached on disk, for another process
+    web.clear_listdir_memo()
+    assert web.url_listdir(listing) == expected
+    assert len(listing_requests(http_server)) == 1
+
+
+def test_url_listdir_revalidation(http_server, listing):
+    assert len(web.url_listdir(listing)) == 3
+    web.clear_listdir_memo()
+    # expired but unchanged: revalidated with the ETag
+    assert len(web.url_listdir(listing, ttl=0)) == 3
+    assert len(listing_requests(http_server)) == 2
+
+    with open(os.path.join(http_server.directory, 'a-5.0-3.sif'), 'w') as f:
+        f.write('new')
+    # still valid
+    assert len(web.url_listdir(listing)) == 3
+    assert len(listing_requests(http_server)) == 2
+    # expired and modified
+    assert web.url_listdir(listing, ttl=0)[-2:] == ['a-5.0-3.sif', 'sub/']
+    assert len(listing_requests(http_server)) == 3
+
+
+def test_url_catalog(http_server, listing, tmp_path):
+    from casa_distro.environment import (find_image_update_url,
+                                         get_run_base_of_dev_image)
+
+    assert web.url_catalog(listing) is None
+    # the absence of catalog is memorized too
+    assert web.url_catalog(listing) is None
+    assert len([r for r in http_server.requests
+                if r[1] == '/catalog.json']) == 1
+
+    # fallback to directory listing
+    local = tmp_path / 'local'
+    local.mkdir()
+    image = str(local / 'a-5.0-1.sif')
+    assert find_image_update_url(image, http_server.url) == (
+        http_server.url + '/a-5.0-2.sif', False)
+
+    web.clear_listdir_memo()
+    catalog = {'images': {
+        'a-5.0-%d.sif' % i: {'name': 'a', 'version': '5.0', 'patch': i,
+                             'image_id': 'id%d' % i, 'md5': None,
+                             'size': None, 'compatibility': []}
+        for i in (1, 2, 3)}}
+    with open(os.path.join(http_server.directory,
+                           web.catalog_basename), 'w') as f:
+        json.dump(catalog, f)
+    del http_server.requests[:]
+    # a-5.0-3.sif is only in the catalog
+    assert find_image_update_url(image, http_server.url) == (
+        http_server.url + '/a-5.0-3.sif', False)
+
+    dev_image = str(local / 'a-dev-5.0.sif')
+    with open(dev_image, 'w') as f:
+        f.write('dev')
+    with open(dev_image + '.json', 'w') as f:
+        json.dump({'origin_run': 'id2'}, f)
+    assert get_run_base_of_dev_image(dev_image, url=http_server.url) \
+        == str(local / 'a-5.0-2.sif')
+    # one request for both resolutions, no listing nor metadata download
+    assert [r[1] for r in http_server.requests] == ['/catalog.json']